@@ -1,12 +1,28 @@
 import os
 import time
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import date, datetime, timedelta
+import csv
+import io
+import queue
+import hmac
+import threading
+import mimetypes
+import itertools
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response, stream_with_context, has_request_context, send_from_directory
+from werkzeug.security import safe_join
 from functools import wraps
 from dotenv import load_dotenv
-from db_wrapper import NeonDB
+from db_wrapper import NeonDB, ConnectionPool, get_statement_stats
+from xlsx_stream import genera_xlsx
+from presenze_stream import StatoListener
+from report_cache import PERCORSO_PREDEFINITO, ReportCache
+from passwords import PasswordHasher
+import metrics
+import report
+import risposte
+from report import intervallo_dettaglio
 import psycopg2
+import psycopg2.errors
 
 load_dotenv()
 
@@ -16,39 +32,238 @@ if hasattr(time, 'tzset'):
     time.tzset()
 
 app = Flask(__name__)
+# JSON con orjson (vedi risposte.py)
+app.json = risposte.OrjsonProvider(app)
 # Use environment variable for secret key
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 # Use environment variable for database URL
 app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL')
+# Pool di connessioni per worker (dimensionare insieme a gunicorn -w / --threads)
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 4))
+app.config['DB_POOL_MAX_OVERFLOW'] = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 2))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = float(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = float(os.environ.get('DB_POOL_PRE_PING', 30))
+# Cache delle query per connessione e prepared statement lato server
+# (disattivarli con l'endpoint "-pooler" di Neon, che non supporta PREPARE)
+app.config['DB_STATEMENT_CACHE_SIZE'] = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100))
+app.config['DB_PREPARED_STATEMENTS'] = os.environ.get('DB_PREPARED_STATEMENTS', '1') not in ('0', 'false', 'no')
+app.config['DB_PREPARE_THRESHOLD'] = int(os.environ.get('DB_PREPARE_THRESHOLD', 2))
+# LISTEN/NOTIFY richiede una connessione diretta (non l'endpoint "-pooler" di Neon)
+app.config['DATABASE_LISTEN_URL'] = os.environ.get('DATABASE_LISTEN_URL') or app.config['DATABASE_URL']
+# Durata massima di una connessione SSE prima che il browser si riconnetta
+app.config['SSE_MAX_DURATION'] = int(os.environ.get('SSE_MAX_DURATION', 1800))
+# Connessioni SSE per worker: ognuna occupa un thread di gunicorn, quindi il
+# limite va tenuto sotto --threads per lasciare thread alle timbrature
+app.config['SSE_MAX_CONNESSIONI'] = int(os.environ.get('SSE_MAX_CONNESSIONI', 8))
+# Mesi futuri per cui creare in anticipo le partizioni di timbrature
+app.config['TIMBRATURE_MESI_FUTURI'] = int(os.environ.get('TIMBRATURE_MESI_FUTURI', 3))
+# Numero massimo di timbrature accettate in un invio della coda offline
+app.config['BATCH_MAX_TIMBRATURE'] = int(os.environ.get('BATCH_MAX_TIMBRATURE', 1000))
+# Un tocco entro questi secondi da un'uscita dello stesso dipendente è un tocco
+# doppio, non un nuovo ingresso
+app.config['TIMBRATURA_DOPPIA_SECONDI'] = int(os.environ.get('TIMBRATURA_DOPPIA_SECONDI', 5))
+# Cache dei report condivisa dai worker della macchina (0 byte = disattivata)
+app.config['REPORT_CACHE_PATH'] = os.environ.get('REPORT_CACHE_PATH') or PERCORSO_PREDEFINITO
+app.config['REPORT_CACHE_BYTES'] = int(os.environ.get('REPORT_CACHE_BYTES', 32 * 1024 * 1024))
+# Strumentazione SQL: header Server-Timing con tempo e numero di query della
+# richiesta, e log (logger "timbraceck.sql") delle query più lente di SLOW_QUERY_MS
+# millisecondi (0 = disattivato)
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '1') not in ('0', 'false', 'no')
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 500))
+# Server asincrono (asgi.py): connessioni psycopg 3 condivise da tutte le
+# richieste di sola lettura del worker e thread per le rotte servite da Flask
+app.config['ASYNC_DB_POOL_SIZE'] = int(os.environ.get('ASYNC_DB_POOL_SIZE', 4))
+app.config['ASGI_WSGI_THREADS'] = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+# Compressione gzip/brotli (secondo Accept-Encoding) delle risposte testuali di
+# almeno COMPRESSION_MIN_BYTES byte (0 = disattivata); brotli solo se installato
+app.config['COMPRESSION_MIN_BYTES'] = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+app.config['COMPRESSION_GZIP_LEVEL'] = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+# Token richiesto da /metrics (header "Authorization: Bearer ..."); vuoto = libero
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Hash delle password: iterazioni PBKDF2 (gli hash con parametri diversi vengono
+# ricalcolati al login), processi dedicati per worker (0 = nel thread della
+# richiesta) e durata in secondi della cache delle verifiche riuscite
+app.config['PASSWORD_ITERATIONS'] = int(os.environ.get('PASSWORD_ITERATIONS', 600000))
+app.config['PASSWORD_PROCESSES'] = int(os.environ.get('PASSWORD_PROCESSES', 2))
+app.config['PASSWORD_CACHE_TTL'] = int(os.environ.get('PASSWORD_CACHE_TTL', 12 * 3600))
 
 # Aggiunta della variabile 'now' a tutti i template
 @app.context_processor
 def inject_now():
     return {'now': datetime.now()}
 
-def to_datetime(val, format='%Y-%m-%d %H:%M:%S'):
-    if val is None:
-        return None
-    if isinstance(val, str):
-        return datetime.strptime(val, format)
-    return val
+# Asset statici con hash nel nome e versioni precompresse, generati da
+# build_static.py in static/dist insieme a manifest.json (nome originale ->
+# nome con hash). Senza build, o in debug, si usano i file di static/.
+ASSET_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def carica_manifest():
+    try:
+        with open(os.path.join(ASSET_DIR, 'manifest.json'), 'rb') as f:
+            return app.json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+asset_manifest = carica_manifest()
+
+@app.template_global()
+def asset_url(filename, **values):
+    """Come url_for('static', filename=...), con il nome con hash se presente nel manifest."""
+    nome = None if app.debug else asset_manifest.get(filename)
+    if nome is None:
+        return url_for('static', filename=filename, **values)
+    return url_for('asset', filename=nome, **values)
+
+@app.route('/static/dist/<path:filename>')
+def asset(filename):
+    # Il nome cambia con il contenuto: il browser lo tiene un anno senza
+    # riconvalidarlo. Serve la versione precompressa accettata dal client.
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    codifica = risposte.negozia(request.accept_encodings)
+    percorso = filename
+    if codifica is not None:
+        compresso = safe_join(ASSET_DIR, filename + risposte.ESTENSIONI[codifica])
+        if compresso is not None and os.path.isfile(compresso):
+            percorso = filename + risposte.ESTENSIONI[codifica]
+        else:
+            codifica = None
+    response = send_from_directory(ASSET_DIR, percorso, mimetype=mimetype, max_age=ASSET_MAX_AGE,
+                                   download_name=os.path.basename(filename))
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if codifica is not None:
+        response.headers['Content-Encoding'] = codifica
+    return response
 
 # Funzioni di utilità per il database
-# Funzioni di utilità per il database
+db_pool = None
+
+def init_db_pool():
+    # Crea il pool del worker e apre subito le connessioni, così la prima
+    # timbratura non paga l'handshake TCP+TLS verso Neon.
+    global db_pool
+    if db_pool is None and app.config['DATABASE_URL']:
+        db_pool = ConnectionPool(
+            app.config['DATABASE_URL'],
+            size=app.config['DB_POOL_SIZE'],
+            max_overflow=app.config['DB_POOL_MAX_OVERFLOW'],
+            timeout=app.config['DB_POOL_TIMEOUT'],
+            recycle=app.config['DB_POOL_RECYCLE'],
+            pre_ping=app.config['DB_POOL_PRE_PING'],
+            statement_cache_size=app.config['DB_STATEMENT_CACHE_SIZE'],
+            prepare_threshold=app.config['DB_PREPARE_THRESHOLD'] if app.config['DB_PREPARED_STATEMENTS'] else 0,
+        )
+        try:
+            db_pool.warm()
+        except Exception as e:
+            print(f"Error warming database pool: {e}")
+    return db_pool
+
 def get_db():
     if 'db' not in g:
         try:
-            conn = psycopg2.connect(app.config['DATABASE_URL'])
-            g.db = NeonDB(conn)
+            pool = init_db_pool()
+            opzioni = {
+                'slow_query_ms': app.config['SLOW_QUERY_MS'],
+                'label': request.endpoint if has_request_context() else None,
+            }
+            if pool is not None:
+                g.db = NeonDB(pool.getconn(), pool, **opzioni)
+            else:
+                g.db = NeonDB(psycopg2.connect(app.config['DATABASE_URL']), **opzioni)
         except Exception as e:
             print(f"Error connecting to database: {e}")
             raise e
     return g.db
 
+# Totali per rotta di questo worker (richieste, query, tempo sul database),
+# esposti da /api/db/stats per trovare le schermate che consumano più database
+statistiche_rotte = {}
+statistiche_rotte_lock = threading.Lock()
+
+def get_route_stats():
+    with statistiche_rotte_lock:
+        rotte = {k: dict(v) for k, v in statistiche_rotte.items()}
+    for v in rotte.values():
+        v['db_time'] = round(v['db_time'], 3)
+        v['queries_per_request'] = round(v['queries'] / v['requests'], 2)
+    return dict(sorted(rotte.items(), key=lambda r: r[1]['db_time'], reverse=True))
+
+@app.before_request
+def inizio_richiesta():
+    g.inizio_richiesta = time.perf_counter()
+    metrics.RICHIESTE_IN_CORSO.inc()
+
+@app.after_request
+def server_timing(response):
+    # Per le risposte in streaming (export) conta solo le query fatte prima
+    # dell'invio del corpo; i totali per rotta le includono tutte
+    db = g.get('db')
+    if 'inizio_richiesta' in g:
+        endpoint = request.endpoint or 'none'
+        metrics.DURATA_RICHIESTE.labels(endpoint, request.method).observe(time.perf_counter() - g.inizio_richiesta)
+        metrics.RICHIESTE.labels(endpoint, request.method, response.status_code).inc()
+    if app.config['SERVER_TIMING'] and 'inizio_richiesta' in g:
+        totale = (time.perf_counter() - g.inizio_richiesta) * 1000
+        metriche = [f'app;dur={totale:.1f}']
+        if db is not None:
+            metriche.append(f'db;dur={db.stats.time * 1000:.1f};desc="{db.stats.count} queries, {db.stats.rows} rows"')
+            if db.stats.count:
+                metriche.append(f'db-slowest;dur={db.stats.slowest_time * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(metriche)
+    return response
+
+@app.after_request
+def comprimi_risposta(response):
+    # Eseguita prima di server_timing, che quindi include la compressione. Le
+    # risposte in streaming (export, SSE) e i file statici restano come sono.
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    dati, codifica, vary = risposte.comprimi_risposta(response.get_data(), response.mimetype,
+                                                      request.accept_encodings, app.config)
+    if vary:
+        response.vary.add('Accept-Encoding')
+    if codifica is None:
+        return response
+    response.set_data(dati)
+    response.headers['Content-Encoding'] = codifica
+    # Come i proxy che comprimono: l'ETag della versione compressa diventa debole
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.teardown_request
+def fine_richiesta(e=None):
+    # Anche dopo un'eccezione (dove after_request non viene chiamato) e, per le
+    # risposte in streaming, alla fine del corpo
+    if g.pop('inizio_richiesta', None) is not None:
+        metrics.RICHIESTE_IN_CORSO.dec()
+        if e is not None:
+            metrics.RICHIESTE.labels(request.endpoint or 'none', request.method, 500).inc()
+
+def registra_query(endpoint, stats):
+    # Query di una richiesta (QueryStats) nei totali per rotta e nelle metriche
+    metrics.DURATA_DB.labels(endpoint).observe(stats.time)
+    metrics.QUERY_DB.labels(endpoint).inc(stats.count)
+    with statistiche_rotte_lock:
+        rotta = statistiche_rotte.setdefault(endpoint, {'requests': 0, 'queries': 0, 'rows': 0, 'db_time': 0.0})
+        rotta['requests'] += 1
+        rotta['queries'] += stats.count
+        rotta['rows'] += stats.rows
+        rotta['db_time'] += stats.time
+
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
+        if db.label is not None:
+            registra_query(db.label, db.stats)
         db.close()
 
 def init_db():
@@ -87,6 +302,85 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Decoratore per le API JSON di sola lettura: ETag forte legato alla versione dei dati.
+# Se il client ha già la versione corrente risponde 304 senza eseguire le query.
+def etag_dati(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        versione = get_db().execute(report.VERSIONE_DATI).fetchone()['versione']
+        etag = risposte.etag_dati(request.full_path, versione)
+        if risposte.non_modificata(request.headers.get('If-None-Match'), etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = risposte.CACHE_CONTROL_DATI
+        return response
+    return decorated_function
+
+# Cache dei report condivisa tra i worker gunicorn
+report_cache = None
+
+def get_report_cache():
+    global report_cache
+    if report_cache is None and app.config['REPORT_CACHE_BYTES'] > 0:
+        report_cache = ReportCache(app.config['REPORT_CACHE_PATH'], app.config['REPORT_CACHE_BYTES'])
+    return report_cache
+
+def chiave_report(path, args, data_inizio, data_fine):
+    return f"{path}?{sorted(args.items())}|{data_inizio}|{data_fine}"
+
+def report_da_cache(data_inizio, data_fine, dipendente_id=None):
+    # Cerca il report della richiesta corrente; la chiave usa le date già risolte,
+    # così i periodi relativi ("ultimo mese") cambiano chiave da soli ogni giorno.
+    cache = get_report_cache()
+    if cache is None:
+        return None
+    chiave = chiave_report(request.path, request.args, data_inizio, data_fine)
+    body = cache.get(chiave)
+    if body is not None:
+        return app.response_class(body, mimetype=app.json.mimetype)
+    # La generazione va letta prima delle query, per non salvare un risultato
+    # calcolato mentre un'altra richiesta lo stava invalidando
+    g.report_cache = (chiave, cache.generazione(), dipendente_id, str(data_inizio)[:10], str(data_fine)[:10])
+    return None
+
+def report_in_cache(result):
+    # Serializza il report e lo salva nella cache preparata da report_da_cache
+    response = jsonify(result)
+    voce = g.pop('report_cache', None)
+    if voce is not None:
+        chiave, generazione, dipendente_id, data_inizio, data_fine = voce
+        get_report_cache().put(chiave, response.get_data(as_text=True), dipendente_id,
+                               data_inizio, data_fine, generazione)
+    return response
+
+def invalida_report(dipendente_id=None, *giorni):
+    # Da chiamare dopo il commit: elimina i report che includono quei giorni
+    # per il dipendente (e quelli su tutti i dipendenti). Senza argomenti svuota la cache.
+    cache = get_report_cache()
+    if cache is None:
+        return
+    if not giorni:
+        cache.invalida(dipendente_id)
+    for giorno in set(str(d)[:10] for d in giorni):
+        cache.invalida(dipendente_id, giorno)
+
+password_hasher = None
+
+def get_password_hasher():
+    global password_hasher
+    if password_hasher is None:
+        password_hasher = PasswordHasher(
+            app.config['PASSWORD_ITERATIONS'],
+            app.config['PASSWORD_PROCESSES'],
+            app.config['PASSWORD_CACHE_TTL'],
+            app.config['SECRET_KEY']
+        )
+    return password_hasher
+
 # Rotte principali
 @app.route('/')
 @login_required
@@ -97,43 +391,145 @@ def index():
     # Handle fetching dipendenti for the grid view
     # Note: Logic here might need adjustment if we only show logged in user%s 
     # Original logic showed all employees. Keeping as is.
-    cur = db.execute('SELECT * FROM dipendenti ORDER BY cognome, nome')
-    dipendenti = cur.fetchall()
+    # Lo stato iniziale viene incluso nella pagina: il chiosco non deve
+    # chiamare /api/stato-dipendenti all'avvio
+    dipendenti = stato_dipendenti(db)
     return render_template('index.html', dipendenti=dipendenti)
 
+def registra_timbratura(db, dipendente_id, client_id, now):
+    # Uscita se c'è un turno aperto (la riga di presenze_correnti, bloccata con
+    # FOR UPDATE), altrimenti ingresso: un solo statement in autocommit, quindi un
+    # solo round-trip verso il database. Id e inizio del turno aperto individuano
+    # direttamente la partizione da aggiornare. L'id del chiosco viene registrato
+    # in timbrature_client nello stesso statement; se era già presente non cambia nulla.
+    # Nessuna riga se presenze_correnti indica un turno che non è aperto in timbrature.
+    # Tocco doppio in uscita: il secondo tocco attende il blocco del primo e non
+    # trova più il turno aperto. Se il turno era aperto all'inizio dello statement
+    # (vista, senza blocco) o è stato chiuso negli ultimi TIMBRATURA_DOPPIA_SECONDI,
+    # restituisce 'uscita_doppia' invece di aprire un nuovo turno. Si cercano solo
+    # i turni iniziati nelle ultime 24 ore, per leggere al massimo due partizioni.
+    return db.execute_autocommit('''
+        WITH registrata AS (
+            INSERT INTO timbrature_client (client_id, dipendente_id)
+            SELECT %s::text, %s WHERE %s::text IS NOT NULL
+            ON CONFLICT (client_id) DO NOTHING
+            RETURNING client_id
+        ),
+        nuova AS (
+            SELECT 1 WHERE %s::text IS NULL OR EXISTS (SELECT 1 FROM registrata)
+        ),
+        vista AS (
+            SELECT 1 FROM presenze_correnti WHERE dipendente_id = %s
+        ),
+        aperta AS (
+            SELECT timbratura_id, inizio FROM presenze_correnti
+            WHERE dipendente_id = %s AND EXISTS (SELECT 1 FROM nuova)
+            FOR UPDATE
+        ),
+        uscita_recente AS (
+            SELECT 1 WHERE EXISTS (SELECT 1 FROM vista)
+            UNION ALL
+            SELECT 1 FROM timbrature
+            WHERE dipendente_id = %s AND inizio >= %s::timestamp - interval '1 day'
+              AND fine > %s::timestamp - make_interval(secs => %s) AND fine <= %s
+        ),
+        uscita AS (
+            UPDATE timbrature t SET fine = %s
+            FROM aperta
+            WHERE t.id = aperta.timbratura_id AND t.inizio = aperta.inizio AND t.fine IS NULL
+            RETURNING 'uscita' AS tipo, t.inizio
+        ),
+        ingresso AS (
+            INSERT INTO timbrature (dipendente_id, inizio)
+            SELECT %s, %s
+            WHERE NOT EXISTS (SELECT 1 FROM aperta) AND EXISTS (SELECT 1 FROM nuova)
+              AND NOT EXISTS (SELECT 1 FROM uscita_recente)
+            RETURNING 'ingresso' AS tipo, inizio
+        )
+        SELECT tipo, inizio FROM uscita
+        UNION ALL
+        SELECT tipo, inizio FROM ingresso
+        UNION ALL
+        SELECT 'uscita_doppia', NULL
+        WHERE NOT EXISTS (SELECT 1 FROM aperta) AND EXISTS (SELECT 1 FROM nuova)
+          AND EXISTS (SELECT 1 FROM uscita_recente)
+        UNION ALL
+        SELECT 'duplicata', NULL WHERE NOT EXISTS (SELECT 1 FROM nuova)
+    ''', (client_id, dipendente_id, client_id, client_id, dipendente_id, dipendente_id,
+          dipendente_id, now, now, app.config['TIMBRATURA_DOPPIA_SECONDI'], now,
+          now, dipendente_id, now)).fetchone()
+
+def riallinea_presenza(db, dipendente_id, client_id):
+    # Ricostruisce la riga di presenze_correnti del dipendente dai turni aperti in
+    # timbrature (come lo schema all'avvio) e dimentica l'id del chiosco,
+    # registrato dal tentativo che non ha timbrato
+    db.execute('DELETE FROM presenze_correnti WHERE dipendente_id = %s', (dipendente_id,))
+    db.execute('''
+        INSERT INTO presenze_correnti (dipendente_id, timbratura_id, inizio)
+        SELECT dipendente_id, id, inizio FROM timbrature
+        WHERE dipendente_id = %s AND fine IS NULL
+        ORDER BY inizio DESC
+        LIMIT 1
+    ''', (dipendente_id,))
+    if client_id is not None:
+        db.execute('DELETE FROM timbrature_client WHERE client_id = %s', (client_id,))
+    db.commit()
+
 @app.route('/timbratura', methods=['POST'])
 @login_required
 def timbratura():
     dipendente_id = request.form.get('dipendente_id')
+    # Id generato dal chiosco: se la risposta va persa la timbratura finisce
+    # nella coda offline, e il batch la riconosce come già registrata
+    client_id = request.form.get('client_id', '')[:64] or None
     db = get_db()
+    now = datetime.now()
     
-    # Verifica se esiste una timbratura di ingresso senza uscita
-    cur = db.execute(
-        'SELECT * FROM timbrature WHERE dipendente_id = %s AND fine IS NULL ORDER BY inizio DESC LIMIT 1',
-        (dipendente_id,)
-    )
-    ultima_timbratura = cur.fetchone()
+    try:
+        esito = registra_timbratura(db, dipendente_id, client_id, now)
+        if esito is None:
+            # presenze_correnti non allineata (turno aperto cancellato o chiuso
+            # senza passare dai trigger): riallinea il dipendente e riprova una volta
+            print(f"presenze_correnti out of sync for employee {dipendente_id}: resyncing")
+            riallinea_presenza(db, dipendente_id, client_id)
+            esito = registra_timbratura(db, dipendente_id, client_id, now)
+    except psycopg2.errors.UniqueViolation:
+        # Tocco doppio: il trigger su presenze_correnti ha rifiutato il secondo
+        # ingresso, già registrato dalla richiesta concorrente
+        metrics.TIMBRATURE.labels('doppia', 'chiosco').inc()
+        return jsonify({
+            'success': True,
+            'message': "Timbratura di ingresso già registrata",
+            'tipo': 'ingresso',
+            'timestamp': now.strftime('%d/%m/%Y %H:%M:%S')
+        })
+    if esito is None:
+        return jsonify({'success': False, 'error': 'Stato del dipendente non coerente, riprovare'}), 409
     
-    if ultima_timbratura:
-        # Se esiste, registra l'uscita
-        now = datetime.now()
-        db.execute(
-            'UPDATE timbrature SET fine = %s WHERE id = %s',
-            (now, ultima_timbratura['id'])
-        )
+    tipo = esito['tipo']
+    if tipo == 'uscita_doppia':
+        # Tocco doppio in uscita: il turno è già stato chiuso dal primo tocco
+        metrics.TIMBRATURE.labels('doppia', 'chiosco').inc()
+        return jsonify({
+            'success': True,
+            'message': "Timbratura di uscita già registrata",
+            'tipo': 'uscita',
+            'timestamp': now.strftime('%d/%m/%Y %H:%M:%S')
+        })
+    metrics.TIMBRATURE.labels(tipo, 'chiosco').inc()
+    if tipo == 'duplicata':
+        return jsonify({
+            'success': True,
+            'message': "Timbratura già registrata",
+            'tipo': tipo,
+            'timestamp': now.strftime('%d/%m/%Y %H:%M:%S')
+        })
+    if tipo == 'uscita':
         messaggio = "Timbratura di uscita registrata"
-        tipo = "uscita"
     else:
-        # Altrimenti registra un nuovo ingresso
-        now = datetime.now()
-        db.execute(
-            'INSERT INTO timbrature (dipendente_id, inizio) VALUES (%s, %s)',
-            (dipendente_id, now)
-        )
         messaggio = "Timbratura di ingresso registrata"
-        tipo = "ingresso"
-    
-    db.commit()
+    # Le ore vengono attribuite al giorno di inizio del turno
+    invalida_report(int(dipendente_id), esito['inizio'])
     
     return jsonify({
         'success': True, 
@@ -142,6 +538,133 @@ def timbratura():
         'timestamp': now.strftime('%d/%m/%Y %H:%M:%S')
     })
 
+def fine_chiusura(db):
+    # Primo giorno dopo l'ultimo mese chiuso (None se nessun mese è chiuso)
+    return db.execute(
+        "SELECT (MAX(mese) + interval '1 month')::date AS fine FROM mesi_chiusi"
+    ).fetchone()['fine']
+
+@app.route('/api/timbrature/batch', methods=['POST'])
+@login_required
+def api_timbrature_batch():
+    # Coda offline dei chioschi: timbrature con id generato dal client e orario
+    # originale, applicate in ordine di orario con la stessa logica di timbratura()
+    # in un'unica transazione. Gli id già ricevuti vengono ignorati.
+    data = request.get_json(silent=True) or {}
+    eventi = data.get('timbrature')
+    if not isinstance(eventi, list):
+        return jsonify({'success': False, 'error': 'Dati mancanti'}), 400
+    if len(eventi) > app.config['BATCH_MAX_TIMBRATURE']:
+        return jsonify({'success': False, 'error': 'Troppe timbrature in un solo invio'}), 413
+    
+    limite = datetime.now() + timedelta(minutes=5)
+    risultati = {}
+    validi = []
+    for evento in eventi:
+        client_id = str(evento.get('id') or '')[:64] if isinstance(evento, dict) else ''
+        if not client_id or client_id in risultati:
+            continue
+        try:
+            dipendente_id = int(evento['dipendente_id'])
+            ts = datetime.fromisoformat(evento['timestamp'])
+            if ts.tzinfo is not None:
+                ts = ts.astimezone().replace(tzinfo=None)
+        except (KeyError, TypeError, ValueError):
+            risultati[client_id] = 'scartata'
+            continue
+        if ts > limite:
+            risultati[client_id] = 'scartata'
+            continue
+        risultati[client_id] = None
+        validi.append((ts, len(validi), client_id, dipendente_id))
+    
+    db = get_db()
+    modifiche = []
+    if validi:
+        # Le timbrature dei mesi chiusi non si possono più registrare
+        chiusura = fine_chiusura(db)
+        if chiusura is not None:
+            for v in validi:
+                if v[0].date() < chiusura:
+                    risultati[v[2]] = 'scartata'
+            validi = [v for v in validi if v[0].date() >= chiusura]
+    
+    if validi:
+        # 1. Deduplica: solo gli id mai visti vengono elaborati (un invio concorrente
+        #    con gli stessi id attende qui e poi li trova già presenti)
+        nuovi = db.execute_values(
+            'INSERT INTO timbrature_client (client_id, dipendente_id) VALUES %s '
+            'ON CONFLICT (client_id) DO NOTHING RETURNING client_id',
+            [(v[2], v[3]) for v in validi], fetch=True
+        )
+        nuovi = {r['client_id'] for r in nuovi}
+        for v in validi:
+            if v[2] not in nuovi:
+                risultati[v[2]] = 'duplicata'
+        validi = sorted(v for v in validi if v[2] in nuovi)
+    
+    if validi:
+        ids = sorted({v[3] for v in validi})
+        # 2. Blocca i dipendenti (le timbrature dai chioschi attendono la fine del blocco)
+        #    e poi i loro turni aperti, letti dopo il lock
+        esistenti = {r['id'] for r in db.execute(
+            'SELECT id FROM dipendenti WHERE id = ANY(%s) ORDER BY id FOR UPDATE', (ids,)
+        ).fetchall()}
+        aperte = {r['dipendente_id']: {'id': r['timbratura_id'], 'inizio': r['inizio']} for r in db.execute(
+            'SELECT dipendente_id, timbratura_id, inizio FROM presenze_correnti '
+            'WHERE dipendente_id = ANY(%s) FOR UPDATE', (ids,)
+        ).fetchall()}
+        
+        # 3. Simula l'alternanza ingresso/uscita in ordine di orario
+        chiusure = []
+        nuove = []
+        for ts, _, client_id, dipendente_id in validi:
+            if dipendente_id not in esistenti:
+                risultati[client_id] = 'scartata'
+                continue
+            aperta = aperte.get(dipendente_id)
+            if aperta is None:
+                aperta = {'id': None, 'inizio': ts, 'fine': None}
+                nuove.append((dipendente_id, aperta))
+                aperte[dipendente_id] = aperta
+                risultati[client_id] = 'ingresso'
+            elif ts <= aperta['inizio']:
+                # Uscita precedente all'ingresso: non la applichiamo
+                risultati[client_id] = 'scartata'
+            else:
+                if aperta['id'] is None:
+                    aperta['fine'] = ts
+                else:
+                    chiusure.append((aperta['id'], aperta['inizio'], ts))
+                del aperte[dipendente_id]
+                risultati[client_id] = 'uscita'
+                modifiche.append((dipendente_id, aperta['inizio']))
+        
+        # 4. Scritture multi-riga
+        if chiusure:
+            db.execute_values(
+                'UPDATE timbrature t SET fine = v.fine FROM (VALUES %s) AS v(id, inizio, fine) '
+                'WHERE t.id = v.id AND t.inizio = v.inizio',
+                chiusure, template='(%s, %s::timestamp, %s::timestamp)'
+            )
+        if nuove:
+            db.execute_values(
+                'INSERT INTO timbrature (dipendente_id, inizio, fine) VALUES %s',
+                [(dipendente_id, t['inizio'], t['fine']) for dipendente_id, t in nuove]
+            )
+            modifiche.extend((dipendente_id, t['inizio']) for dipendente_id, t in nuove)
+    
+    db.commit()
+    for dipendente_id, giorno in set(modifiche):
+        invalida_report(dipendente_id, giorno)
+    for esito in risultati.values():
+        metrics.TIMBRATURE.labels(esito, 'coda').inc()
+    
+    return jsonify({
+        'success': True,
+        'risultati': [{'id': client_id, 'esito': esito} for client_id, esito in risultati.items()]
+    })
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -154,17 +677,24 @@ def login():
         
         # Controlla sia password in chiaro (per la prima esecuzione/reset) o hashata
         if user:
+            hasher = get_password_hasher()
             pwd_valid = False
             # Check plain text first (migrazione/reset)
             if user['password'] == password:
                 pwd_valid = True
                 # Hasha la password per sicurezza futura (anche se poi la cambierà)
-                hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+                hashed_password = hasher.genera(password)
                 db.execute('UPDATE admin SET password = %s WHERE id = %s', (hashed_password, user['id']))
                 db.commit()
             # Check hash standard
-            elif user['password'].startswith('pbkdf2') and check_password_hash(user['password'], password):
+            elif user['password'].startswith('pbkdf2') and hasher.verifica(user['password'], password):
                 pwd_valid = True
+                # Parametri dell'hash cambiati (PASSWORD_ITERATIONS): ricalcolalo ora
+                # che abbiamo la password in chiaro
+                if hasher.da_aggiornare(user['password']):
+                    hashed_password = hasher.genera(password)
+                    db.execute('UPDATE admin SET password = %s WHERE id = %s', (hashed_password, user['id']))
+                    db.commit()
             
             if pwd_valid:
                 session['user_id'] = user['id']
@@ -214,7 +744,7 @@ def admin_change_password_dipendenti():
             return render_template('admin/change_password_dipendenti.html')
             
         db = get_db()
-        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        hashed_password = get_password_hasher().genera(new_password)
         
         # Aggiorna password utente 'dipendenti'
         # Note: 'dipendenti' isn't a user here, we check roles. 
@@ -260,7 +790,7 @@ def change_password():
         # Controlla password corrente
         password_valid = False
         if user['password'].startswith('pbkdf2'):
-            password_valid = check_password_hash(user['password'], current_password)
+            password_valid = get_password_hasher().verifica(user['password'], current_password)
         else:
             password_valid = (user['password'] == current_password)
         
@@ -269,7 +799,7 @@ def change_password():
             return render_template('change_password.html')
         
         # Aggiorna password
-        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        hashed_password = get_password_hasher().genera(new_password)
         db.execute('UPDATE admin SET password = %s, force_change = FALSE WHERE id = %s', (hashed_password, session['user_id']))
         db.commit()
         
@@ -320,7 +850,7 @@ def admin_dipendente_add():
              return redirect(url_for('admin_dipendenti'))
              
         try:
-            hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+            hashed_password = get_password_hasher().genera(password)
             db.execute(
                 "INSERT INTO admin (username, password, role) VALUES (%s, %s, %s)",
                 (username, hashed_password, 'dipendente')
@@ -348,6 +878,7 @@ def admin_dipendente_add():
                 (nome, cognome, email, data_assunzione, colore)
             )
             db.commit()
+            invalida_report()
             flash('Dipendente aggiunto con successo', 'success')
         except sqlite3.IntegrityError:
             flash('Email già in uso', 'error')
@@ -370,8 +901,13 @@ def admin_dipendente_edit(id):
     db = get_db()
     
     if request.method == 'DELETE':
-        db.execute('DELETE FROM dipendenti WHERE id = %s', (id,))
+        try:
+            db.execute('DELETE FROM dipendenti WHERE id = %s', (id,))
+        except (psycopg2.errors.ObjectNotInPrerequisiteState, psycopg2.errors.ForeignKeyViolation):
+            # Timbrature in mesi chiusi (o negli snapshot della chiusura)
+            return jsonify({'success': False, 'error': 'Il dipendente ha timbrature in mesi chiusi'}), 409
         db.commit()
+        invalida_report()
         return jsonify({'success': True})
     
     if request.method == 'POST':
@@ -390,6 +926,7 @@ def admin_dipendente_edit(id):
                     (nome, cognome, email, data_assunzione, colore, id)
                 )
                 db.commit()
+                invalida_report()
                 flash('Dipendente aggiornato con successo', 'success')
             except sqlite3.IntegrityError:
                 flash('Email già in uso', 'error')
@@ -409,153 +946,130 @@ def admin_dipendente_edit(id):
 def admin_report():
     return render_template('admin/report.html')
 
+# Report di sola lettura: il calcolo è in report.py (condiviso con asgi.py)
+
+def esegui_report(calcolo):
+    # Esegue le query di un report di report.py con la connessione della richiesta;
+    # se il periodo del report è in cache restituisce direttamente quella
+    db = get_db()
+    risposta = None
+    try:
+        while True:
+            try:
+                passo = calcolo.send(risposta)
+            except report.ParametroNonValido as e:
+                return jsonify({'error': str(e)}), 400
+            if isinstance(passo, report.Periodo):
+                cached = report_da_cache(*passo)
+                if cached is not None:
+                    calcolo.close()
+                    return cached
+                risposta = None
+            else:
+                risposta = db.execute(passo.sql, passo.params).fetchall()
+    except StopIteration as fine:
+        return report_in_cache(fine.value)
+
 @app.route('/api/report/totale')
 @login_required
 @admin_required
+@etag_dati
 def api_report_totale():
-    db = get_db()
-    periodo = request.args.get('periodo', 'mese')
-    selected_year = request.args.get('anno', str(datetime.now().year))
-    selected_month = request.args.get('mese', str(datetime.now().month))
-    
-    if periodo == 'settimana':
-        data_inizio = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-        data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    elif periodo == 'mese':
-        data_inizio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    elif periodo == 'mese_specifico':
-        # Calcola inizio e fine del mese specifico
-        try:
-            m = int(selected_month)
-            y = int(selected_year)
-            data_inizio = f"{y}-{m:02d}-01"
-            # Calcola ultimo giorno del mese
-            if m == 12:
-                data_fine = f"{y}-12-31 23:59:59"
-            else:
-                next_month = datetime(y, m + 1, 1)
-                last_day = next_month - timedelta(days=1)
-                data_fine = f"{last_day.strftime('%Y-%m-%d')} 23:59:59"
-        except:
-            # Fallback al mese corrente
-            data_inizio = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-            data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    else:  # anno
-        data_inizio = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
-        data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    
-    report = db.execute('''
-        SELECT 
-            d.id, d.nome, d.cognome,
-            SUM(CASE WHEN t.fine IS NOT NULL 
-                THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                ELSE 0 END) as ore_totali
-        FROM dipendenti d
-        LEFT JOIN timbrature t ON d.id = t.dipendente_id
-        WHERE t.inizio >= %s AND t.inizio <= %s
-        GROUP BY d.id
-        ORDER BY ore_totali DESC
-    ''', (data_inizio, data_fine)).fetchall()
-    
-    result = []
-    for row in report:
-        result.append({
-            'id': row['id'],
-            'nome': row['nome'],
-            'cognome': row['cognome'],
-            'ore_totali': round(row['ore_totali'], 2)
-        })
-    
-    return jsonify(result)
+    return esegui_report(report.totale(request.args))
 
 @app.route('/api/report/dipendente/<int:id>')
 @login_required
 @admin_required
+@etag_dati
 def api_report_dipendente(id):
-    db = get_db()
-    periodo = request.args.get('periodo', 'mese')
-    
-    # Ottieni l'anno selezionato (default: anno corrente)
+    return esegui_report(report.dipendente(request.args, id))
+
+@app.route('/api/report/timbrature')
+@login_required
+@admin_required
+@etag_dati
+def api_report_timbrature():
+    return esegui_report(report.timbrature(request.args))
+
+@app.route('/api/export/timbrature')
+@login_required
+@admin_required
+def api_export_timbrature():
+    # Esportazione per le paghe: le righe arrivano dal database a blocchi
+    # (cursore lato server) e vengono inviate man mano, senza caricarle tutte in memoria
+    periodo = request.args.get('periodo', 'mese_specifico')
+    dipendente_id = request.args.get('dipendente', 'tutti')
+    formato = request.args.get('formato', 'csv')
     selected_year = request.args.get('anno', str(datetime.now().year))
     selected_month = request.args.get('mese', str(datetime.now().month))
-    current_year = datetime.now().year
     
-    # Determina le date di inizio/fine in base al periodo e all'anno
-    if periodo == 'mese_specifico':
-        try:
-            m = int(selected_month)
-            y = int(selected_year)
-            data_inizio = f"{y}-{m:02d}-01"
-            if m == 12:
-                data_fine = f"{y}-12-31 23:59:59"
-            else:
-                next_month = datetime(y, m + 1, 1)
-                last_day = next_month - timedelta(days=1)
-                data_fine = f"{last_day.strftime('%Y-%m-%d')} 23:59:59"
-        except:
-             data_inizio = f"{selected_year}-01-01"
-             data_fine = f"{selected_year}-12-31 23:59:59"
-    elif int(selected_year) == current_year:
-        # Logica per l'anno corrente
-        if periodo == 'settimana':
-            data_inizio = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-            data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-        elif periodo == 'mese':
-            data_inizio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-            data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-        else:  # anno
-            data_inizio = f"{selected_year}-01-01"
-            data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    else:
-        # Logica per anni passati
-        if periodo == 'settimana':
-            # Ultima settimana dell'anno
-            data_inizio = f"{selected_year}-12-24"
-            data_fine = f"{selected_year}-12-31 23:59:59"
-        elif periodo == 'mese':
-            # Ultimo mese dell'anno
-            data_inizio = f"{selected_year}-12-01"
-            data_fine = f"{selected_year}-12-31 23:59:59"
-        else:  # anno
-            data_inizio = f"{selected_year}-01-01"
-            data_fine = f"{selected_year}-12-31 23:59:59"
-            
-    timbrature = db.execute('''
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({'success': False, 'error': 'Formato non supportato'}), 400
+    
+    # Parametri controllati prima di iniziare la risposta: un errore durante lo
+    # streaming arriverebbe con lo stato 200 già inviato
+    try:
+        if dipendente_id != 'tutti':
+            dipendente_id = int(dipendente_id)
+        data_inizio, data_fine = intervallo_dettaglio(periodo, selected_year, selected_month)
+        if periodo == 'mese_specifico':
+            nome_file = f"timbrature_{selected_year}-{int(selected_month):02d}"
+        else:
+            nome_file = f"timbrature_{periodo}_{selected_year}"
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Parametri non validi'}), 400
+    if dipendente_id != 'tutti':
+        nome_file += f"_{dipendente_id}"
+    
+    query = '''
         SELECT 
             t.id,
-            t.inizio, 
-            t.fine,
-            CASE WHEN t.fine IS NOT NULL 
-                THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                ELSE NULL END as ore
+            t.dipendente_id,
+            d.cognome,
+            d.nome,
+            to_char(t.inizio, 'YYYY-MM-DD') as data,
+            to_char(t.inizio, 'HH24:MI:SS') as inizio,
+            to_char(t.fine, 'YYYY-MM-DD HH24:MI:SS') as fine,
+            ROUND((EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600)::numeric, 2) as ore
         FROM timbrature t
-        WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio <= %s
-        ORDER BY t.inizio DESC
-    ''', (id, data_inizio, data_fine)).fetchall()
-    
-    dipendente = db.execute('SELECT nome, cognome FROM dipendenti WHERE id = %s', (id,)).fetchone()
+        JOIN dipendenti d ON d.id = t.dipendente_id
+        WHERE t.inizio >= %s AND t.inizio < %s
+    '''
+    params = [data_inizio, data_fine + timedelta(days=1)]
+    if dipendente_id != 'tutti':
+        query += " AND t.dipendente_id = %s"
+        params.append(dipendente_id)
+    query += " ORDER BY t.inizio, t.id"
     
-    result = {
-        'nome': dipendente['nome'],
-        'cognome': dipendente['cognome'],
-        'timbrature': [],
-        'anno': selected_year
-    }
+    header = ['id', 'dipendente_id', 'cognome', 'nome', 'data', 'inizio', 'fine', 'ore']
+    # Il primo blocco viene letto subito, così un errore della query diventa una
+    # risposta di errore invece di un file vuoto con stato 200
+    stream = get_db().stream(query, params)
+    primo = next(stream, None)
+    chunks = itertools.chain([primo], stream) if primo is not None else []
     
-    for t in timbrature:
-        inizio = to_datetime(t['inizio'])
-        fine = to_datetime(t['fine'])
-        
-        result['timbrature'].append({
-            'id': t['id'],  # Aggiunto ID per la modifica
-            'data': inizio.strftime('%d/%m/%Y'),
-            'inizio': inizio.strftime('%H:%M:%S'),
-            'fine': fine.strftime('%H:%M:%S') if fine else None,
-            'ore': round(t['ore'], 2) if t['ore'] is not None else None
-        })
+    if formato == 'xlsx':
+        body = genera_xlsx(header, chunks)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        def genera_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            for rows in chunks:
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        body = genera_csv()
+        mimetype = 'text/csv'
     
-    return jsonify(result)
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={nome_file}.{formato}'}
+    )
 
 @app.route('/api/timbratura/<int:id>', methods=['PUT'])
 @login_required
@@ -586,13 +1100,23 @@ def api_update_timbratura(id):
             if dt_fine <= dt_inizio:
                 return jsonify({'success': False, 'error': 'L\'ora di fine deve essere successiva all\'inizio'}), 400
         
-        db.execute(
-            'UPDATE timbrature SET inizio = %s, fine = %s WHERE id = %s',
-            (ts_inizio, ts_fine, id)
-        )
+        # Restituisce anche l'inizio precedente per invalidare i report di entrambi i giorni
+        modificata = db.execute('''
+            UPDATE timbrature t SET inizio = %s, fine = %s
+            FROM timbrature v
+            WHERE t.id = %s AND v.id = t.id
+            RETURNING t.dipendente_id, v.inizio AS vecchio_inizio, t.inizio
+        ''', (ts_inizio, ts_fine, id)).fetchone()
         db.commit()
+        if modificata:
+            invalida_report(modificata['dipendente_id'], modificata['vecchio_inizio'], modificata['inizio'])
         return jsonify({'success': True})
         
+    except psycopg2.errors.UniqueViolation:
+        return jsonify({'success': False, 'error': 'Il dipendente ha già un turno aperto'}), 409
+    except psycopg2.errors.ObjectNotInPrerequisiteState as e:
+        # Trigger su timbrature: vecchio o nuovo inizio in un mese chiuso
+        return jsonify({'success': False, 'error': e.diag.message_primary, 'mese_chiuso': True}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -602,391 +1126,207 @@ def api_update_timbratura(id):
 def api_delete_timbratura(id):
     db = get_db()
     try:
-        db.execute('DELETE FROM timbrature WHERE id = %s', (id,))
+        eliminata = db.execute(
+            'DELETE FROM timbrature WHERE id = %s RETURNING dipendente_id, inizio', (id,)
+        ).fetchone()
         db.commit()
+        if eliminata:
+            invalida_report(eliminata['dipendente_id'], eliminata['inizio'])
         return jsonify({'success': True})
+    except psycopg2.errors.ObjectNotInPrerequisiteState as e:
+        return jsonify({'success': False, 'error': e.diag.message_primary, 'mese_chiuso': True}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/report/mensile')
+def chiudi_mesi(db, mese, utente, chiusi):
+    # Chiude i mesi aperti fino a mese compreso, uno per transazione: il lock di
+    # chiudi_mesi() su timbrature (che sospende le timbrature) dura il calcolo
+    # di un solo mese anche alla prima chiusura, con tutto lo storico aperto.
+    # I mesi chiusi vengono aggiunti a chiusi man mano.
+    primo = fine_chiusura(db) or db.execute(
+        "SELECT date_trunc('month', MIN(inizio))::date AS primo FROM timbrature"
+    ).fetchone()['primo'] or mese
+    corrente = min(primo, mese)
+    while corrente <= mese:
+        if db.execute('SELECT chiudi_mesi(%s, %s) AS chiusi', (corrente, utente)).fetchone()['chiusi']:
+            chiusi.append(corrente)
+        db.commit()
+        corrente = (corrente + timedelta(days=32)).replace(day=1)
+
+@app.route('/api/chiusura-mese', methods=['GET', 'POST'])
 @login_required
 @admin_required
-def api_report_mensile():
+def api_chiusura_mese():
+    # Chiusura mensile: congela le ore fino al mese indicato (vedi chiudi_mesi()
+    # in schema_pg.sql); da quel momento le timbrature di quei mesi non si
+    # modificano più e i report li leggono dagli snapshot
     db = get_db()
-    dipendente_id = request.args.get('dipendente', 'tutti')
-    periodo = request.args.get('periodo', 'anno')
-    
-    # Ottieni l'anno selezionato (default: anno corrente)
-    selected_year = request.args.get('anno', str(datetime.now().year))
-    selected_month = request.args.get('mese', str(datetime.now().month))
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            mese = datetime.strptime(str(data.get('mese', '')), '%Y-%m').date()
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Mese non valido (formato AAAA-MM)'}), 400
+        chiusi = []
+        try:
+            chiudi_mesi(db, mese, session.get('username'), chiusi)
+        except psycopg2.errors.ObjectNotInPrerequisiteState as e:
+            # I mesi precedenti a quello con l'errore restano chiusi
+            return jsonify({'success': False, 'error': e.diag.message_primary, 'chiusi': len(chiusi)}), 409
+        return jsonify({'success': True, 'chiusi': len(chiusi)})
     
-    # Default: Anno (Mensile)
-    if periodo == 'anno':
-        start_date = f"{selected_year}-01-01"
-        end_date = f"{selected_year}-12-31 23:59:59"
-        
-        # Query per raggruppamento mensile
-        group_by = "to_char(t.inizio, 'MM')"
-        labels = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", 
-                  "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
-        
-        # Esegui query
-        if dipendente_id != 'tutti':
-            report = db.execute(f'''
-                SELECT 
-                    {group_by} as label_key,
-                    SUM(CASE WHEN t.fine IS NOT NULL 
-                        THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                        ELSE 0 END) as ore_totali
-                FROM timbrature t
-                WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio <= %s
-                GROUP BY label_key
-                ORDER BY label_key
-            ''', (dipendente_id, start_date, end_date)).fetchall()
-        else:
-            report = db.execute(f'''
-                SELECT 
-                    {group_by} as label_key,
-                    SUM(CASE WHEN t.fine IS NOT NULL 
-                        THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                        ELSE 0 END) as ore_totali
-                FROM timbrature t
-                WHERE t.inizio >= %s AND t.inizio <= %s
-                GROUP BY label_key
-                ORDER BY label_key
-            ''', (start_date, end_date)).fetchall()
-            
-        # Formatta dati
-        data = [0] * 12
-        for row in report:
-            idx = int(row['label_key']) - 1
-            if 0 <= idx < 12:
-                data[idx] = round(row['ore_totali'], 2)
-                
-        return jsonify({
-            'labels': labels,
-            'data': data,
-            'anno': selected_year
-        })
-        
-    else:
-        # Periodo: Mese, Mese Specifico, Settimana (Giornaliero)
-        if periodo == 'settimana':
-            start_date = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d') # Last 7 days including today
-            end_date = datetime.now().strftime('%Y-%m-%d 23:59:59')
-        elif periodo == 'mese':
-            start_date = (datetime.now() - timedelta(days=29)).strftime('%Y-%m-%d') # Last 30 days
-            end_date = datetime.now().strftime('%Y-%m-%d 23:59:59')
-        elif periodo == 'mese_specifico':
-            try:
-                m = int(selected_month)
-                y = int(selected_year)
-                start_date = f"{y}-{m:02d}-01"
-                if m == 12:
-                    end_date = f"{y}-12-31 23:59:59"
-                else:
-                    next_month = datetime(y, m + 1, 1)
-                    last_day = next_month - timedelta(days=1)
-                    end_date = f"{last_day.strftime('%Y-%m-%d')} 23:59:59"
-            except:
-                start_date = f"{selected_year}-01-01"
-                end_date = f"{selected_year}-12-31 23:59:59"
-        
-        # Query per raggruppamento giornaliero
-        # Usa la data completa come chiave per ordinamento e visualizzazione
-        group_by = "to_char(t.inizio, 'YYYY-MM-DD')"
-        
-        params = []
-        query_base = f'''
-            SELECT 
-                {group_by} as data_giorno,
-                SUM(CASE WHEN t.fine IS NOT NULL 
-                    THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                    ELSE 0 END) as ore_totali
-            FROM timbrature t
-            WHERE t.inizio >= %s AND t.inizio <= %s
-        '''
-        params.append(start_date)
-        params.append(end_date)
-        
-        if dipendente_id != 'tutti':
-            query_base += " AND t.dipendente_id = %s"
-            params.append(dipendente_id)
-            
-        query_base += f" GROUP BY data_giorno ORDER BY data_giorno"
-        
-        report = db.execute(query_base, params).fetchall()
-        
-        # Genera labels e data
-        # Per semplicità, restituiamo solo i giorni che hanno dati o tutti i giorni nel range%s
-        # Meglio tutti i giorni nel range per continuità
-        
-        labels = []
-        data = []
-        
-        # Mappa dei risultati
-        results_map = {row['data_giorno']: row['ore_totali'] for row in report}
-        
-        current = datetime.strptime(start_date, '%Y-%m-%d')
-        end = datetime.strptime(end_date.split(' ')[0], '%Y-%m-%d')
-        
-        while current <= end:
-            day_str = current.strftime('%Y-%m-%d')
-            # Format label: dd/mm
-            label = current.strftime('%d/%m')
-            labels.append(label)
-            
-            val = results_map.get(day_str, 0)
-            data.append(round(val, 2))
-            
-            current += timedelta(days=1)
-            
-        return jsonify({
-            'labels': labels,
-            'data': data,
-            'anno': selected_year
-        })
+    mesi = db.execute('SELECT mese, chiuso_il, chiuso_da FROM mesi_chiusi ORDER BY mese').fetchall()
+    return jsonify({
+        'mesi': [{
+            'mese': m['mese'].strftime('%Y-%m'),
+            'chiuso_il': m['chiuso_il'].strftime('%d/%m/%Y %H:%M:%S'),
+            'chiuso_da': m['chiuso_da']
+        } for m in mesi]
+    })
+
+@app.route('/api/report/mensile')
+@login_required
+@admin_required
+@etag_dati
+def api_report_mensile():
+    return esegui_report(report.mensile(request.args))
 
 @app.route('/api/report/distribuzione')
 @login_required
 @admin_required
+@etag_dati
 def api_report_distribuzione():
-    db = get_db()
-    periodo = request.args.get('periodo', 'mese')
-    dipendente_id = request.args.get('dipendente', 'tutti')
-    selected_year = request.args.get('anno', str(datetime.now().year))
-    selected_month = request.args.get('mese', str(datetime.now().month))
-    
-    # Determina la data di inizio e fine
-    data_fine = datetime.now().strftime('%Y-%m-%d 23:59:59')
-    
-    if periodo == 'settimana':
-        data_inizio = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-    elif periodo == 'mese':
-        data_inizio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-    elif periodo == 'mese_specifico':
-        try:
-            m = int(selected_month)
-            y = int(selected_year)
-            data_inizio = f"{y}-{m:02d}-01"
-            if m == 12:
-                data_fine = f"{y}-12-31 23:59:59"
-            else:
-                next_month = datetime(y, m + 1, 1)
-                last_day = next_month - timedelta(days=1)
-                data_fine = f"{last_day.strftime('%Y-%m-%d')} 23:59:59"
-        except:
-             data_inizio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-    else:  # anno
-        data_inizio = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
-    
-    # Costruisci la query SQL
-    params = []
-    if dipendente_id != 'tutti':
-        where_clause = "WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio <= %s AND t.fine IS NOT NULL"
-        params = [dipendente_id, data_inizio, data_fine]
-    else:
-        where_clause = "WHERE t.inizio >= %s AND t.inizio <= %s AND t.fine IS NOT NULL"
-        params = [data_inizio, data_fine]
-    
-    # Query per ottenere la distribuzione oraria per giorno della settimana
-    report = db.execute(f'''
-        SELECT 
-            EXTRACT(DOW FROM t.inizio) as giorno_settimana,
-            AVG(CASE WHEN t.fine IS NOT NULL 
-                THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                ELSE 0 END) as ore_medie
-        FROM timbrature t
-        {where_clause}
-        GROUP BY giorno_settimana
-        ORDER BY giorno_settimana
-    ''', params).fetchall()
-    
-    # Prepara i dati per tutti i giorni della settimana (0=domenica, 1=lunedì, ...)
-    giorni = ["Domenica", "Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato"]
-    ore_per_giorno = [0] * 7  # Inizializza con 0 ore per ogni giorno
-    
-    # Popola i dati dai risultati della query
-    for row in report:
-        idx = int(row['giorno_settimana'])  # Converte da 0-6 a indice
-        if 0 <= idx < 7:  # Controllo di sicurezza
-            ore_per_giorno[idx] = round(row['ore_medie'], 2)
-    
-    result = {
-        'labels': giorni,
-        'data': ore_per_giorno
-    }
-    
-    return jsonify(result)
+    return esegui_report(report.distribuzione(request.args))
 
 @app.route('/api/report/confronto')
 @login_required
 @admin_required
+@etag_dati
 def api_report_confronto():
-    db = get_db()
-    periodo = request.args.get('periodo', 'mese')
-    
-    # Ottieni l'anno selezionato (default: anno corrente)
-    selected_year = request.args.get('anno', str(datetime.now().year))
-    selected_month = request.args.get('mese', str(datetime.now().month))
+    return esegui_report(report.confronto(request.args))
+
+@app.route('/api/db/stats')
+@login_required
+@admin_required
+def api_db_stats():
+    # Occupazione del pool e hit della cache query di questo worker
+    pool = init_db_pool()
+    cache = get_report_cache()
+    return jsonify({
+        'pid': os.getpid(),
+        'pool': pool.stats() if pool is not None else None,
+        'statements': get_statement_stats(),
+        'report_cache': cache.stats() if cache is not None else None,
+        'passwords': get_password_hasher().stats(),
+        'routes': get_route_stats()
+    })
+
+@app.route('/metrics')
+def metriche():
+    # Metriche Prometheus di tutti i worker (vedi metrics.py e gunicorn.conf.py)
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    body, content_type = metrics.esporta()
+    return Response(body, content_type=content_type)
+
+stato_listener = None
+
+@app.route('/api/stato-dipendenti/stream')
+def api_stato_dipendenti_stream():
+    # Server-Sent Events: invia solo lo stato del dipendente che è cambiato.
+    # Non usa il pool: le notifiche arrivano da un unico LISTEN per worker.
+    global stato_listener
+    if stato_listener is None:
+        stato_listener = StatoListener(app.config['DATABASE_LISTEN_URL'])
+    coda = stato_listener.subscribe(app.config['SSE_MAX_CONNESSIONI'])
+    if coda is None:
+        # Troppi schermi collegati a questo worker: il chiosco torna al
+        # ricaricamento completo e riprova più tardi
+        return Response('Too many streams\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '60'})
+    scadenza = time.monotonic() + app.config['SSE_MAX_DURATION']
     
-    # Determina la data di inizio in base al periodo
-    if periodo == 'mese':
-        # Ultimo mese: prendere da 30 giorni fa fino ad oggi se anno corrente,
-        # altrimenti prendere l'ultimo mese dell'anno selezionato
-        current_year = datetime.now().year
-        if int(selected_year) == current_year:
-            data_inizio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-            data_fine = datetime.now().strftime('%Y-%m-%d')
-        else:
-            data_inizio = f"{selected_year}-12-01"
-            data_fine = f"{selected_year}-12-31"
-    elif periodo == 'mese_specifico':
+    def eventi():
         try:
-            m = int(selected_month)
-            y = int(selected_year)
-            data_inizio = f"{y}-{m:02d}-01"
-            if m == 12:
-                data_fine = f"{y}-12-31"
-            else:
-                next_month = datetime(y, m + 1, 1)
-                last_day = next_month - timedelta(days=1)
-                data_fine = last_day.strftime('%Y-%m-%d')
-        except:
-             data_inizio = f"{selected_year}-01-01"
-             data_fine = f"{selected_year}-12-31"
-    else:  # anno
-        data_inizio = f"{selected_year}-01-01"
-        data_fine = f"{selected_year}-12-31"
-    
-    # Ottieni tutti i dipendenti attivi
-    dipendenti = db.execute('''
-        SELECT id, nome, cognome 
-        FROM dipendenti 
-        ORDER BY cognome, nome
-    ''').fetchall()
-    
-    result = {
-        'labels': [],
-        'datasets': [],
-        'anno': selected_year
-    }
-    
-    if periodo == 'mese' or periodo == 'mese_specifico':
-        # Query per ottenere ore per dipendente nel periodo selezionato (una singola barra per dipendente)
-        result['labels'] = ["Ore Lavorate"]
-        
-        # Definiamo alcuni colori per i diversi dipendenti
-        colori = [
-            'rgba(54, 162, 235, 0.7)', 'rgba(255, 99, 132, 0.7)', 'rgba(75, 192, 192, 0.7)', 
-            'rgba(255, 206, 86, 0.7)', 'rgba(153, 102, 255, 0.7)', 'rgba(255, 159, 64, 0.7)',
-            'rgba(199, 199, 199, 0.7)', 'rgba(83, 102, 255, 0.7)', 'rgba(40, 167, 69, 0.7)'
-        ]
-        
-        for idx, dip in enumerate(dipendenti):
-            color_idx = idx % len(colori)
-            
-            ore_totali = db.execute('''
-                SELECT 
-                    SUM(CASE WHEN t.fine IS NOT NULL 
-                        THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                        ELSE 0 END) as ore_totali
-                FROM timbrature t
-                WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio <= %s
-            ''', (dip['id'], data_inizio, data_fine)).fetchone()['ore_totali'] or 0
-            
-            result['datasets'].append({
-                'label': f"{dip['cognome']} {dip['nome']}",
-                'data': [round(ore_totali, 2)],
-                'backgroundColor': colori[color_idx],
-                'borderColor': colori[color_idx].replace('0.7)', '1)'),
-                'borderWidth': 1
-            })
-    else:  # anno - mostra l'andamento mensile per ciascun dipendente
-        # Prepara le etichette dei mesi
-        mesi = ["Gen", "Feb", "Mar", "Apr", "Mag", "Giu", "Lug", "Ago", "Set", "Ott", "Nov", "Dic"]
-        result['labels'] = mesi
-        
-        # Definiamo alcuni colori per i diversi dipendenti
-        colori = [
-            'rgba(54, 162, 235, 1)', 'rgba(255, 99, 132, 1)', 'rgba(75, 192, 192, 1)', 
-            'rgba(255, 206, 86, 1)', 'rgba(153, 102, 255, 1)', 'rgba(255, 159, 64, 1)',
-            'rgba(199, 199, 199, 1)', 'rgba(83, 102, 255, 1)', 'rgba(40, 167, 69, 1)'
-        ]
-        
-        for idx, dip in enumerate(dipendenti):
-            color_idx = idx % len(colori)
-            
-            # Query per ottenere le ore mensili del dipendente
-            report = db.execute('''
-                SELECT 
-                    to_char(t.inizio, 'MM') as mese,
-                    SUM(CASE WHEN t.fine IS NOT NULL 
-                        THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600 
-                        ELSE 0 END) as ore_totali
-                FROM timbrature t
-                WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio <= %s
-                GROUP BY 1
-                ORDER BY 1
-            ''', (dip['id'], data_inizio, data_fine)).fetchall()
-            
-            # Inizializza un array di 12 elementi con 0 ore
-            ore_mensili = [0] * 12
-            
-            # Popola i dati dai risultati della query
-            for row in report:
-                mese_idx = int(row['mese']) - 1  # Converte da 01-12 a 0-11 per l'indice
-                if 0 <= mese_idx < 12:  # Controllo di sicurezza
-                    ore_mensili[mese_idx] = round(row['ore_totali'], 2)
-            
-            # Aggiungi il dataset per questo dipendente
-            result['datasets'].append({
-                'label': f"{dip['cognome']} {dip['nome']}",
-                'data': ore_mensili,
-                'borderColor': colori[color_idx],
-                'backgroundColor': colori[color_idx].replace('1)', '0.1)'),
-                'fill': False,
-                'tension': 0.1
-            })
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < scadenza:
+                try:
+                    payload = coda.get(timeout=15)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                if payload is None:
+                    # Notifiche perse: il client deve ricaricare l'elenco completo
+                    yield 'event: reload\ndata: {}\n\n'
+                else:
+                    yield f'event: stato\ndata: {payload}\n\n'
+        finally:
+            stato_listener.unsubscribe(coda)
     
-    return jsonify(result)
+    return Response(eventi(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def stato_dipendenti(db, args=None):
+    calcolo = report.stato_dipendenti(args)
+    passo = next(calcolo)
+    try:
+        calcolo.send(db.execute(passo.sql, passo.params).fetchall())
+    except StopIteration as fine:
+        return fine.value
 
 @app.route('/api/stato-dipendenti')
+@etag_dati
 def api_stato_dipendenti():
-    db = get_db()
-    dipendenti = db.execute('''
-        SELECT 
-            d.id, d.nome, d.cognome,
-            t.inizio,
-            t.id as timbratura_id
-        FROM dipendenti d
-        LEFT JOIN (
-            SELECT * FROM timbrature 
-            WHERE fine IS NULL 
-            ORDER BY inizio DESC
-        ) t ON d.id = t.dipendente_id
-        ORDER BY d.cognome, d.nome
-    ''').fetchall()
-    
-    result = []
-    for d in dipendenti:
-        stato = {
-            'id': d['id'],
-            'nome': d['nome'],
-            'cognome': d['cognome'],
-            'presente': d['inizio'] is not None,
-            'inizio': None
-        }
-        
-        if d['inizio']:
-            inizio = to_datetime(d['inizio'])
-            stato['inizio'] = inizio.strftime('%d/%m/%Y %H:%M:%S')
-        
-        result.append(stato)
-    
-    return jsonify(result)
+    return jsonify(stato_dipendenti(get_db(), request.args))
+
+def crea_partizioni():
+    # Partizioni mensili di timbrature fino a TIMBRATURE_MESI_FUTURI mesi da oggi
+    # (le timbrature fuori dalle partizioni finirebbero in timbrature_default)
+    if not app.config['DATABASE_URL']:
+        return
+    try:
+        with app.app_context():
+            db = get_db()
+            db.execute(
+                "SELECT crea_partizioni_timbrature(current_date, (current_date + make_interval(months => %s))::date)",
+                (app.config['TIMBRATURE_MESI_FUTURI'],)
+            )
+            # Id dei chioschi oltre il periodo in cui una timbratura può essere ritrasmessa
+            db.execute("DELETE FROM timbrature_client WHERE ricevuta < now() - interval '30 days'")
+            db.commit()
+    except Exception as e:
+        print(f"Error creating timbrature partitions: {e}")
+
+# Anche un worker che resta attivo per mesi deve creare le partizioni dei mesi
+# successivi: la prima richiesta di ogni giorno le verifica in un thread, senza
+# rallentare la richiesta (se non manca nulla costa poche letture del catalogo)
+ultima_manutenzione = date.today()
+manutenzione_lock = threading.Lock()
+
+@app.before_request
+def manutenzione_giornaliera():
+    global ultima_manutenzione
+    if ultima_manutenzione == date.today():
+        return
+    with manutenzione_lock:
+        if ultima_manutenzione == date.today():
+            return
+        ultima_manutenzione = date.today()
+    threading.Thread(target=crea_partizioni, name='crea-partizioni', daemon=True).start()
+
+def avvia():
+    # In ogni worker, dopo il fork: apre le connessioni del pool e crea le
+    # partizioni dei mesi successivi. Non all'import del modulo, così asgi.py
+    # (che lo chiama nel lifespan), i test e gli script che importano app non
+    # aprono connessioni che non usano.
+    init_db_pool()
+    crea_partizioni()
 
 def create_app():
+    avvia()
     return app
 
 if __name__ == '__main__':
@@ -994,4 +1334,5 @@ if __name__ == '__main__':
     with app.app_context():
         # init_db() # Optional: auto-init schema. For now disable to rely on migration/manual init
         pass
+    avvia()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5003)), debug=True)
\ No newline at end of file
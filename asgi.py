@@ -0,0 +1,224 @@
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header
+
+import metrics
+import report
+import risposte
+from app import app as flask_app, avvia, chiave_report, get_report_cache, registra_query
+from db_wrapper import QueryStats, normalize_sql, slow_query_log
+
+# Modalità asincrona opzionale, in alternativa a "app:create_app()":
+#
+#   gunicorn -w 2 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:5003 asgi:app
+#
+# /api/stato-dipendenti e le /api/report/* di sola lettura vengono servite su un
+# event loop con un pool psycopg 3 asincrono di ASYNC_DB_POOL_SIZE connessioni:
+# una connessione è occupata solo per la durata di una query, quindi centinaia
+# di richieste contemporanee si alternano su poche connessioni senza tenere
+# occupato un thread ciascuna. Il calcolo dei report è lo stesso delle rotte
+# Flask (report.py), così come ETag e cache dei report.
+#
+# Tutto il resto (timbrature, login, pagine, export, SSE) e le richieste che
+# l'event loop non serve (sessione assente o scaduta, utente non admin, cambio
+# password obbligatorio) passano all'app Flask, invariata, eseguita in un pool
+# di ASGI_WSGI_THREADS thread.
+
+flask_asgi = WSGIMiddleware(flask_app, workers=flask_app.config['ASGI_WSGI_THREADS'])
+
+pool = AsyncConnectionPool(
+    flask_app.config['DATABASE_URL'],
+    min_size=flask_app.config['ASYNC_DB_POOL_SIZE'],
+    max_size=flask_app.config['ASYNC_DB_POOL_SIZE'],
+    timeout=flask_app.config['DB_POOL_TIMEOUT'],
+    max_lifetime=flask_app.config['DB_POOL_RECYCLE'],
+    kwargs={
+        # Solo letture: niente BEGIN/COMMIT attorno alle query
+        'autocommit': True,
+        'row_factory': dict_row,
+        'prepare_threshold': flask_app.config['DB_PREPARE_THRESHOLD'] if flask_app.config['DB_PREPARED_STATEMENTS'] else None,
+    },
+    open=False,
+)
+
+sessioni = flask_app.session_interface.get_signing_serializer(flask_app)
+
+
+def leggi_sessione(request):
+    # Stessa verifica del cookie di sessione di Flask (firma e scadenza)
+    valore = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not valore or sessioni is None:
+        return {}
+    try:
+        return sessioni.loads(valore, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def avanza(calcolo, risposta):
+    # Un passo del generatore di report.py, in un thread: il calcolo del risultato
+    # può richiedere qualche millisecondo sui periodi lunghi
+    try:
+        return calcolo.send(risposta), None
+    except StopIteration as fine:
+        return None, flask_app.json.response(fine.value).get_data(as_text=True)
+
+
+async def fetch(endpoint, stats, sql, params):
+    async with pool.connection() as conn:
+        inizio = time.perf_counter()
+        cur = await conn.execute(sql, params)
+        righe = await cur.fetchall()
+        durata = time.perf_counter() - inizio
+    stats.record(sql, durata, len(righe))
+    if flask_app.config['SLOW_QUERY_MS'] and durata * 1000 >= flask_app.config['SLOW_QUERY_MS']:
+        # Come NeonDB: mai i valori dei parametri nel log
+        slow_query_log.warning('slow query %.1f ms, %d rows, %d params redacted [%s]: %s',
+                               durata * 1000, len(righe), len(params), endpoint, normalize_sql(sql))
+    return righe
+
+
+async def esegui_report(endpoint, stats, calcolo, path, args):
+    # Come esegui_report di app.py, con le query sul pool asincrono
+    cache = get_report_cache()
+    voce = None
+    risposta = None
+    while True:
+        passo, body = await run_in_threadpool(avanza, calcolo, risposta)
+        if body is not None:
+            break
+        if isinstance(passo, report.Periodo):
+            risposta = None
+            if cache is None:
+                continue
+            chiave = chiave_report(path, args, passo.data_inizio, passo.data_fine)
+            cached = await run_in_threadpool(cache.get, chiave)
+            if cached is not None:
+                calcolo.close()
+                return cached
+            voce = (chiave, await run_in_threadpool(cache.generazione), passo.dipendente_id,
+                    str(passo.data_inizio)[:10], str(passo.data_fine)[:10])
+        else:
+            risposta = await fetch(endpoint, stats, passo.sql, passo.params)
+    if voce is not None:
+        chiave, generazione, dipendente_id, data_inizio, data_fine = voce
+        await run_in_threadpool(cache.put, chiave, body, dipendente_id, data_inizio, data_fine, generazione)
+    return body
+
+
+class SolaLettura:
+    """Endpoint ASGI di un report di report.py (come le rotte Flask con @etag_dati)."""
+
+    def __init__(self, endpoint, calcolo, admin=True):
+        self.endpoint = endpoint
+        self.calcolo = calcolo
+        self.admin = admin
+
+    def servibile(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if not self.admin:
+            return True
+        # login_required e admin_required: negli altri casi risponde Flask
+        # (redirect e messaggio flash)
+        sessione = leggi_sessione(request)
+        return 'user_id' in sessione and not sessione.get('force_change') and sessione.get('role') == 'admin'
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if not self.servibile(request):
+            await flask_asgi(scope, receive, send)
+            return
+
+        inizio = time.perf_counter()
+        metrics.RICHIESTE_IN_CORSO.inc()
+        stats = QueryStats()
+        try:
+            response = await self.rispondi(request, stats)
+        except Exception:
+            metrics.RICHIESTE.labels(self.endpoint, request.method, 500).inc()
+            raise
+        finally:
+            metrics.RICHIESTE_IN_CORSO.dec()
+        durata = time.perf_counter() - inizio
+        registra_query(self.endpoint, stats)
+        metrics.DURATA_RICHIESTE.labels(self.endpoint, request.method).observe(durata)
+        metrics.RICHIESTE.labels(self.endpoint, request.method, response.status_code).inc()
+        if flask_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f'app;dur={durata * 1000:.1f}, '
+                f'db;dur={stats.time * 1000:.1f};desc="{stats.count} queries, {stats.rows} rows"')
+        await response(scope, receive, send)
+
+    async def rispondi(self, request, stats):
+        # Argomenti come request.args di Flask: il primo valore di ogni parametro
+        args = {}
+        for chiave, valore in request.query_params.multi_items():
+            args.setdefault(chiave, valore)
+        path = request.url.path
+
+        versione = (await fetch(self.endpoint, stats, report.VERSIONE_DATI, ()))[0]['versione']
+        # Come request.full_path di Flask
+        full_path = f"{path}?{request.scope['query_string'].decode('utf-8', 'replace')}"
+        etag = risposte.etag_dati(full_path, versione)
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': risposte.CACHE_CONTROL_DATI}
+        if risposte.non_modificata(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=headers)
+
+        calcolo = self.calcolo(args, **request.path_params)
+        try:
+            body = await esegui_report(self.endpoint, stats, calcolo, path, args)
+        except report.ParametroNonValido as e:
+            # Come esegui_report di app.py: 400 senza ETag
+            return Response(flask_app.json.dumps({'error': str(e)}), status_code=400,
+                            media_type=flask_app.json.mimetype)
+        return comprimi(request, body.encode(), headers)
+
+
+def comprimi(request, dati, headers):
+    # Come comprimi_risposta di app.py
+    dati, codifica, vary = risposte.comprimi_risposta(
+        dati, flask_app.json.mimetype, parse_accept_header(request.headers.get('accept-encoding')), flask_app.config)
+    if vary:
+        headers['Vary'] = 'Accept-Encoding'
+    if codifica is not None:
+        headers['Content-Encoding'] = codifica
+        headers['ETag'] = f"W/{headers['ETag']}"
+    return Response(dati, media_type=flask_app.json.mimetype, headers=headers)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Pool sincrono dell'app Flask (per le richieste che passano a Flask) e
+    # partizioni: all'avvio del worker, non all'import
+    await run_in_threadpool(avvia)
+    await pool.open()
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/stato-dipendenti', SolaLettura('api_stato_dipendenti', report.stato_dipendenti, admin=False)),
+        Route('/api/report/totale', SolaLettura('api_report_totale', report.totale)),
+        Route('/api/report/dipendente/{id:int}', SolaLettura('api_report_dipendente', report.dipendente)),
+        Route('/api/report/timbrature', SolaLettura('api_report_timbrature', report.timbrature)),
+        Route('/api/report/mensile', SolaLettura('api_report_mensile', report.mensile)),
+        Route('/api/report/distribuzione', SolaLettura('api_report_distribuzione', report.distribuzione)),
+        Route('/api/report/confronto', SolaLettura('api_report_confronto', report.confronto)),
+        Mount('/', app=flask_asgi),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,75 @@
+from dotenv import load_dotenv
+import psycopg2
+import os
+from report_cache import invalida_cache_locale
+
+load_dotenv()
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'schema_pg.sql')
+
+def ricostruisci_ore_giornaliere(cur):
+    """Ricalcola ore_giornaliere da zero a partire da timbrature.
+
+    Blocca le scritture su timbrature (le letture restano possibili) finché
+    la transazione del chiamante non fa commit.
+    """
+    cur.execute("LOCK TABLE timbrature IN SHARE MODE")
+    cur.execute("DELETE FROM ore_giornaliere")
+    cur.execute("""
+        INSERT INTO ore_giornaliere (dipendente_id, giorno, ore, n_timbrature, n_chiuse)
+        SELECT
+            dipendente_id,
+            inizio::date,
+            SUM(CASE WHEN fine IS NOT NULL
+                THEN EXTRACT(EPOCH FROM (fine - inizio)) / 3600
+                ELSE 0 END),
+            COUNT(*),
+            COUNT(fine)
+        FROM timbrature
+        GROUP BY dipendente_id, inizio::date
+    """)
+    return cur.rowcount
+
+def ricostruisci_presenze_correnti(cur):
+    """Ricalcola presenze_correnti (ultimo turno aperto di ogni dipendente)."""
+    cur.execute("DELETE FROM presenze_correnti")
+    cur.execute("""
+        INSERT INTO presenze_correnti (dipendente_id, timbratura_id, inizio)
+        SELECT DISTINCT ON (dipendente_id) dipendente_id, id, inizio
+        FROM timbrature
+        WHERE fine IS NULL
+        ORDER BY dipendente_id, inizio DESC
+    """)
+    return cur.rowcount
+
+def backfill():
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        print("DATABASE_URL not found")
+        return
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+
+    try:
+        # 1. Crea tabella e trigger se mancano
+        print("Applying schema...")
+        with open(SCHEMA_PATH, 'r') as f:
+            cur.execute(f.read())
+
+        # 2. Ricostruisci l'aggregato nella stessa transazione
+        print("Rebuilding ore_giornaliere...")
+        righe = ricostruisci_ore_giornaliere(cur)
+
+        conn.commit()
+        print(f"ore_giornaliere rebuilt: {righe} rows.")
+        invalida_cache_locale()
+
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    backfill()
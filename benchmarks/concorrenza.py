@@ -0,0 +1,141 @@
+import argparse
+import itertools
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+from login_storm import client, percentile, post
+
+# Confronta i limiti di concorrenza della modalità sincrona (gunicorn con
+# "app:create_app()") e di quella asincrona (asgi.py): a ogni livello N client
+# chiedono senza pausa un report pesante mentre un chiosco continua a timbrare
+# e a leggere lo stato dei dipendenti. Riporta report al secondo, latenza dei
+# report, errori e latenza del chiosco per ogni modalità e livello.
+#
+#   gunicorn -w 2 --threads 4 -b 127.0.0.1:5003 "app:create_app()"
+#   gunicorn -w 2 -k uvicorn_worker.UvicornWorker -b 127.0.0.1:5004 asgi:app
+#   python benchmarks/concorrenza.py --sync-url http://127.0.0.1:5003 \
+#       --async-url http://127.0.0.1:5004 --username admin --password segreta --dipendente 1
+#
+# Ogni richiesta di report ha un parametro diverso, quindi non viene servita
+# dalla cache dei report né con un 304. Il dipendente di prova riceve un numero
+# pari di timbrature e torna allo stato iniziale. Con un database locale la
+# latenza delle query è quasi nulla e conta solo la CPU: per riprodurre il caso
+# di Neon i server vanno collegati a un database remoto.
+
+
+def get(opener, url, timeout):
+    try:
+        with opener.open(url, timeout=timeout) as risposta:
+            risposta.read()
+            return risposta.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def login(opener, url, args):
+    dati = {'username': args.username, 'password': args.password}
+    return post(opener, f"{url}/login", dati) == 302
+
+
+def carico(url, args, concorrenza):
+    admin = client()
+    kiosk = client()
+    if not login(admin, url, args) or not login(kiosk, url, args):
+        raise RuntimeError(f"{url}: login failed")
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    contatore = itertools.count()
+    separatore = '&' if '?' in args.report else '?'
+    report = []
+    errori = [0]
+    chiosco = []
+
+    def lettore():
+        while not stop.is_set():
+            inizio = time.perf_counter()
+            stato = get(admin, f"{url}{args.report}{separatore}n={next(contatore)}", args.timeout)
+            durata = (time.perf_counter() - inizio) * 1000
+            with lock:
+                if stato == 200:
+                    report.append(durata)
+                else:
+                    errori[0] += 1
+
+    def timbratore():
+        # Timbrature a coppie (ingresso e uscita), poi lo stato dei dipendenti
+        while not stop.is_set():
+            for _ in range(2):
+                inizio = time.perf_counter()
+                post(kiosk, f"{url}/timbratura", {'dipendente_id': args.dipendente})
+                chiosco.append((time.perf_counter() - inizio) * 1000)
+            inizio = time.perf_counter()
+            get(kiosk, f"{url}/api/stato-dipendenti", args.timeout)
+            chiosco.append((time.perf_counter() - inizio) * 1000)
+            time.sleep(args.pausa)
+
+    threads = [threading.Thread(target=lettore) for _ in range(concorrenza)]
+    threads.append(threading.Thread(target=timbratore))
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.durata)
+    stop.set()
+    for t in threads:
+        t.join()
+    durata = time.perf_counter() - inizio
+
+    return {
+        'report_s': len(report) / durata,
+        'report_p50': percentile(report, 50),
+        'report_p95': percentile(report, 95),
+        'errori': errori[0],
+        'chiosco_p50': percentile(chiosco, 50),
+        'chiosco_p95': percentile(chiosco, 95),
+        'chiosco_max': max(chiosco, default=float('nan')),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare concurrency limits of sync and async mode')
+    parser.add_argument('--sync-url', help='server started with app:create_app()')
+    parser.add_argument('--async-url', help='server started with asgi:app')
+    parser.add_argument('--username', required=True, help='admin user')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--dipendente', type=int, required=True, help='employee id used for punches')
+    parser.add_argument('--concorrenza', default='4,16,64,256', help='comma-separated concurrent report clients')
+    parser.add_argument('--report', default='/api/report/timbrature?periodo=anno', help='report requested by the clients')
+    parser.add_argument('--durata', type=float, default=10, help='seconds per level')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout (counted as error)')
+    parser.add_argument('--pausa', type=float, default=0.2, help='seconds between kiosk rounds')
+    parser.add_argument('--soglia', type=float, default=500, help='kiosk p95 limit (ms) for the summary')
+    args = parser.parse_args()
+
+    modalita = [(nome, url) for nome, url in (('sync', args.sync_url), ('async', args.async_url)) if url]
+    if not modalita:
+        print("Pass --sync-url and/or --async-url.")
+        return
+    livelli = [int(n) for n in args.concorrenza.split(',')]
+
+    print(f"{'mode':<6} {'clients':>7} {'reports/s':>10} {'p50':>8} {'p95':>8} {'errors':>7} "
+          f"{'kiosk p50':>10} {'kiosk p95':>10} {'kiosk max':>10}")
+    limiti = {}
+    for nome, url in modalita:
+        for n in livelli:
+            r = carico(url.rstrip('/'), args, n)
+            print(f"{nome:<6} {n:>7} {r['report_s']:>10.1f} {r['report_p50']:>8.0f} {r['report_p95']:>8.0f} "
+                  f"{r['errori']:>7} {r['chiosco_p50']:>10.0f} {r['chiosco_p95']:>10.0f} {r['chiosco_max']:>10.0f}")
+            if r['errori'] == 0 and r['chiosco_p95'] <= args.soglia:
+                limiti[nome] = n
+
+    print(f"\nHighest level without errors and kiosk p95 <= {args.soglia:.0f} ms:")
+    for nome, _ in modalita:
+        print(f"  {nome}: {limiti.get(nome, 'none')}")
+
+
+if __name__ == "__main__":
+    main()
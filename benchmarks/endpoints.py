@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import date, datetime
+
+# Benchmark degli endpoint di report e del chiosco. Per ogni scala (dipendenti x
+# anni di storico) rigenera i dati con populate_db.py, poi chiama ogni endpoint e
+# variante di periodo con il client di test di Flask (nessuna rete in mezzo) e
+# riporta latenza p50/p95/p99, query per richiesta e righe lette dal database
+# (da EXPLAIN ANALYZE delle query registrate). Il risultato in JSON si confronta
+# con quello di un altro commit:
+#
+#   BENCHMARK_DATABASE_URL=postgresql://localhost/timbraceck_bench \
+#       python benchmarks/endpoints.py --scale 10x1,100x2,1000x5 --output dopo.json
+#   python benchmarks/endpoints.py --scale 100x2 --confronta prima.json
+#
+# Il database indicato da BENCHMARK_DATABASE_URL viene svuotato: non usare quello
+# di produzione. I dati dipendono dal seed e dalla data di esecuzione.
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERIODI = ('settimana', 'mese', 'mese_specifico', 'anno')
+
+url_db = os.environ.get('BENCHMARK_DATABASE_URL')
+if url_db:
+    # L'app deve usare il database del benchmark e rispondere senza cache dei report
+    os.environ['DATABASE_URL'] = url_db
+    os.environ['REPORT_CACHE_BYTES'] = '0'
+
+sys.path.insert(0, RADICE)
+
+import psycopg2
+from db_wrapper import NeonDB
+
+query_registrate = []
+
+_execute = NeonDB.execute
+_stream = NeonDB.stream
+_execute_values = NeonDB.execute_values
+
+def _registra_execute(self, query, params=()):
+    query_registrate.append((query, params))
+    return _execute(self, query, params)
+
+def _registra_stream(self, query, params=(), chunk_size=2000):
+    query_registrate.append((query, params))
+    return _stream(self, query, params, chunk_size)
+
+def _registra_execute_values(self, query, rows, *args, **kwargs):
+    # Conta la query ma non la ripete con EXPLAIN (i parametri sono le righe)
+    query_registrate.append((query, None))
+    return _execute_values(self, query, rows, *args, **kwargs)
+
+NeonDB.execute = _registra_execute
+NeonDB.stream = _registra_stream
+NeonDB.execute_values = _registra_execute_values
+
+
+def casi(dipendenti):
+    """(nome, metodo, url, dati) per ogni endpoint e variante di periodo."""
+    oggi = date.today()
+    # Per il mese specifico si usa l'ultimo mese completo
+    anno, mese = (oggi.year, oggi.month - 1) if oggi.month > 1 else (oggi.year - 1, 12)
+    for periodo in PERIODI:
+        filtro = f'periodo={periodo}&anno={anno}&mese={mese}'
+        yield f'report_totale[{periodo}]', 'GET', f'/api/report/totale?{filtro}', None
+        yield f'report_mensile[{periodo}]', 'GET', f'/api/report/mensile?{filtro}', None
+        yield f'report_mensile_dipendente[{periodo}]', 'GET', f'/api/report/mensile?{filtro}&dipendente=1', None
+        yield f'report_distribuzione[{periodo}]', 'GET', f'/api/report/distribuzione?{filtro}', None
+        yield f'report_confronto[{periodo}]', 'GET', f'/api/report/confronto?{filtro}', None
+        yield f'report_dipendente[{periodo}]', 'GET', f'/api/report/dipendente/1?{filtro}', None
+        yield f'report_timbrature[{periodo}]', 'GET', f'/api/report/timbrature?{filtro}', None
+    yield 'stato_dipendenti', 'GET', '/api/stato-dipendenti', None
+    yield 'index', 'GET', '/', None
+    # Due tocchi consecutivi per dipendente (ingresso e uscita): lo stato torna quello iniziale
+    yield 'timbratura', 'POST', '/timbratura', lambda i: {'dipendente_id': (i // 2) % dipendenti + 1}
+
+
+def percentile(valori, p):
+    valori = sorted(valori)
+    return valori[min(len(valori) - 1, int(len(valori) * p / 100))]
+
+
+def nodi(piano):
+    yield piano
+    for figlio in piano.get('Plans', []):
+        yield from nodi(figlio)
+
+
+def analizza(conn, query, params):
+    """Righe lette e blocchi toccati da una query, con EXPLAIN ANALYZE (poi rollback)."""
+    cur = conn.cursor()
+    try:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query.replace('?', '%s'), params)
+        piano = cur.fetchone()[0][0]['Plan']
+    finally:
+        conn.rollback()
+    righe = 0
+    for n in nodi(piano):
+        if 'Relation Name' in n:
+            letti = (n.get('Actual Rows', 0) + n.get('Rows Removed by Filter', 0)
+                     + n.get('Rows Removed by Index Recheck', 0))
+            righe += letti * n.get('Actual Loops', 1)
+    return righe, piano.get('Shared Hit Blocks', 0) + piano.get('Shared Read Blocks', 0)
+
+
+def misura(client, conn, caso, ripetizioni, riscaldamento):
+    nome, metodo, url, dati = caso
+    latenze = []
+    for i in range(riscaldamento + ripetizioni):
+        query_registrate.clear()
+        inizio = time.perf_counter()
+        if metodo == 'GET':
+            risposta = client.get(url)
+        else:
+            risposta = client.post(url, data=dati(i))
+        risposta.get_data()
+        durata = (time.perf_counter() - inizio) * 1000
+        if risposta.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {risposta.status_code}")
+        if i >= riscaldamento:
+            latenze.append(durata)
+
+    # Query dell'ultima richiesta ripetute con EXPLAIN ANALYZE
+    righe = blocchi = 0
+    for query, params in query_registrate:
+        if params is None:
+            continue
+        r, b = analizza(conn, query, params)
+        righe += r
+        blocchi += b
+
+    return {
+        'name': nome,
+        'method': metodo,
+        'url': url,
+        'p50_ms': round(percentile(latenze, 50), 3),
+        'p95_ms': round(percentile(latenze, 95), 3),
+        'p99_ms': round(percentile(latenze, 99), 3),
+        'mean_ms': round(sum(latenze) / len(latenze), 3),
+        'queries': len(query_registrate),
+        'rows_scanned': righe,
+        'buffers': blocchi,
+    }
+
+
+def prepara_dati(dipendenti, anni, seed):
+    print(f"Seeding {dipendenti} employees x {anni} years...")
+    subprocess.run(
+        [sys.executable, os.path.join(RADICE, 'populate_db.py'), '--dipendenti', str(dipendenti),
+         '--anni', str(anni), '--seed', str(seed), '--svuota'],
+        check=True, env=os.environ, stdout=subprocess.DEVNULL
+    )
+    # Visibility map aggiornata come su un database a regime (index-only scan)
+    conn = psycopg2.connect(url_db)
+    conn.autocommit = True
+    conn.cursor().execute('VACUUM ANALYZE')
+    conn.close()
+
+
+def commit_corrente():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RADICE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def confronta(risultato, base):
+    print(f"\nComparison with {base.get('commit')} (p50 / p95 ratio, < 1 = faster):")
+    prima = {(s['scale'], e['name']): e for s in base['scales'] for e in s['endpoints']}
+    for scala in risultato['scales']:
+        if not any(s['scale'] == scala['scale'] for s in base['scales']):
+            print(f"  {scala['scale']}: not in {base.get('commit')}")
+            continue
+        for e in scala['endpoints']:
+            b = prima.get((scala['scale'], e['name']))
+            if b is None:
+                continue
+            print(f"  {scala['scale']:>8} {e['name']:<42} "
+                  f"{e['p50_ms'] / b['p50_ms']:6.2f} {e['p95_ms'] / b['p95_ms']:6.2f}  "
+                  f"queries {b['queries']}->{e['queries']}  rows {b['rows_scanned']}->{e['rows_scanned']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark report and kiosk endpoints')
+    parser.add_argument('--scale', default='10x1,100x2,1000x5',
+                        help='comma-separated scales, employees x years (e.g. 100x2)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ripetizioni', type=int, default=30, help='measured requests per case')
+    parser.add_argument('--riscaldamento', type=int, default=4, help='unmeasured requests per case')
+    parser.add_argument('--senza-seed', action='store_true',
+                        help='benchmark the current database contents (one run, no seeding)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--confronta', help='compare with a previous JSON result')
+    args = parser.parse_args()
+
+    if not url_db:
+        print("BENCHMARK_DATABASE_URL not found (the database is cleared: do not use production)")
+        return 1
+    # Ingresso e uscita a coppie
+    args.ripetizioni += args.ripetizioni % 2
+    args.riscaldamento += args.riscaldamento % 2
+
+    scale = [None] if args.senza_seed else [tuple(int(x) for x in s.split('x')) for s in args.scale.split(',')]
+
+    import app as timbraceck
+    timbraceck.avvia()
+    client = timbraceck.app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+        s['role'] = 'admin'
+
+    conn = psycopg2.connect(url_db)
+    cur = conn.cursor()
+    cur.execute('SHOW server_version')
+    risultato = {
+        'commit': commit_corrente(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'postgres': cur.fetchone()[0],
+        'seed': args.seed,
+        'repetitions': args.ripetizioni,
+        'scales': [],
+    }
+    conn.rollback()
+
+    for scala in scale:
+        if scala is not None:
+            prepara_dati(scala[0], scala[1], args.seed)
+        cur.execute('SELECT (SELECT COUNT(*) FROM dipendenti), (SELECT COUNT(*) FROM timbrature)')
+        dipendenti, timbrature = cur.fetchone()
+        conn.rollback()
+        nome_scala = f"{scala[0]}x{scala[1]}" if scala else 'existing'
+        print(f"\nScale {nome_scala}: {dipendenti} employees, {timbrature} punches")
+        print(f"  {'endpoint':<42} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'rows':>10}")
+
+        endpoints = []
+        for caso in casi(dipendenti):
+            e = misura(client, conn, caso, args.ripetizioni, args.riscaldamento)
+            endpoints.append(e)
+            print(f"  {e['name']:<42} {e['p50_ms']:8.2f} {e['p95_ms']:8.2f} {e['p99_ms']:8.2f} "
+                  f"{e['queries']:8d} {e['rows_scanned']:10d}")
+        risultato['scales'].append({
+            'scale': nome_scala, 'employees': dipendenti, 'punches': timbrature, 'endpoints': endpoints
+        })
+
+    conn.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(risultato, f, indent=1)
+        print(f"\nResults written to {args.output}")
+    if args.confronta:
+        with open(args.confronta) as f:
+            confronta(risultato, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import argparse
+import http.cookiejar
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Simula l'accesso delle 8:00: molti login contemporanei (account condivisi dei
+# chioschi) mentre un chiosco già autenticato continua a timbrare. Riporta i
+# login al secondo e la latenza delle timbrature prima e durante la raffica.
+# Va lanciato contro un server avviato come in produzione (gunicorn), ad es.:
+#
+#   python benchmarks/login_storm.py --url http://localhost:5000 \
+#       --username dipendenti --password segreta --dipendente 1
+#
+# Ogni timbratura alterna ingresso/uscita: usare un dipendente di prova e un
+# numero pari di timbrature (--timbrature) per lasciarlo nello stato iniziale.
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def client():
+    cookies = http.cookiejar.CookieJar()
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies), NoRedirect())
+
+
+def post(opener, url, dati):
+    body = urllib.parse.urlencode(dati).encode()
+    try:
+        with opener.open(url, body, timeout=60) as risposta:
+            risposta.read()
+            return risposta.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def login(opener, args):
+    # Login riuscito = redirect verso la dashboard; 200 = form con errore
+    return post(opener, f"{args.url}/login", {'username': args.username, 'password': args.password}) == 302
+
+
+def percentile(valori, p):
+    if not valori:
+        return float('nan')
+    valori = sorted(valori)
+    return valori[min(len(valori) - 1, int(len(valori) * p / 100))]
+
+
+def misura_timbrature(opener, args, n, stop=None):
+    latenze = []
+    for _ in range(n):
+        if stop is not None and stop.is_set():
+            break
+        inizio = time.perf_counter()
+        stato = post(opener, f"{args.url}/timbratura", {'dipendente_id': args.dipendente})
+        latenze.append((time.perf_counter() - inizio) * 1000)
+        if stato != 200:
+            print(f"  punch returned HTTP {stato}")
+        time.sleep(args.pausa)
+    return latenze
+
+
+def riepilogo(nome, latenze):
+    print(f"{nome}: {len(latenze)} punches, "
+          f"p50 {percentile(latenze, 50):.1f} ms, p95 {percentile(latenze, 95):.1f} ms, "
+          f"p99 {percentile(latenze, 99):.1f} ms, max {max(latenze, default=float('nan')):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login storm benchmark')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--dipendente', type=int, required=True, help='employee id used for punches')
+    parser.add_argument('--login', type=int, default=200, help='total logins in the storm')
+    parser.add_argument('--concorrenza', type=int, default=32, help='concurrent login clients')
+    parser.add_argument('--timbrature', type=int, default=20, help='baseline punches (even)')
+    parser.add_argument('--pausa', type=float, default=0.05, help='seconds between punches')
+    args = parser.parse_args()
+
+    kiosk = client()
+    if not login(kiosk, args):
+        print("Login failed: check username and password.")
+        return
+
+    # 1. Latenza delle timbrature a riposo
+    riepilogo("Baseline", misura_timbrature(kiosk, args, args.timbrature))
+
+    # 2. Raffica di login con le timbrature in parallelo
+    rimanenti = [args.login]
+    lock = threading.Lock()
+    riusciti = [0]
+    durate = []
+
+    def worker():
+        while True:
+            with lock:
+                if rimanenti[0] <= 0:
+                    return
+                rimanenti[0] -= 1
+            inizio = time.perf_counter()
+            ok = login(client(), args)
+            with lock:
+                durate.append((time.perf_counter() - inizio) * 1000)
+                riusciti[0] += ok
+
+    stop = threading.Event()
+    latenze = []
+    timbratore = threading.Thread(
+        target=lambda: latenze.extend(misura_timbrature(kiosk, args, 10 ** 9, stop)))
+    threads = [threading.Thread(target=worker) for _ in range(args.concorrenza)]
+
+    inizio = time.perf_counter()
+    timbratore.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    durata = time.perf_counter() - inizio
+    stop.set()
+    timbratore.join()
+
+    print(f"Storm: {args.login} logins ({riusciti[0]} ok) in {durata:.2f} s, "
+          f"{args.login / durata:.1f} logins/s, "
+          f"login p50 {percentile(durate, 50):.0f} ms, p95 {percentile(durate, 95):.0f} ms")
+    riepilogo("During storm", latenze)
+    if len(latenze) % 2:
+        # Riporta il dipendente allo stato iniziale
+        post(kiosk, f"{args.url}/timbratura", {'dipendente_id': args.dipendente})
+
+
+if __name__ == "__main__":
+    main()
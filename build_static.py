@@ -0,0 +1,77 @@
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import risposte
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+# Prepara gli asset statici per la produzione (da rieseguire a ogni deploy,
+# il Dockerfile lo fa in fase di build):
+#
+#   static/css/style.css -> static/dist/css/style.<hash>.css (+ .gz e .br)
+#
+# e scrive static/dist/manifest.json, letto all'avvio da app.py: asset_url()
+# nei template restituisce il nome con hash, servito con Cache-Control
+# immutable per un anno. Il nome cambia solo se cambia il contenuto, quindi
+# dopo il primo caricamento i chioschi non richiedono più i file statici.
+# Le versioni compresse sono generate una volta con la compressione massima.
+
+def hash_contenuto(dati):
+    return hashlib.sha256(dati).hexdigest()[:12]
+
+def scrivi(percorso, dati):
+    os.makedirs(os.path.dirname(percorso), exist_ok=True)
+    with open(percorso, 'wb') as f:
+        f.write(dati)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed static assets into static/dist')
+    parser.add_argument('--min-bytes', type=int, default=256, help='do not precompress smaller files')
+    args = parser.parse_args()
+
+    # Ricostruita da zero: niente file di build precedenti nel manifest
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+
+    manifest = {}
+    totale = compresso = 0
+    for radice, cartelle, files in os.walk(STATIC_DIR):
+        cartelle[:] = sorted(c for c in cartelle if os.path.join(radice, c) != DIST_DIR)
+        for nome in sorted(files):
+            relativo = os.path.relpath(os.path.join(radice, nome), STATIC_DIR).replace(os.sep, '/')
+            with open(os.path.join(radice, nome), 'rb') as f:
+                dati = f.read()
+
+            base, estensione = os.path.splitext(relativo)
+            destinazione = f"{base}.{hash_contenuto(dati)}{estensione}"
+            scrivi(os.path.join(DIST_DIR, destinazione), dati)
+            manifest[relativo] = destinazione
+
+            mimetype = mimetypes.guess_type(relativo)[0]
+            if not risposte.comprimibile(mimetype, len(dati), args.min_bytes):
+                print(f"{relativo} -> {destinazione}")
+                continue
+            codifiche = ['gzip'] + (['br'] if risposte.brotli is not None else [])
+            dimensioni = []
+            for codifica in codifiche:
+                compressi = risposte.comprimi(dati, codifica, livello_gzip=9, qualita_brotli=11)
+                scrivi(os.path.join(DIST_DIR, destinazione + risposte.ESTENSIONI[codifica]), compressi)
+                dimensioni.append(f"{codifica} {len(compressi)}")
+            totale += len(dati)
+            compresso += len(compressi)
+            print(f"{relativo} -> {destinazione} ({len(dati)} bytes, {', '.join(dimensioni)})")
+
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    if risposte.brotli is None:
+        print("brotli not installed: only .gz files were written.")
+    print(f"Built {len(manifest)} asset(s) into {DIST_DIR} ({totale} -> {compresso} bytes compressed).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from dotenv import load_dotenv
+import psycopg2
+import os
+from report_cache import invalida_cache_locale
+
+load_dotenv()
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'schema_pg.sql')
+
+def chiudi_turni_duplicati(cur):
+    """Lascia aperto solo il turno più recente di ogni dipendente.
+
+    I turni aperti più vecchi vengono chiusi con fine = inizio (zero ore),
+    così restano visibili nei report e l'admin può correggerli a mano.
+    """
+    cur.execute("LOCK TABLE timbrature IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("""
+        UPDATE timbrature t SET fine = t.inizio
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY dipendente_id ORDER BY inizio DESC, id DESC
+            ) AS n
+            FROM timbrature
+            WHERE fine IS NULL
+        ) aperte
+        WHERE t.id = aperte.id AND aperte.n > 1
+    """)
+    return cur.rowcount
+
+def migra():
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        print("DATABASE_URL not found")
+        return
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+
+    try:
+        # 1. Chiudi i turni aperti doppi: presenze_correnti ne può tenere uno solo
+        print("Closing duplicate open shifts...")
+        chiusi = chiudi_turni_duplicati(cur)
+
+        # 2. Applica lo schema (riallinea presenze_correnti) nella stessa transazione
+        print("Applying schema...")
+        with open(SCHEMA_PATH, 'r') as f:
+            cur.execute(f.read())
+
+        conn.commit()
+        print(f"Closed {chiusi} duplicate open shifts.")
+        invalida_cache_locale()
+
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migra()
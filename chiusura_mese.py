@@ -0,0 +1,108 @@
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+import argparse
+import psycopg2
+import psycopg2.errors
+import os
+
+load_dotenv()
+
+# Chiusura mensile da riga di comando (per esempio da cron all'inizio del mese),
+# come POST /api/chiusura-mese:
+#
+#   python chiusura_mese.py              chiude fino al mese scorso
+#   python chiusura_mese.py 2026-09      chiude fino a settembre 2026
+#   python chiusura_mese.py --elenco     elenca i mesi chiusi
+#   python chiusura_mese.py --riapri     riapre l'ultimo mese chiuso
+#
+# La riapertura serve solo per correggere una chiusura sbagliata: elimina gli
+# snapshot dell'ultimo mese, le cui timbrature tornano modificabili.
+#
+# Lo schema (tabelle, trigger e funzioni della chiusura) va applicato prima da
+# database/schema_pg.sql: questo script non lo modifica. I mesi vengono chiusi
+# uno per transazione, quindi il lock di chiudi_mesi() su timbrature (durante il
+# quale le timbrature attendono) dura il calcolo di un solo mese, anche alla
+# prima chiusura con tutto lo storico ancora aperto.
+
+def chiudi_fino_a(conn, cur, mese):
+    """Chiude i mesi aperti fino a mese compreso, un mese per transazione."""
+    cur.execute("""
+        SELECT COALESCE(
+            (SELECT (MAX(mese) + interval '1 month')::date FROM mesi_chiusi),
+            (SELECT date_trunc('month', MIN(inizio))::date FROM timbrature)
+        )
+    """)
+    corrente = min(cur.fetchone()[0] or mese, mese)
+    chiusi = 0
+    while corrente <= mese:
+        cur.execute("SELECT chiudi_mesi(%s, %s)", (corrente, 'chiusura_mese.py'))
+        if cur.fetchone()[0]:
+            chiusi += 1
+            print(f"  {corrente:%Y-%m} closed")
+        conn.commit()
+        corrente = (corrente + timedelta(days=32)).replace(day=1)
+    return chiusi
+
+def riapri_ultimo_mese(cur):
+    """Riapre l'ultimo mese chiuso e restituisce il mese (None se nessuno è chiuso)."""
+    cur.execute("LOCK TABLE mesi_chiusi IN EXCLUSIVE MODE")
+    cur.execute("SELECT MAX(mese) FROM mesi_chiusi")
+    mese = cur.fetchone()[0]
+    if mese is None:
+        return None
+    cur.execute("DELETE FROM ore_mensili_chiuse WHERE mese = %s", (mese,))
+    cur.execute(
+        "DELETE FROM ore_giornaliere_chiuse WHERE giorno >= %s AND giorno < %s::date + interval '1 month'",
+        (mese, mese)
+    )
+    cur.execute("DELETE FROM mesi_chiusi WHERE mese = %s", (mese,))
+    return mese
+
+def main():
+    parser = argparse.ArgumentParser(description='Close (freeze) months for payroll reporting')
+    parser.add_argument('mese', nargs='?', help='close all open months up to this one (YYYY-MM, default: last month)')
+    parser.add_argument('--elenco', action='store_true', help='list closed months')
+    parser.add_argument('--riapri', action='store_true', help='reopen the last closed month')
+    args = parser.parse_args()
+
+    if args.mese:
+        try:
+            mese = datetime.strptime(args.mese, '%Y-%m').date()
+        except ValueError:
+            parser.error("mese must be YYYY-MM")
+    else:
+        mese = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        print("DATABASE_URL not found")
+        return
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+
+    try:
+        if args.elenco:
+            cur.execute("SELECT mese, chiuso_il, chiuso_da FROM mesi_chiusi ORDER BY mese")
+            for m, chiuso_il, chiuso_da in cur.fetchall():
+                print(f"{m:%Y-%m}  closed {chiuso_il:%Y-%m-%d %H:%M} by {chiuso_da or '-'}")
+        elif args.riapri:
+            riaperto = riapri_ultimo_mese(cur)
+            print(f"Reopened {riaperto:%Y-%m}." if riaperto else "No closed months.")
+        else:
+            print(f"Closing months up to {mese:%Y-%m}...")
+            print(f"Closed {chiudi_fino_a(conn, cur, mese)} month(s).")
+
+        conn.commit()
+
+    except (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedFunction) as e:
+        print(f"Error: {e}Apply database/schema_pg.sql first.")
+        conn.rollback()
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -16,17 +16,489 @@ CREATE TABLE IF NOT EXISTS admin (
     role TEXT NOT NULL DEFAULT 'viewer' CHECK(role IN ('viewer', 'admin', 'dipendente'))
 );
 
+-- Partizionata per mese su inizio (timbrature_AAAA_MM, più timbrature_default per
+-- le date fuori dalle partizioni create): i report su un periodo leggono solo i
+-- mesi interessati. Le partizioni dei prossimi mesi vengono create all'avvio
+-- dell'applicazione con crea_partizioni_timbrature(); un database con la vecchia
+-- tabella non partizionata si converte con migra_partizioni.py.
 CREATE TABLE IF NOT EXISTS timbrature (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     dipendente_id INTEGER NOT NULL REFERENCES dipendenti(id) ON DELETE CASCADE,
     inizio TIMESTAMP NOT NULL,
     fine TIMESTAMP,
-    note TEXT
+    note TEXT,
+    PRIMARY KEY (id, inizio)
+) PARTITION BY RANGE (inizio);
+
+-- Indici di copertura per i report: i filtri sono intervalli semiaperti su
+-- inizio (per dipendente o per tutti) e le colonne lette stanno nell'indice,
+-- quindi i report sono index-only scan. Sostituiscono i vecchi indici su una
+-- sola colonna.
+DROP INDEX IF EXISTS idx_timbrature_dipendente;
+DROP INDEX IF EXISTS idx_timbrature_inizio;
+CREATE INDEX IF NOT EXISTS idx_timbrature_dipendente_inizio ON timbrature(dipendente_id, inizio) INCLUDE (id, fine);
+CREATE INDEX IF NOT EXISTS idx_timbrature_periodo ON timbrature(inizio) INCLUDE (id, dipendente_id, fine);
+-- Turni aperti. L'unicità (un turno aperto per dipendente) è garantita dalla
+-- chiave di presenze_correnti, perché su una tabella partizionata un indice
+-- univoco deve includere inizio.
+CREATE INDEX IF NOT EXISTS idx_timbrature_aperta ON timbrature(dipendente_id) WHERE fine IS NULL;
+
+-- Crea le partizioni mensili per i mesi da p_da a p_a compresi e restituisce
+-- quante ne ha create. Le righe di quei mesi finite nel frattempo nella partizione
+-- di default vengono spostate nella nuova partizione (passando dai trigger, così
+-- gli aggregati restano allineati). Non fa nulla se timbrature non è partizionata.
+CREATE OR REPLACE FUNCTION crea_partizioni_timbrature(p_da DATE, p_a DATE) RETURNS INTEGER AS $$
+DECLARE
+    v_mese DATE;
+    v_nome TEXT;
+    v_create INTEGER := 0;
+    v_temp BOOLEAN := false;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'timbrature'::regclass) THEN
+        RETURN 0;
+    END IF;
+
+    -- I worker gunicorn partono insieme: uno alla volta
+    PERFORM pg_advisory_xact_lock(hashtext('crea_partizioni_timbrature'));
+
+    IF to_regclass('timbrature_default') IS NULL THEN
+        EXECUTE 'CREATE TABLE timbrature_default PARTITION OF timbrature DEFAULT';
+    END IF;
+
+    v_mese := date_trunc('month', p_da)::date;
+    WHILE v_mese <= p_a LOOP
+        v_nome := 'timbrature_' || to_char(v_mese, 'YYYY_MM');
+        IF to_regclass(v_nome) IS NULL THEN
+            IF NOT v_temp THEN
+                CREATE TEMP TABLE IF NOT EXISTS timbrature_da_spostare (LIKE timbrature) ON COMMIT DROP;
+                v_temp := true;
+            END IF;
+            WITH spostate AS (
+                DELETE FROM timbrature_default
+                WHERE inizio >= v_mese AND inizio < v_mese + interval '1 month'
+                RETURNING *
+            )
+            INSERT INTO timbrature_da_spostare SELECT * FROM spostate;
+
+            EXECUTE 'CREATE TABLE ' || quote_ident(v_nome) || ' PARTITION OF timbrature FOR VALUES FROM ('
+                || quote_literal(v_mese) || ') TO ('
+                || quote_literal((v_mese + interval '1 month')::date) || ')';
+
+            INSERT INTO timbrature SELECT * FROM timbrature_da_spostare;
+            TRUNCATE timbrature_da_spostare;
+            v_create := v_create + 1;
+        END IF;
+        v_mese := (v_mese + interval '1 month')::date;
+    END LOOP;
+
+    RETURN v_create;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT crea_partizioni_timbrature(current_date, (current_date + interval '3 months')::date);
+
+-- Ore lavorate per dipendente e giorno (giorno = data di inizio della timbratura).
+-- Mantenuta dal trigger su timbrature nella stessa transazione della scrittura;
+-- si ricostruisce con backfill_ore_giornaliere.py.
+-- n_timbrature conta tutte le timbrature del giorno, n_chiuse solo quelle con uscita.
+CREATE TABLE IF NOT EXISTS ore_giornaliere (
+    dipendente_id INTEGER NOT NULL REFERENCES dipendenti(id) ON DELETE CASCADE,
+    giorno DATE NOT NULL,
+    ore NUMERIC NOT NULL DEFAULT 0,
+    n_timbrature INTEGER NOT NULL DEFAULT 0,
+    n_chiuse INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dipendente_id, giorno)
+);
+
+-- Le ore sono NUMERIC come le somme calcolate sulle timbrature: i totali sono
+-- esatti anche dopo molti aggiornamenti incrementali e le API le restituiscono
+-- come prima (Decimal, serializzato come stringa). Le tabelle create come
+-- DOUBLE PRECISION vengono convertite e ricalcolate da timbrature.
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'ore_giornaliere'
+          AND column_name = 'ore') = 'double precision' THEN
+        ALTER TABLE ore_giornaliere ALTER COLUMN ore TYPE NUMERIC;
+        UPDATE ore_giornaliere o SET ore = s.ore
+        FROM (
+            SELECT dipendente_id, inizio::date AS giorno,
+                   COALESCE(SUM(EXTRACT(EPOCH FROM (fine - inizio)) / 3600), 0) AS ore
+            FROM timbrature
+            GROUP BY dipendente_id, inizio::date
+        ) s
+        WHERE o.dipendente_id = s.dipendente_id AND o.giorno = s.giorno;
+    END IF;
+END $$;
+
+-- La chiave primaria serve i report di un dipendente; per quelli su tutti i
+-- dipendenti l'indice sul giorno include le colonne sommate (index-only scan)
+DROP INDEX IF EXISTS idx_ore_giornaliere_giorno;
+CREATE INDEX IF NOT EXISTS idx_ore_giornaliere_periodo ON ore_giornaliere(giorno) INCLUDE (dipendente_id, ore, n_chiuse);
+
+CREATE OR REPLACE FUNCTION aggiorna_ore_giornaliere() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.dipendente_id = NEW.dipendente_id AND OLD.inizio = NEW.inizio
+       AND OLD.fine IS NOT DISTINCT FROM NEW.fine THEN
+        RETURN NULL;
+    END IF;
+
+    -- Aggiornamenti incrementali: sicuri anche con timbrature concorrenti sullo stesso giorno
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE ore_giornaliere SET
+            ore = ore - COALESCE(EXTRACT(EPOCH FROM (OLD.fine - OLD.inizio)) / 3600, 0),
+            n_timbrature = n_timbrature - 1,
+            n_chiuse = n_chiuse - (OLD.fine IS NOT NULL)::int
+        WHERE dipendente_id = OLD.dipendente_id AND giorno = OLD.inizio::date;
+
+        DELETE FROM ore_giornaliere
+        WHERE dipendente_id = OLD.dipendente_id AND giorno = OLD.inizio::date AND n_timbrature <= 0;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO ore_giornaliere AS o (dipendente_id, giorno, ore, n_timbrature, n_chiuse)
+        VALUES (NEW.dipendente_id, NEW.inizio::date,
+                COALESCE(EXTRACT(EPOCH FROM (NEW.fine - NEW.inizio)) / 3600, 0),
+                1, (NEW.fine IS NOT NULL)::int)
+        ON CONFLICT (dipendente_id, giorno) DO UPDATE SET
+            ore = o.ore + EXCLUDED.ore,
+            n_timbrature = o.n_timbrature + 1,
+            n_chiuse = o.n_chiuse + EXCLUDED.n_chiuse;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_timbrature_ore_giornaliere ON timbrature;
+CREATE TRIGGER trg_timbrature_ore_giornaliere
+    AFTER INSERT OR UPDATE OR DELETE ON timbrature
+    FOR EACH ROW EXECUTE FUNCTION aggiorna_ore_giornaliere();
+
+-- Id generati dai chioschi per ogni timbratura (registrati sia da /timbratura sia
+-- dall'invio in blocco della coda offline): una timbratura ritrasmessa dopo un
+-- errore di rete non viene registrata due volte.
+CREATE TABLE IF NOT EXISTS timbrature_client (
+    client_id TEXT PRIMARY KEY,
+    dipendente_id INTEGER NOT NULL,
+    ricevuta TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_timbrature_client_ricevuta ON timbrature_client(ricevuta);
+
+-- Presenze correnti: il turno aperto di ogni dipendente (al massimo uno), così
+-- lo stato dei chioschi costa quanto il numero di dipendenti e non cresce con
+-- lo storico delle timbrature. Mantenuta dal trigger su timbrature.
+CREATE TABLE IF NOT EXISTS presenze_correnti (
+    dipendente_id INTEGER PRIMARY KEY REFERENCES dipendenti(id) ON DELETE CASCADE,
+    timbratura_id INTEGER NOT NULL,
+    inizio TIMESTAMP NOT NULL
+);
+
+DROP FUNCTION IF EXISTS ricalcola_presenza(INTEGER);
+
+CREATE OR REPLACE FUNCTION aggiorna_presenze_correnti() RETURNS trigger AS $$
+BEGIN
+    -- Turno che smette di essere aperto (uscita, cancellazione, modifica;
+    -- anche lo spostamento in un'altra partizione arriva come DELETE + INSERT)
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.fine IS NULL THEN
+        DELETE FROM presenze_correnti
+        WHERE dipendente_id = OLD.dipendente_id AND timbratura_id = OLD.id;
+    END IF;
+    -- Nuovo turno aperto: la chiave primaria rifiuta un secondo turno aperto
+    -- per lo stesso dipendente, anche da transazioni concorrenti
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.fine IS NULL THEN
+        INSERT INTO presenze_correnti (dipendente_id, timbratura_id, inizio)
+        VALUES (NEW.dipendente_id, NEW.id, NEW.inizio);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- I trigger AFTER partono in ordine alfabetico: questo deve precedere
+-- trg_timbrature_notifica_stato, che legge presenze_correnti.
+DROP TRIGGER IF EXISTS trg_timbrature_aggiorna_presenze ON timbrature;
+CREATE TRIGGER trg_timbrature_aggiorna_presenze
+    AFTER INSERT OR UPDATE OR DELETE ON timbrature
+    FOR EACH ROW EXECUTE FUNCTION aggiorna_presenze_correnti();
+
+-- Allinea la tabella ai turni aperti esistenti (idempotente)
+DELETE FROM presenze_correnti p
+WHERE NOT EXISTS (
+    SELECT 1 FROM timbrature t
+    WHERE t.id = p.timbratura_id AND t.dipendente_id = p.dipendente_id AND t.fine IS NULL
 );
 
--- Indexes for performance (optional but good practice)
-CREATE INDEX IF NOT EXISTS idx_timbrature_dipendente ON timbrature(dipendente_id);
-CREATE INDEX IF NOT EXISTS idx_timbrature_inizio ON timbrature(inizio);
+INSERT INTO presenze_correnti (dipendente_id, timbratura_id, inizio)
+SELECT DISTINCT ON (dipendente_id) dipendente_id, id, inizio
+FROM timbrature
+WHERE fine IS NULL
+ORDER BY dipendente_id, inizio DESC
+ON CONFLICT (dipendente_id) DO UPDATE SET
+    timbratura_id = EXCLUDED.timbratura_id,
+    inizio = EXCLUDED.inizio;
+
+-- Notifiche di presenza (LISTEN stato_dipendenti) per il flusso SSE dei chioschi:
+-- ad ogni cambio viene inviato solo lo stato del dipendente interessato.
+CREATE OR REPLACE FUNCTION stato_dipendente_json(p_id INTEGER) RETURNS TEXT AS $$
+    SELECT json_build_object(
+        'id', d.id,
+        'nome', d.nome,
+        'cognome', d.cognome,
+        'presente', p.inizio IS NOT NULL,
+        'inizio', to_char(p.inizio, 'DD/MM/YYYY HH24:MI:SS')
+    )::text
+    FROM dipendenti d
+    LEFT JOIN presenze_correnti p ON p.dipendente_id = d.id
+    WHERE d.id = p_id
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION notifica_stato_timbratura() RETURNS trigger AS $$
+DECLARE
+    payload TEXT;
+BEGIN
+    -- Le modifiche a timbrature già chiuse non cambiano la presenza
+    IF TG_OP = 'UPDATE' AND OLD.fine IS NOT NULL AND NEW.fine IS NOT NULL
+       AND OLD.dipendente_id = NEW.dipendente_id THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        payload := stato_dipendente_json(NEW.dipendente_id);
+        IF payload IS NOT NULL THEN
+            PERFORM pg_notify('stato_dipendenti', payload);
+        END IF;
+    END IF;
+    -- Il dipendente può non esistere più (cancellazione a cascata)
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.dipendente_id <> NEW.dipendente_id) THEN
+        payload := stato_dipendente_json(OLD.dipendente_id);
+        IF payload IS NOT NULL THEN
+            PERFORM pg_notify('stato_dipendenti', payload);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notifica_stato_dipendente() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('stato_dipendenti', json_build_object('id', OLD.id, 'eliminato', true)::text);
+    ELSE
+        PERFORM pg_notify('stato_dipendenti', stato_dipendente_json(NEW.id));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_timbrature_notifica_stato ON timbrature;
+CREATE TRIGGER trg_timbrature_notifica_stato
+    AFTER INSERT OR UPDATE OR DELETE ON timbrature
+    FOR EACH ROW EXECUTE FUNCTION notifica_stato_timbratura();
+
+DROP TRIGGER IF EXISTS trg_dipendenti_notifica_stato ON dipendenti;
+CREATE TRIGGER trg_dipendenti_notifica_stato
+    AFTER INSERT OR UPDATE OR DELETE ON dipendenti
+    FOR EACH ROW EXECUTE FUNCTION notifica_stato_dipendente();
+
+-- Versione dei dati: un contatore per tabella, incrementato da ogni scrittura su
+-- timbrature o dipendenti; la somma (sempre crescente) è usata per gli ETag
+-- delle API di report e presenze.
+--
+-- Costo: l'UPDATE prende il lock della riga della tabella fino al commit,
+-- quindi le transazioni che scrivono sulla stessa tabella si serializzano
+-- sull'ultimo tratto. Con una riga per tabella le modifiche ai dipendenti non
+-- attendono le timbrature (e viceversa); tra le timbrature l'attesa dura al
+-- massimo una transazione della rotta, che è un'unica istruzione seguita dal
+-- commit. Transazioni lunghe su timbrature (script, SQL manuale) bloccano le
+-- timbrature dei chioschi fino al commit, come già fanno ore_giornaliere e
+-- presenze_correnti per il dipendente coinvolto.
+CREATE TABLE IF NOT EXISTS versione_dati (
+    tabella TEXT PRIMARY KEY,
+    versione BIGINT NOT NULL DEFAULT 0
+);
+
+-- Tabella creata con un'unica riga (id = 1): il valore passa a timbrature, così
+-- la somma non torna a un valore già usato in un ETag
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = 'versione_dati'
+                 AND column_name = 'id') THEN
+        ALTER TABLE versione_dati DROP COLUMN id;
+        ALTER TABLE versione_dati ADD COLUMN tabella TEXT;
+        UPDATE versione_dati SET tabella = 'timbrature';
+        ALTER TABLE versione_dati ADD PRIMARY KEY (tabella);
+    END IF;
+END $$;
+
+INSERT INTO versione_dati (tabella, versione) VALUES ('timbrature', 0), ('dipendenti', 0)
+ON CONFLICT (tabella) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION incrementa_versione_dati() RETURNS trigger AS $$
+BEGIN
+    UPDATE versione_dati SET versione = versione + 1 WHERE tabella = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_timbrature_versione ON timbrature;
+CREATE TRIGGER trg_timbrature_versione
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON timbrature
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_dati();
+
+DROP TRIGGER IF EXISTS trg_dipendenti_versione ON dipendenti;
+CREATE TRIGGER trg_dipendenti_versione
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON dipendenti
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_dati();
+
+-- Chiusura mensile: i mesi vengono chiusi in ordine (chiudere un mese chiude anche
+-- i precedenti ancora aperti), quindi i mesi chiusi sono tutti quelli prima di
+-- fine_chiusura(). Alla chiusura le ore di ogni dipendente vengono congelate per
+-- giorno e per mese; da quel momento le timbrature di quei mesi non si possono
+-- più inserire, modificare o eliminare e i report leggono gli snapshot.
+CREATE TABLE IF NOT EXISTS mesi_chiusi (
+    mese DATE PRIMARY KEY CHECK (mese = date_trunc('month', mese)::date),
+    chiuso_il TIMESTAMP NOT NULL DEFAULT now(),
+    chiuso_da TEXT
+);
+
+-- Snapshot con le stesse colonne di ore_giornaliere; senza ON DELETE CASCADE, così
+-- un dipendente con mesi chiusi non si può eliminare.
+CREATE TABLE IF NOT EXISTS ore_giornaliere_chiuse (
+    dipendente_id INTEGER NOT NULL REFERENCES dipendenti(id),
+    giorno DATE NOT NULL,
+    ore NUMERIC NOT NULL,
+    n_timbrature INTEGER NOT NULL,
+    n_chiuse INTEGER NOT NULL,
+    PRIMARY KEY (dipendente_id, giorno)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ore_giornaliere_chiuse_periodo ON ore_giornaliere_chiuse(giorno) INCLUDE (dipendente_id, ore, n_chiuse);
+
+-- Totali mensili (mese = primo giorno del mese): i report su mesi interi leggono
+-- una riga per dipendente e mese invece di una per giorno.
+CREATE TABLE IF NOT EXISTS ore_mensili_chiuse (
+    dipendente_id INTEGER NOT NULL REFERENCES dipendenti(id),
+    mese DATE NOT NULL,
+    ore NUMERIC NOT NULL,
+    n_timbrature INTEGER NOT NULL,
+    n_chiuse INTEGER NOT NULL,
+    PRIMARY KEY (dipendente_id, mese)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ore_mensili_chiuse_periodo ON ore_mensili_chiuse(mese) INCLUDE (dipendente_id, ore, n_chiuse);
+
+-- Primo giorno dopo l'ultimo mese chiuso ('-infinity' se nessun mese è chiuso)
+CREATE OR REPLACE FUNCTION fine_chiusura() RETURNS DATE AS $$
+    SELECT COALESCE((MAX(mese) + interval '1 month')::date, '-infinity'::date) FROM mesi_chiusi
+$$ LANGUAGE sql STABLE;
+
+-- Snapshot create come DOUBLE PRECISION: stessa conversione di ore_giornaliere
+-- (le timbrature dei mesi chiusi non sono cambiate dalla chiusura)
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'ore_giornaliere_chiuse'
+          AND column_name = 'ore') = 'double precision' THEN
+        ALTER TABLE ore_giornaliere_chiuse ALTER COLUMN ore TYPE NUMERIC;
+        ALTER TABLE ore_mensili_chiuse ALTER COLUMN ore TYPE NUMERIC;
+        UPDATE ore_giornaliere_chiuse o SET ore = s.ore
+        FROM (
+            SELECT dipendente_id, inizio::date AS giorno,
+                   COALESCE(SUM(EXTRACT(EPOCH FROM (fine - inizio)) / 3600), 0) AS ore
+            FROM timbrature
+            WHERE inizio < fine_chiusura()
+            GROUP BY dipendente_id, inizio::date
+        ) s
+        WHERE o.dipendente_id = s.dipendente_id AND o.giorno = s.giorno;
+        UPDATE ore_mensili_chiuse m SET ore = s.ore
+        FROM (
+            SELECT dipendente_id, date_trunc('month', giorno)::date AS mese, SUM(ore) AS ore
+            FROM ore_giornaliere_chiuse
+            GROUP BY dipendente_id, date_trunc('month', giorno)::date
+        ) s
+        WHERE m.dipendente_id = s.dipendente_id AND m.mese = s.mese;
+    END IF;
+END $$;
+
+CREATE OR REPLACE FUNCTION verifica_mese_aperto() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.inizio < fine_chiusura() THEN
+        RAISE EXCEPTION USING MESSAGE = 'Il mese ' || to_char(OLD.inizio, 'MM/YYYY') || ' è chiuso',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.inizio < fine_chiusura() THEN
+        RAISE EXCEPTION USING MESSAGE = 'Il mese ' || to_char(NEW.inizio, 'MM/YYYY') || ' è chiuso',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_timbrature_mese_aperto ON timbrature;
+CREATE TRIGGER trg_timbrature_mese_aperto
+    BEFORE INSERT OR UPDATE OR DELETE ON timbrature
+    FOR EACH ROW EXECUTE FUNCTION verifica_mese_aperto();
+
+-- Chiude i mesi ancora aperti fino a p_mese compreso e restituisce quanti ne ha
+-- chiusi. Solo mesi passati e senza turni aperti; le ore vengono ricalcolate
+-- dalle timbrature, bloccate in scrittura fino alla fine della transazione.
+CREATE OR REPLACE FUNCTION chiudi_mesi(p_mese DATE, p_utente TEXT) RETURNS INTEGER AS $$
+DECLARE
+    v_a DATE := date_trunc('month', p_mese)::date;
+    v_da DATE;
+    v_fine DATE;
+    v_aperti INTEGER;
+BEGIN
+    IF v_a >= date_trunc('month', current_date)::date THEN
+        RAISE EXCEPTION 'Si possono chiudere solo i mesi passati'
+            USING ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    LOCK TABLE mesi_chiusi IN EXCLUSIVE MODE;
+    LOCK TABLE timbrature IN SHARE MODE;
+
+    v_da := fine_chiusura();
+    IF v_da = '-infinity'::date THEN
+        SELECT LEAST(date_trunc('month', MIN(inizio))::date, v_a) INTO v_da FROM timbrature;
+        v_da := COALESCE(v_da, v_a);
+    END IF;
+    IF v_da > v_a THEN
+        RETURN 0;
+    END IF;
+    v_fine := (v_a + interval '1 month')::date;
+
+    SELECT COUNT(*) INTO v_aperti FROM timbrature
+    WHERE inizio >= v_da AND inizio < v_fine AND fine IS NULL;
+    IF v_aperti > 0 THEN
+        RAISE EXCEPTION USING MESSAGE = 'Turni ancora aperti nei mesi da chiudere: ' || v_aperti,
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    INSERT INTO ore_giornaliere_chiuse (dipendente_id, giorno, ore, n_timbrature, n_chiuse)
+    SELECT dipendente_id, inizio::date,
+           COALESCE(SUM(EXTRACT(EPOCH FROM (fine - inizio)) / 3600), 0),
+           COUNT(*), COUNT(fine)
+    FROM timbrature
+    WHERE inizio >= v_da AND inizio < v_fine
+    GROUP BY dipendente_id, inizio::date;
+
+    INSERT INTO ore_mensili_chiuse (dipendente_id, mese, ore, n_timbrature, n_chiuse)
+    SELECT dipendente_id, date_trunc('month', giorno)::date, SUM(ore), SUM(n_timbrature), SUM(n_chiuse)
+    FROM ore_giornaliere_chiuse
+    WHERE giorno >= v_da AND giorno < v_fine
+    GROUP BY dipendente_id, date_trunc('month', giorno)::date;
+
+    INSERT INTO mesi_chiusi (mese, chiuso_da)
+    SELECT generate_series(v_da, v_a, interval '1 month')::date, p_utente;
+
+    RETURN (SELECT COUNT(*) FROM mesi_chiusi WHERE mese >= v_da)::integer;
+END;
+$$ LANGUAGE plpgsql;
 
 -- Initial Users (using ON CONFLICT to avoid errors on re-run)
 INSERT INTO admin (username, password, role) 
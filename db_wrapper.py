@@ -1,26 +1,505 @@
-from psycopg2.extras import RealDictCursor
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2 import extensions
 import psycopg2
+import psycopg2.errors
+from metrics import (ATTESA_POOL, CACHE_QUERY, CONNESSIONI_DB, CONNESSIONI_POOL,
+                     TIMEOUT_POOL)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Contatori (per worker) della cache delle query
+statement_stats = {
+    'translate_hits': 0,
+    'translate_misses': 0,
+    'prepared_hits': 0,
+    'prepared_new': 0,
+    'prepared_failed': 0,
+    'evictions': 0,
+}
+_stats_lock = threading.Lock()
+
+def _count(key):
+    with _stats_lock:
+        statement_stats[key] += 1
+    CACHE_QUERY.labels(key).inc()
+
+def get_statement_stats():
+    with _stats_lock:
+        stats = dict(statement_stats)
+    lookups = stats['translate_hits'] + stats['translate_misses']
+    stats['hit_ratio'] = round(stats['translate_hits'] / lookups, 4) if lookups else None
+    return stats
+
+
+slow_query_log = logging.getLogger('timbraceck.sql')
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_sql(query, max_length=500):
+    """SQL text for logs: literals and placeholders become '?', whitespace collapsed."""
+    sql = _STRING_LITERAL.sub('?', query)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _WHITESPACE.sub(' ', sql.replace('%s', '?')).strip()
+    return sql if len(sql) <= max_length else sql[:max_length] + '...'
+
+
+class QueryStats:
+    """Queries run through one NeonDB (one request): count, time, rows, slowest."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+        self.slowest_time = 0.0
+        self.slowest_query = None
+
+    def record(self, query, elapsed, rows):
+        self.count += 1
+        self.time += elapsed
+        self.rows += max(rows, 0)
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_query = query
+
+
+_PREPARABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+
+class StatementCache:
+    """LRU cache of translated SQL for a single connection.
+
+    Statements seen at least `prepare_threshold` times are turned into
+    server-side prepared statements (PREPARE/EXECUTE), so Postgres parses
+    and plans them once per connection. When an entry is evicted its
+    prepared statement is deallocated together with the next query.
+    """
+
+    def __init__(self, size=100, prepare_threshold=2):
+        self.size = size
+        self.prepare_threshold = prepare_threshold
+        self.entries = OrderedDict()
+        self.deallocate = []
+        self._next_id = 0
+
+    def lookup(self, query):
+        entry = self.entries.get(query)
+        if entry is not None:
+            self.entries.move_to_end(query)
+            _count('translate_hits')
+            return entry
+
+        _count('translate_misses')
+        sql = query.replace('?', '%s')
+        entry = {'sql': sql, 'uses': 0, 'name': None, 'execute': None, 'prepare': None,
+                 'preparable': self.prepare_threshold > 0 and ';' not in sql.strip().rstrip(';')
+                                and '%(' not in sql and bool(_PREPARABLE.match(sql))}
+        self.entries[query] = entry
+        if len(self.entries) > self.size:
+            _, old = self.entries.popitem(last=False)
+            _count('evictions')
+            if old['name']:
+                self.deallocate.append(old['name'])
+        return entry
+
+    def prepare(self, entry):
+        # Converte i segnaposto %s in $1..$n; i '%%' restano tali perché il
+        # testo passa comunque dalla formattazione di psycopg2.
+        counter = [0]
+
+        def repl(m):
+            if m.group(0) == '%%':
+                return '%%'
+            counter[0] += 1
+            return f'${counter[0]}'
+
+        body = _PLACEHOLDER.sub(repl, entry['sql'].strip().rstrip(';'))
+        self._next_id += 1
+        name = f'neondb_{self._next_id}'
+        args = ', '.join(['%s'] * counter[0])
+        entry['name'] = name
+        entry['execute'] = f'EXECUTE {name} ({args})' if counter[0] else f'EXECUTE {name}'
+        entry['prepare'] = f'PREPARE {name} AS {body}'
+
+    def pop_deallocate(self):
+        stmts = ''.join(f'DEALLOCATE {name}; ' for name in self.deallocate)
+        self.deallocate = []
+        return stmts
+
+
+class CachedConnection(extensions.connection):
+    """psycopg2 connection carrying its own StatementCache."""
+
+    statement_cache = None
+
+
+class ConnectionPool:
+    """Per-worker pool of Postgres connections.
+
+    Keeps up to `size` idle connections open between requests and allows
+    `max_overflow` extra connections under load. Connections are validated
+    before reuse if they sat idle longer than `pre_ping` seconds, recycled
+    after `recycle` seconds and rolled back when returned.
+    """
+
+    def __init__(self, dsn, size=4, max_overflow=2, timeout=30, recycle=1800, pre_ping=30,
+                 statement_cache_size=100, prepare_threshold=2):
+        self.dsn = dsn
+        self.statement_cache_size = statement_cache_size
+        self.prepare_threshold = prepare_threshold
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._idle = []       # lista di (conn, creata_il, restituita_il)
+        self._created = {}    # id(conn) -> timestamp di apertura
+        self._in_use = 0
+
+        # Statistiche
+        self._opened = 0
+        self._reused = 0
+        self._recycled = 0
+        self._broken = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    def _check_pid(self):
+        # Dopo un fork (es. gunicorn --preload) le connessioni del processo
+        # padre non vanno riusate: le abbandoniamo senza chiuderle.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._created = {}
+            self._in_use = 0
+
+    def _open(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=CachedConnection)
+        if self.statement_cache_size:
+            conn.statement_cache = StatementCache(self.statement_cache_size, self.prepare_threshold)
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._opened += 1
+        CONNESSIONI_DB.labels('opened').inc()
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def warm(self):
+        """Apre le connessioni del pool in anticipo (avvio del worker)."""
+        self._check_pid()
+        conns = []
+        try:
+            for _ in range(self.size):
+                conns.append(self._open())
+        finally:
+            now = time.monotonic()
+            with self._cond:
+                for conn in conns:
+                    self._idle.append((conn, self._created[id(conn)], now))
+                self._update_gauges()
+                self._cond.notify_all()
+
+    def getconn(self):
+        self._check_pid()
+        start = time.monotonic()
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, created, returned = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use + len(self._idle) < self.size + self.max_overflow:
+                    conn = None
+                    self._in_use += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    TIMEOUT_POOL.inc()
+                    raise PoolTimeout(
+                        f"Nessuna connessione disponibile dopo {self.timeout}s "
+                        f"(size={self.size}, overflow={self.max_overflow})"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+            if waited:
+                elapsed = time.monotonic() - start
+                self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait = max(self._max_wait, elapsed)
+                ATTESA_POOL.observe(elapsed)
+            self._update_gauges()
+
+        try:
+            if conn is not None:
+                now = time.monotonic()
+                if self.recycle and now - created > self.recycle:
+                    with self._cond:
+                        self._recycled += 1
+                    CONNESSIONI_DB.labels('recycled').inc()
+                    self._discard(conn)
+                    conn = None
+                elif conn.closed or (self.pre_ping is not None and now - returned > self.pre_ping
+                                     and not self._is_alive(conn)):
+                    with self._cond:
+                        self._broken += 1
+                    CONNESSIONI_DB.labels('broken').inc()
+                    self._discard(conn)
+                    conn = None
+                else:
+                    with self._cond:
+                        self._reused += 1
+                    CONNESSIONI_DB.labels('reused').inc()
+            if conn is None:
+                conn = self._open()
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._update_gauges()
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        if self._pid != os.getpid():
+            return
+        keep = not conn.closed
+        if keep:
+            try:
+                # Annulla eventuali transazioni lasciate aperte dalla richiesta
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            if keep and len(self._idle) < self.size:
+                self._idle.append((conn, self._created.get(id(conn), time.monotonic()), time.monotonic()))
+                conn = None
+            self._update_gauges()
+            self._cond.notify()
+
+        if conn is not None:
+            self._discard(conn)
+
+    def _update_gauges(self):
+        # Da chiamare con self._cond acquisito
+        CONNESSIONI_POOL.labels('in_use').set(self._in_use)
+        CONNESSIONI_POOL.labels('idle').set(len(self._idle))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'opened': self._opened,
+                'reused': self._reused,
+                'recycled': self._recycled,
+                'broken': self._broken,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'wait_time_total': round(self._wait_time, 4),
+                'wait_time_max': round(self._max_wait, 4),
+            }
+
 
 class NeonDB:
-    def __init__(self, conn):
+    def __init__(self, conn, pool=None, slow_query_ms=0, label=None):
         self.conn = conn
+        self.pool = pool
+        self.stats = QueryStats()
+        # Soglia del log delle query lente (0 = disattivato); label identifica
+        # la richiesta nel log (la rotta)
+        self.slow_query_ms = slow_query_ms
+        self.label = label
+
+    def _record(self, query, params, elapsed, rows):
+        self.stats.record(query, elapsed, rows)
+        if self.slow_query_ms and elapsed * 1000 >= self.slow_query_ms:
+            # Mai i valori dei parametri: possono contenere dati personali o password
+            n_params = len(params) if isinstance(params, (tuple, list, dict)) else 0
+            slow_query_log.warning(
+                'slow query %.1f ms, %d rows, %d params redacted [%s]: %s',
+                elapsed * 1000, max(rows, 0), n_params, self.label or '-', normalize_sql(query)
+            )
 
     def execute(self, query, params=()):
-        # Replace SQLite placeholders (?) with Postgres ones (%s)
-        # Note: This is a simple replacement. If '?' appears in strings, it might break.
-        # Given the app simplicity, this is likely fine.
-        query = query.replace('?', '%s')
-        
+        started = time.perf_counter()
+        cur = None
+        try:
+            cur = self._execute(query, params)
+            return cur
+        finally:
+            self._record(query, params, time.perf_counter() - started, cur.rowcount if cur is not None else 0)
+
+    def _execute(self, query, params=()):
+        cache = getattr(self.conn, 'statement_cache', None)
+        if cache is None:
+            # Replace SQLite placeholders (?) with Postgres ones (%s)
+            # Note: This is a simple replacement. If '?' appears in strings, it might break.
+            # Given the app simplicity, this is likely fine.
+            query = query.replace('?', '%s')
+            entry = None
+        else:
+            entry = cache.lookup(query)
+            entry['uses'] += 1
+            query = entry['sql']
+
         cur = self.conn.cursor(cursor_factory=RealDictCursor)
+        preparato = False
+        if entry is not None and isinstance(params, (tuple, list)):
+            if entry['name'] is None and entry['preparable'] and entry['uses'] >= cache.prepare_threshold:
+                preparato = self._prepare(cur, cache, entry)
         try:
+            if entry is not None and entry['name'] is not None and isinstance(params, (tuple, list)):
+                cur.execute(cache.pop_deallocate() + entry['execute'], params)
+                if not preparato:
+                    _count('prepared_hits')
+                return cur
             cur.execute(query, params)
             return cur
         except Exception as e:
             self.conn.rollback()
+            if entry is not None and entry['name'] and isinstance(e, psycopg2.errors.FeatureNotSupported):
+                # "cached plan must not change result type" dopo una modifica dello schema
+                cache.deallocate.append(entry['name'])
+                entry['name'] = None
             raise e
 
+    def _prepare(self, cur, cache, entry):
+        # PREPARE in un round-trip separato (una volta per statement e
+        # connessione), così un errore dell'EXECUTE resta un errore della query
+        # e il prepared statement resta valido. Se il PREPARE fallisce la query
+        # viene eseguita senza: dentro una transazione il savepoint ne conserva
+        # le scritture precedenti. Parametri vuoti: i '%%' del testo vanno
+        # comunque formattati da psycopg2.
+        cache.prepare(entry)
+        in_transazione = not self.conn.autocommit
+        try:
+            if in_transazione:
+                cur.execute(f"SAVEPOINT neondb_prepare; {entry['prepare']}; RELEASE SAVEPOINT neondb_prepare", ())
+            else:
+                cur.execute(entry['prepare'], ())
+            _count('prepared_new')
+            return True
+        except psycopg2.Error:
+            entry['name'] = None
+            entry['preparable'] = False
+            _count('prepared_failed')
+            if in_transazione:
+                cur.execute('ROLLBACK TO SAVEPOINT neondb_prepare; RELEASE SAVEPOINT neondb_prepare')
+            return False
+
+    def execute_autocommit(self, query, params=()):
+        """Run a single statement as its own transaction.
+
+        Saves the separate BEGIN and COMMIT round trips; only valid when no
+        transaction is open on the connection.
+        """
+        self.conn.autocommit = True
+        try:
+            return self.execute(query, params)
+        finally:
+            self.conn.autocommit = False
+
+    def execute_values(self, query, rows, template=None, fetch=False, page_size=500):
+        """Multi-row statement (`VALUES %s`) through psycopg2's execute_values.
+
+        Sends `page_size` rows per statement instead of one statement per row.
+        With `fetch=True` returns the rows produced by RETURNING.
+        """
+        cur = self.conn.cursor(cursor_factory=RealDictCursor)
+        started = time.perf_counter()
+        result = None
+        try:
+            result = execute_values(cur, query, rows, template=template, page_size=page_size, fetch=fetch)
+            return result
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._record(query, rows, time.perf_counter() - started,
+                         len(result) if fetch and result else cur.rowcount)
+
+    def stream(self, query, params=(), chunk_size=2000):
+        """Yield result rows in chunks through a server-side (named) cursor.
+
+        Rows are plain tuples and only `chunk_size` of them are held in
+        memory at a time, regardless of the size of the result.
+        """
+        cur = self.conn.cursor(name=f'neondb_stream_{id(self)}')
+        cur.itersize = chunk_size
+        # Il tempo misurato è quello passato ad aspettare il database, non
+        # quello speso dal chiamante tra un blocco e l'altro
+        elapsed = 0.0
+        total = 0
+        try:
+            started = time.perf_counter()
+            cur.execute(query.replace('?', '%s'), params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                elapsed += time.perf_counter() - started
+                if not rows:
+                    break
+                total += len(rows)
+                yield rows
+                started = time.perf_counter()
+        finally:
+            try:
+                cur.close()
+            except Exception:
+                pass
+            self._record(query, params, elapsed, total)
+
     def commit(self):
         self.conn.commit()
 
     def close(self):
-        self.conn.close()
+        # Se la connessione arriva dal pool la restituiamo invece di chiuderla
+        if self.pool is not None:
+            self.pool.putconn(self.conn)
+        else:
+            self.conn.close()
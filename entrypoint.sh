@@ -28,7 +28,7 @@ fi
 echo "Starting application with Gunicorn..."
 exec gosu appuser gunicorn --bind 0.0.0.0:5003 \
     --workers 2 \
-    --threads 4 \
+    --threads ${GUNICORN_THREADS:-16} \
     --timeout 60 \
     --access-logfile - \
     --error-logfile - \
@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+
+# Configurazione letta da gunicorn all'avvio (dalla cartella in cui viene
+# lanciato); worker e thread restano sulla riga di comando di start.sh,
+# entrypoint.sh e Procfile.
+#
+# Metriche Prometheus: ogni worker scrive i propri valori in file dentro
+# PROMETHEUS_MULTIPROC_DIR (in /dev/shm quando disponibile) e /metrics li somma.
+# La cartella viene svuotata all'avvio del master; quando un worker termina i
+# suoi valori "live" (richieste in corso, connessioni del pool) vengono scartati.
+
+metriche = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'timbraceck-metrics'))
+
+
+def on_starting(server):
+    # Valori rimasti da un'esecuzione precedente
+    shutil.rmtree(metriche, ignore_errors=True)
+    os.makedirs(metriche, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,54 @@
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess, REGISTRY)
+
+# Metriche Prometheus dell'applicazione, esposte da /metrics.
+#
+# Con gunicorn (gunicorn.conf.py) PROMETHEUS_MULTIPROC_DIR indica una cartella
+# condivisa in cui ogni worker scrive i propri valori: /metrics li somma, quindi
+# ogni scrape vede il totale di tutti i worker qualunque sia quello che risponde.
+# Senza la variabile (server di sviluppo, script) i valori restano nel processo.
+
+# Richieste HTTP
+RICHIESTE = Counter('timbraceck_http_requests_total', 'HTTP requests',
+                    ['endpoint', 'method', 'status'])
+DURATA_RICHIESTE = Histogram('timbraceck_http_request_duration_seconds',
+                             'Time until the response is ready (streamed bodies excluded)',
+                             ['endpoint', 'method'])
+RICHIESTE_IN_CORSO = Gauge('timbraceck_http_requests_in_progress',
+                           'Requests being served, including open SSE streams',
+                           multiprocess_mode='livesum')
+
+# Timbrature registrate (origine: chiosco o coda offline)
+TIMBRATURE = Counter('timbraceck_punches_total', 'Punches recorded', ['tipo', 'origine'])
+
+# Database
+DURATA_DB = Histogram('timbraceck_db_request_seconds', 'Database time per request', ['endpoint'])
+QUERY_DB = Counter('timbraceck_db_queries_total', 'SQL statements executed', ['endpoint'])
+CONNESSIONI_DB = Counter('timbraceck_db_connections_total',
+                         'Pool checkouts by outcome (opened, reused, recycled, broken)', ['event'])
+CONNESSIONI_POOL = Gauge('timbraceck_db_pool_connections', 'Pool connections by state',
+                         ['state'], multiprocess_mode='livesum')
+ATTESA_POOL = Histogram('timbraceck_db_pool_wait_seconds',
+                        'Time spent waiting for a free connection (only checkouts that waited)')
+TIMEOUT_POOL = Counter('timbraceck_db_pool_timeouts_total', 'Checkouts that gave up waiting')
+CACHE_QUERY = Counter('timbraceck_db_statement_cache_total',
+                      'Statement cache lookups and prepared statements', ['event'])
+
+# Cache dei report e password
+CACHE_REPORT = Counter('timbraceck_report_cache_total', 'Report cache hits, misses and errors', ['result'])
+VERIFICHE_PASSWORD = Counter('timbraceck_password_verifications_total',
+                             'Password verifications (cache_hit, computed, shared)', ['result'])
+DURATA_HASH = Histogram('timbraceck_password_hash_seconds', 'PBKDF2 hash or verification time',
+                        buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10))
+
+
+def esporta():
+    """Corpo e content type della risposta di /metrics."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,202 @@
+from datetime import date
+from dotenv import load_dotenv
+import psycopg2
+import os
+
+load_dotenv()
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'schema_pg.sql')
+BATCH_SIZE = 50000
+MESI_FUTURI = 3
+
+COLONNE = 'id, dipendente_id, inizio, fine, note'
+
+# Indici di timbrature in schema_pg.sql: creati sulla nuova tabella prima della
+# copia, così al cambio non vanno costruiti mentre la tabella è bloccata
+INDICI = {
+    'idx_timbrature_dipendente_inizio': '(dipendente_id, inizio) INCLUDE (id, fine)',
+    'idx_timbrature_periodo': '(inizio) INCLUDE (id, dipendente_id, fine)',
+    'idx_timbrature_aperta': '(dipendente_id) WHERE fine IS NULL',
+}
+
+# Conversione online di timbrature in tabella partizionata per mese:
+#   1. crea timbrature_nuova con le partizioni e un trigger che registra gli id
+#      modificati sulla vecchia tabella (timbrature_modifiche)
+#   2. copia le righe a blocchi, un commit per blocco (le timbrature continuano)
+#   3. riapplica le righe modificate nel frattempo
+#   4. blocca timbrature per pochi istanti, riapplica le ultime modifiche e
+#      scambia le tabelle; la vecchia resta come timbrature_vecchia
+# Se interrotto si può rilanciare: riprende dalla tabella già creata.
+
+def aggiungi_mese(d):
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+def prepara(cur):
+    cur.execute("SELECT to_regclass('timbrature_nuova') IS NOT NULL")
+    if cur.fetchone()[0]:
+        print("Resuming: timbrature_nuova already exists.")
+        return
+
+    cur.execute("""
+        CREATE TABLE timbrature_nuova (
+            id INTEGER NOT NULL DEFAULT nextval('timbrature_id_seq'),
+            dipendente_id INTEGER NOT NULL REFERENCES dipendenti(id) ON DELETE CASCADE,
+            inizio TIMESTAMP NOT NULL,
+            fine TIMESTAMP,
+            note TEXT,
+            PRIMARY KEY (id, inizio)
+        ) PARTITION BY RANGE (inizio)
+    """)
+    cur.execute("CREATE TABLE timbrature_default PARTITION OF timbrature_nuova DEFAULT")
+
+    cur.execute("SELECT MIN(inizio)::date, MAX(inizio)::date FROM timbrature")
+    primo, ultimo = cur.fetchone()
+    oggi = date.today()
+    mese = (primo or oggi).replace(day=1)
+    fine = max(ultimo or oggi, oggi).replace(day=1)
+    for _ in range(MESI_FUTURI):
+        fine = aggiungi_mese(fine)
+    partizioni = 0
+    while mese <= fine:
+        cur.execute(
+            f"CREATE TABLE timbrature_{mese:%Y_%m} PARTITION OF timbrature_nuova "
+            "FOR VALUES FROM (%s) TO (%s)",
+            (mese, aggiungi_mese(mese))
+        )
+        mese = aggiungi_mese(mese)
+        partizioni += 1
+
+    for nome, definizione in INDICI.items():
+        cur.execute(f"CREATE INDEX {nome}_nuova ON timbrature_nuova {definizione}")
+
+    cur.execute("CREATE TABLE timbrature_modifiche (id INTEGER NOT NULL)")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION registra_modifica_timbratura() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO timbrature_modifiche VALUES (OLD.id);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO timbrature_modifiche VALUES (NEW.id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+        CREATE TRIGGER trg_timbrature_migrazione
+            AFTER INSERT OR UPDATE OR DELETE ON timbrature
+            FOR EACH ROW EXECUTE FUNCTION registra_modifica_timbratura()
+    """)
+    print(f"Created timbrature_nuova with {partizioni} monthly partitions.")
+
+def copia(conn, cur):
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM timbrature")
+    massimo = cur.fetchone()[0]
+    copiate = 0
+    for da in range(0, massimo, BATCH_SIZE):
+        cur.execute(f"""
+            INSERT INTO timbrature_nuova ({COLONNE})
+            SELECT {COLONNE} FROM timbrature WHERE id > %s AND id <= %s
+            ON CONFLICT DO NOTHING
+        """, (da, da + BATCH_SIZE))
+        conn.commit()
+        copiate += cur.rowcount
+        print(f"  copied {copiate} rows (id <= {min(da + BATCH_SIZE, massimo)})")
+    return copiate
+
+def applica_modifiche(cur):
+    """Riallinea in timbrature_nuova un blocco di righe modificate; restituisce quante."""
+    cur.execute("""
+        WITH lotto AS (
+            DELETE FROM timbrature_modifiche
+            WHERE ctid IN (SELECT ctid FROM timbrature_modifiche LIMIT %s)
+            RETURNING id
+        )
+        SELECT DISTINCT id FROM lotto
+    """, (BATCH_SIZE,))
+    ids = [r[0] for r in cur.fetchall()]
+    if ids:
+        cur.execute("DELETE FROM timbrature_nuova WHERE id = ANY(%s)", (ids,))
+        cur.execute(f"""
+            INSERT INTO timbrature_nuova ({COLONNE})
+            SELECT {COLONNE} FROM timbrature WHERE id = ANY(%s)
+        """, (ids,))
+    return len(ids)
+
+def scambia(cur):
+    # Breve blocco esclusivo: nessuna timbratura durante lo scambio
+    cur.execute("LOCK TABLE timbrature IN ACCESS EXCLUSIVE MODE")
+    while applica_modifiche(cur):
+        pass
+
+    cur.execute("""
+        SELECT tgname FROM pg_trigger
+        WHERE tgrelid = 'timbrature'::regclass AND NOT tgisinternal
+    """)
+    for (nome,) in cur.fetchall():
+        cur.execute(f"DROP TRIGGER {nome} ON timbrature")
+    cur.execute("DROP TABLE timbrature_modifiche")
+    cur.execute("DROP FUNCTION registra_modifica_timbratura()")
+
+    cur.execute("ALTER TABLE timbrature RENAME TO timbrature_vecchia")
+    cur.execute("ALTER TABLE timbrature_vecchia RENAME CONSTRAINT timbrature_pkey TO timbrature_vecchia_pkey")
+    for nome in INDICI:
+        cur.execute(f"ALTER INDEX IF EXISTS {nome} RENAME TO {nome}_vecchia")
+        cur.execute(f"ALTER INDEX {nome}_nuova RENAME TO {nome}")
+    cur.execute("ALTER TABLE timbrature_nuova RENAME TO timbrature")
+    cur.execute("ALTER TABLE timbrature RENAME CONSTRAINT timbrature_nuova_pkey TO timbrature_pkey")
+    cur.execute("ALTER TABLE timbrature RENAME CONSTRAINT timbrature_nuova_dipendente_id_fkey TO timbrature_dipendente_id_fkey")
+    cur.execute("ALTER SEQUENCE timbrature_id_seq OWNED BY timbrature.id")
+
+    # Trigger, funzioni e tabelle derivate sulla nuova tabella
+    with open(SCHEMA_PATH, 'r') as f:
+        cur.execute(f.read())
+
+def migra():
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        print("DATABASE_URL not found")
+        return
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'timbrature'::regclass)")
+        if cur.fetchone()[0]:
+            print("timbrature is already partitioned.")
+            return
+
+        # 1. Nuova tabella e registrazione delle modifiche
+        print("Preparing partitioned table...")
+        prepara(cur)
+        conn.commit()
+
+        # 2. Copia a blocchi
+        print("Copying rows...")
+        copiate = copia(conn, cur)
+
+        # 3. Recupero delle modifiche avvenute durante la copia
+        print("Applying changes made during the copy...")
+        while True:
+            righe = applica_modifiche(cur)
+            conn.commit()
+            if righe < BATCH_SIZE:
+                break
+
+        # 4. Scambio delle tabelle
+        print("Swapping tables...")
+        scambia(cur)
+        conn.commit()
+        print(f"Migration completed: {copiate} rows copied. "
+              "The old table is kept as timbrature_vecchia: drop it once verified.")
+
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migra()
@@ -1,18 +1,204 @@
+import argparse
+import io
 import sqlite3
+import time
 import psycopg2
-import psycopg2.extras
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
+from backfill_ore_giornaliere import ricostruisci_ore_giornaliere, ricostruisci_presenze_correnti
+from report_cache import invalida_cache_locale
 
 load_dotenv()
 
 # Configuration
 SQLITE_DB_PATH = os.path.join('database', 'timbrature.db')
 POSTGRES_DB_URL = os.getenv('DATABASE_URL')
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'schema_pg.sql')
+CHUNK_SIZE = 20000
+
+# Tabelle da migrare, con le colonne copiate (se presenti in SQLite) e le tabelle
+# che devono essere già completate per rispettare le foreign key
+TABELLE = {
+    'admin': {'colonne': ['id', 'username', 'password', 'role'], 'dopo': []},
+    'dipendenti': {'colonne': ['id', 'nome', 'cognome', 'email', 'data_assunzione', 'colore'], 'dopo': []},
+    'timbrature': {'colonne': ['id', 'dipendente_id', 'inizio', 'fine', 'note'], 'dopo': ['dipendenti']},
+}
+
+# Migrazione da SQLite a Postgres in streaming:
+#   - le righe vengono lette a blocchi di CHUNK_SIZE in ordine di id e scritte con
+#     COPY FROM STDIN; ogni blocco è una transazione che aggiorna anche il
+#     checkpoint della tabella (migrazione_sqlite), quindi se interrotta la
+#     migrazione riprende dall'ultimo blocco salvato;
+#   - le tabelle senza dipendenze tra loro vengono copiate in parallelo;
+#   - gli id vengono mantenuti e le sequenze riallineate alla fine;
+#   - durante la copia i trigger di timbrature sono disattivati: ore_giornaliere e
+#     presenze_correnti vengono ricostruite una volta sola alla fine. Trigger e
+#     ricostruzione avvengono anche se la copia si interrompe, così l'applicazione
+#     non resta con le tabelle derivate ferme fino alla ripresa.
+#
+#   python migrate_to_neon.py               # avvia o riprende
+#   python migrate_to_neon.py --ricomincia  # svuota il database di destinazione e riparte
+
+
+def valore_copy(valore):
+    # Formato testo di COPY: \N per NULL, escape di backslash e separatori
+    if valore is None:
+        return '\\N'
+    return (str(valore).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def colonne_sqlite(sqlite_conn, tabella):
+    presenti = {r[1] for r in sqlite_conn.execute(f"PRAGMA table_info({tabella})")}
+    return [c for c in TABELLE[tabella]['colonne'] if c in presenti]
+
+
+def prepara(pg_conn, sqlite_conn, ricomincia):
+    pg_cur = pg_conn.cursor()
+
+    # Prima esecuzione (o --ricomincia): nessun checkpoint salvato
+    pg_cur.execute("SELECT to_regclass('migrazione_sqlite') IS NOT NULL")
+    if ricomincia or not pg_cur.fetchone()[0]:
+        # 1. Schema e partizioni per il periodo coperto dalle timbrature (solo
+        # alla prima esecuzione: lo schema inserisce gli utenti predefiniti, che
+        # andrebbero in conflitto con gli id copiati)
+        print("Initializing Postgres schema...")
+        with open(SCHEMA_PATH, 'r') as f:
+            pg_cur.execute(f.read())
+        primo, ultimo = sqlite_conn.execute("SELECT MIN(inizio), MAX(inizio) FROM timbrature").fetchone()
+        if primo:
+            pg_cur.execute("SELECT crea_partizioni_timbrature(%s::date, %s::date)", (primo[:10], ultimo[:10]))
+
+        # 2. Checkpoint vuoti e destinazione svuotata
+        pg_cur.execute("""
+            CREATE TABLE IF NOT EXISTS migrazione_sqlite (
+                tabella TEXT PRIMARY KEY,
+                ultimo_id BIGINT NOT NULL DEFAULT 0,
+                righe BIGINT NOT NULL DEFAULT 0,
+                completata BOOLEAN NOT NULL DEFAULT FALSE
+            )
+        """)
+        print("Clearing existing data in target...")
+        pg_cur.execute("TRUNCATE TABLE timbrature, dipendenti, admin, timbrature_client, mesi_chiusi RESTART IDENTITY CASCADE")
+        pg_cur.execute("DELETE FROM migrazione_sqlite")
+        for tabella in TABELLE:
+            pg_cur.execute("INSERT INTO migrazione_sqlite (tabella) VALUES (%s)", (tabella,))
+    else:
+        print("Resuming from the last checkpoint...")
+
+    # 3. Niente trigger per riga durante la copia
+    pg_cur.execute("ALTER TABLE timbrature DISABLE TRIGGER USER")
+    pg_conn.commit()
+
+
+def copia_tabella(tabella, chunk_size):
+    """Copia una tabella a blocchi dal checkpoint salvato; restituisce le righe copiate."""
+    sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
+    pg_conn = psycopg2.connect(POSTGRES_DB_URL)
+    try:
+        pg_cur = pg_conn.cursor()
+        pg_cur.execute(
+            "SELECT ultimo_id, righe, completata FROM migrazione_sqlite WHERE tabella = %s", (tabella,)
+        )
+        ultimo_id, righe, completata = pg_cur.fetchone()
+        pg_conn.rollback()
+        if completata:
+            print(f"  {tabella}: already migrated ({righe} rows)")
+            return 0
+
+        colonne = colonne_sqlite(sqlite_conn, tabella)
+        elenco = ', '.join(colonne)
+        copiate = 0
+        inizio = time.perf_counter()
+        while True:
+            blocco = sqlite_conn.execute(
+                f"SELECT {elenco} FROM {tabella} WHERE id > ? ORDER BY id LIMIT ?", (ultimo_id, chunk_size)
+            ).fetchall()
+            if not blocco:
+                break
+
+            buffer = io.StringIO()
+            for riga in blocco:
+                buffer.write('\t'.join(valore_copy(v) for v in riga) + '\n')
+            buffer.seek(0)
+
+            # Righe e checkpoint nella stessa transazione
+            pg_cur.copy_expert(f"COPY {tabella} ({elenco}) FROM STDIN", buffer)
+            ultimo_id = blocco[-1][0]
+            pg_cur.execute(
+                "UPDATE migrazione_sqlite SET ultimo_id = %s, righe = righe + %s WHERE tabella = %s",
+                (ultimo_id, len(blocco), tabella)
+            )
+            pg_conn.commit()
+
+            copiate += len(blocco)
+            durata = time.perf_counter() - inizio
+            print(f"  {tabella}: {righe + copiate} rows (id <= {ultimo_id}), {copiate / durata:.0f} rows/s")
+
+        pg_cur.execute("UPDATE migrazione_sqlite SET completata = TRUE WHERE tabella = %s", (tabella,))
+        pg_conn.commit()
+        durata = time.perf_counter() - inizio
+        print(f"  {tabella}: done, {copiate} rows in {durata:.1f} s "
+              f"({copiate / durata if durata else 0:.0f} rows/s)")
+        return copiate
+    finally:
+        sqlite_conn.close()
+        pg_conn.close()
+
+
+def copia_tabelle(chunk_size, processi):
+    # Avvia ogni tabella appena quelle da cui dipende sono completate
+    completate = set()
+    in_corso = {}
+    totale = 0
+    with ThreadPoolExecutor(processi) as executor:
+        while len(completate) < len(TABELLE):
+            for tabella, info in TABELLE.items():
+                if tabella not in completate and tabella not in in_corso.values() \
+                        and all(d in completate for d in info['dopo']):
+                    in_corso[executor.submit(copia_tabella, tabella, chunk_size)] = tabella
+            finiti, _ = wait(in_corso, return_when=FIRST_COMPLETED)
+            for future in finiti:
+                totale += future.result()
+                completate.add(in_corso.pop(future))
+    return totale
+
+
+def completa(pg_conn):
+    pg_cur = pg_conn.cursor()
+
+    # Sequenze allineate agli id copiati
+    for tabella in TABELLE:
+        pg_cur.execute(
+            f"SELECT setval(pg_get_serial_sequence('{tabella}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {tabella}"
+        )
+    pg_conn.commit()
+
+
+def riattiva_trigger(pg_conn):
+    # Riattiva i trigger e ricostruisce le tabelle derivate dalle righe copiate
+    # finora (eseguita anche se la copia fallisce)
+    pg_conn.rollback()
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute("ALTER TABLE timbrature ENABLE TRIGGER USER")
+    righe = ricostruisci_ore_giornaliere(pg_cur)
+    ricostruisci_presenze_correnti(pg_cur)
+    pg_cur.execute("UPDATE versione_dati SET versione = versione + 1 WHERE tabella = 'timbrature'")
+    pg_conn.commit()
+    print(f"ore_giornaliere rebuilt: {righe} rows.")
+    invalida_cache_locale()
+
 
 def migrate():
+    parser = argparse.ArgumentParser(description='Migrate the SQLite database to Postgres')
+    parser.add_argument('--ricomincia', action='store_true', help='clear the target and start over')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='rows per COPY batch')
+    parser.add_argument('--processi', type=int, default=len(TABELLE), help='tables copied in parallel')
+    args = parser.parse_args()
+
     print("Starting migration from SQLite to Neon Postgres...")
-    
+
     if not os.path.exists(SQLITE_DB_PATH):
         print(f"Error: SQLite database not found at {SQLITE_DB_PATH}")
         return
@@ -21,71 +207,28 @@ def migrate():
         print("Error: DATABASE_URL not found in environment")
         return
 
-    # Connect to SQLite
-    print("Connecting to SQLite...")
     sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
-    sqlite_conn.row_factory = sqlite3.Row
-    sqlite_cur = sqlite_conn.cursor()
-
-    # Connect to Postgres
-    print("Connecting to Neon Postgres...")
     pg_conn = psycopg2.connect(POSTGRES_DB_URL)
-    pg_cur = pg_conn.cursor()
 
     try:
-        # 1. Initialize Schema in Postgres
-        print("Initializing Postgres schema...")
-        with open(os.path.join('database', 'schema_pg.sql'), 'r') as f:
-            pg_cur.execute(f.read())
-        pg_conn.commit()
-
-        # 2. Clear existing data in Postgres (optional, for safety during dev)
-        print("Clearing existing data in target...")
-        pg_cur.execute("TRUNCATE TABLE timbrature, dipendenti, admin CASCADE;")
+        prepara(pg_conn, sqlite_conn, args.ricomincia)
 
-        # 3. Migrate Admin Users
-        print("Migrating Admin/Users...")
-        sqlite_cur.execute("SELECT * FROM admin")
-        admins = sqlite_cur.fetchall()
-        for admin in admins:
-            pg_cur.execute(
-                "INSERT INTO admin (username, password, role) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING",
-                (admin['username'], admin['password'], admin['role'])
-            )
-        
-        # 4. Migrate Dipendenti
-        print("Migrating Dipendenti...")
-        sqlite_cur.execute("SELECT * FROM dipendenti")
-        dipendenti = sqlite_cur.fetchall()
-        # Maintain ID mapping if necessary, but here we can just insert with explicit IDs
-        for d in dipendenti:
-            pg_cur.execute(
-                """INSERT INTO dipendenti (id, nome, cognome, email, data_assunzione, colore) 
-                   VALUES (%s, %s, %s, %s, %s, %s) 
-                   ON CONFLICT (id) DO UPDATE SET email=EXCLUDED.email""",
-                (d['id'], d['nome'], d['cognome'], d['email'], d['data_assunzione'], d['colore'])
-            )
-            # Update sequence for dipendenti_id
-        
-        # Reset sequence for dipendenti
-        pg_cur.execute("SELECT setval('dipendenti_id_seq', (SELECT MAX(id) FROM dipendenti))")
-
-        # 5. Migrate Timbrature
-        print("Migrating Timbrature...")
-        sqlite_cur.execute("SELECT * FROM timbrature")
-        timbrature = sqlite_cur.fetchall()
-        for t in timbrature:
-            pg_cur.execute(
-                """INSERT INTO timbrature (dipendente_id, inizio, fine, note) 
-                   VALUES (%s, %s, %s, %s)""",
-                (t['dipendente_id'], t['inizio'], t['fine'], t['note'] if 'note' in t.keys() else None)
-            )
-            
-        pg_conn.commit()
-        print("Migration completed successfully!")
+        try:
+            print("Copying tables...")
+            inizio = time.perf_counter()
+            totale = copia_tabelle(args.chunk, args.processi)
+            durata = time.perf_counter() - inizio
+            completa(pg_conn)
+        finally:
+            print("Rebuilding derived tables...")
+            riattiva_trigger(pg_conn)
+        print(f"Migration completed successfully: {totale} rows in {durata:.1f} s "
+              f"({totale / durata if durata else 0:.0f} rows/s).")
 
     except Exception as e:
+        # Il lavoro già salvato resta: rilanciando lo script riprende dal checkpoint
         print(f"Migration failed: {e}")
+        print("Run the script again to resume from the last checkpoint.")
         pg_conn.rollback()
     finally:
         sqlite_conn.close()
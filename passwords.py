@@ -0,0 +1,130 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import DURATA_HASH, VERIFICHE_PASSWORD
+
+
+class PasswordHasher:
+    """Hash e verifica delle password PBKDF2 fuori dai thread delle richieste.
+
+    PBKDF2 occupa la CPU per centinaia di millisecondi: con molti accessi
+    insieme (i chioschi alle 8:00) rallenterebbe le timbrature servite dallo
+    stesso worker. Il calcolo avviene in un pool di `processi` processi, che
+    limita le CPU usate per gli hash; con 0 processi avviene nel thread
+    chiamante.
+
+    Le verifiche riuscite restano in memoria per `cache_ttl` secondi, con
+    chiave HMAC(chiave, hash salvato + password): un nuovo accesso con la
+    stessa password (account condivisi dei chioschi) non ricalcola PBKDF2, e
+    cambiando la password l'hash salvato cambia e la voce non vale più.
+    Verifiche identiche contemporanee attendono lo stesso calcolo.
+    """
+
+    def __init__(self, iterazioni, processi, cache_ttl, chiave, cache_size=256):
+        self.metodo = f'pbkdf2:sha256:{iterazioni}'
+        self.processi = processi
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._chiave = chiave.encode() if isinstance(chiave, str) else chiave
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._verificate = OrderedDict()
+        self._in_corso = {}
+        self._hits = 0
+        self._misses = 0
+        self._condivise = 0
+        self._tempo_hash = 0.0
+
+    def _esegui(self, funzione, *args):
+        inizio = time.perf_counter()
+        try:
+            if self.processi <= 0:
+                return funzione(*args)
+            with self._lock:
+                # Un pool per processo: dopo il fork di gunicorn va ricreato
+                if self._pool is None or self._pid != os.getpid():
+                    # forkserver: i figli non ereditano thread e lock del worker
+                    self._pool = ProcessPoolExecutor(
+                        self.processi, mp_context=multiprocessing.get_context('forkserver'))
+                    self._pid = os.getpid()
+                pool = self._pool
+            return pool.submit(funzione, *args).result()
+        finally:
+            durata = time.perf_counter() - inizio
+            with self._lock:
+                self._tempo_hash += durata
+            DURATA_HASH.observe(durata)
+
+    def _chiave_cache(self, hash_salvato, password):
+        messaggio = hash_salvato.encode() + b'\0' + password.encode()
+        return hmac.new(self._chiave, messaggio, hashlib.sha256).digest()
+
+    def genera(self, password):
+        """Hash della password con i parametri correnti."""
+        return self._esegui(generate_password_hash, password, self.metodo)
+
+    def verifica(self, hash_salvato, password):
+        chiave = self._chiave_cache(hash_salvato, password)
+        adesso = time.monotonic()
+        with self._lock:
+            scadenza = self._verificate.get(chiave)
+            if scadenza is not None and scadenza > adesso:
+                self._verificate.move_to_end(chiave)
+                self._hits += 1
+                VERIFICHE_PASSWORD.labels('cache_hit').inc()
+                return True
+            in_corso = self._in_corso.get(chiave)
+            if in_corso is None:
+                self._misses += 1
+                risultato = self._in_corso[chiave] = Future()
+            else:
+                self._condivise += 1
+        if in_corso is not None:
+            VERIFICHE_PASSWORD.labels('shared').inc()
+            return in_corso.result()
+
+        VERIFICHE_PASSWORD.labels('computed').inc()
+        try:
+            valida = self._esegui(check_password_hash, hash_salvato, password)
+        except BaseException as e:
+            with self._lock:
+                del self._in_corso[chiave]
+            risultato.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_corso[chiave]
+            if valida and self.cache_ttl > 0:
+                self._verificate[chiave] = adesso + self.cache_ttl
+                self._verificate.move_to_end(chiave)
+                while len(self._verificate) > self.cache_size:
+                    self._verificate.popitem(last=False)
+        risultato.set_result(valida)
+        return valida
+
+    def da_aggiornare(self, hash_salvato):
+        """True se l'hash è stato calcolato con parametri diversi da quelli correnti."""
+        return hash_salvato.split('$', 1)[0] != self.metodo
+
+    def stats(self):
+        with self._lock:
+            verifiche = self._hits + self._misses
+            return {
+                'method': self.metodo,
+                'processes': self.processi,
+                'cache_hits': self._hits,
+                'cache_misses': self._misses,
+                'shared_verifications': self._condivise,
+                'cache_hit_ratio': round(self._hits / verifiche, 4) if verifiche else None,
+                'cache_entries': len(self._verificate),
+                'hash_time_total': round(self._tempo_hash, 3),
+            }
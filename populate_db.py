@@ -1,137 +1,210 @@
+import argparse
+import io
 import os
-import sqlite3
 import random
-import datetime
+import time
 from datetime import timedelta, date, datetime
+import psycopg2
+from dotenv import load_dotenv
+from backfill_ore_giornaliere import ricostruisci_ore_giornaliere, ricostruisci_presenze_correnti
+from report_cache import invalida_cache_locale
+
+load_dotenv()
+
+# Generatore di dati di test per Postgres (DATABASE_URL): dipendenti e anni di
+# timbrature scritti con COPY, per riprodurre in locale i tempi dei report con
+# volumi di produzione. A parità di parametri, seed e data di esecuzione i dati
+# sono identici.
+#
+#   python populate_db.py --dipendenti 2000 --anni 3 --svuota
+#
+# Ogni dipendente segue un tipo di turno:
+#   giorno     lun-ven, circa 8:00-17:00
+#   spezzato   lun-sab, mattina e pomeriggio (due timbrature al giorno)
+#   notte      dom-gio, 22:00-6:00 del giorno dopo (attraversa la mezzanotte)
+#   part_time  lun-ven, circa 9:00-13:00
+# Una frazione delle uscite viene dimenticata (--aperte): come al chiosco, il
+# tocco successivo chiude quel turno invece di aprirne uno nuovo; se non ci sono
+# tocchi successivi il turno resta aperto. I turni in corso adesso restano aperti.
+
+NOMI = ["Mario", "Giulia", "Paolo", "Francesca", "Alessandro", "Laura", "Luca", "Chiara",
+        "Marco", "Sara", "Andrea", "Elena", "Giuseppe", "Anna", "Davide", "Martina"]
+COGNOMI = ["Rossi", "Bianchi", "Verdi", "Ferrari", "Ricci", "Marini", "Russo", "Romano",
+           "Colombo", "Bruno", "Gallo", "Conti", "Costa", "Greco", "Fontana", "Moretti"]
+COLORI = ['#4361ee', '#f72585', '#4cc9f0', '#7209b7', '#2a9d8f', '#e76f51']
+
+BLOCCO_COPY = 100000
+
+
+def turni_del_giorno(tipo, giorno, rnd):
+    """(inizio, fine) dei turni di un dipendente che iniziano nel giorno indicato."""
+    settimana = giorno.weekday()  # 0 = lunedì
+    base = datetime(giorno.year, giorno.month, giorno.day)
+
+    def turno(ora, minuti_variazione, durata, durata_variazione):
+        inizio = base + timedelta(hours=ora, minutes=rnd.randint(-minuti_variazione, minuti_variazione),
+                                  seconds=rnd.randint(0, 59))
+        fine = inizio + timedelta(hours=durata + rnd.uniform(-durata_variazione, durata_variazione))
+        return inizio, fine
+
+    if tipo == 'giorno' and settimana < 5:
+        return [turno(8, 45, 9, 1)]
+    if tipo == 'spezzato' and settimana < 6:
+        return [turno(8.5, 20, 4, 0.5), turno(14.5, 20, 4, 0.5)]
+    if tipo == 'notte' and settimana in (6, 0, 1, 2, 3):
+        return [turno(22, 30, 8, 0.5)]
+    if tipo == 'part_time' and settimana < 5:
+        return [turno(9, 30, 4, 0.5)]
+    return []
+
+
+def genera_dipendenti(args):
+    rnd = random.Random(f"{args.seed}-dipendenti")
+    inizio_storico = date.today() - timedelta(days=365 * args.anni)
+    dipendenti = []
+    for i in range(1, args.dipendenti + 1):
+        x = rnd.random()
+        if x < args.notturni:
+            tipo = 'notte'
+        elif x < args.notturni + args.spezzati:
+            tipo = 'spezzato'
+        elif x < args.notturni + args.spezzati + args.part_time:
+            tipo = 'part_time'
+        else:
+            tipo = 'giorno'
+        dipendenti.append({
+            'id': i,
+            'nome': rnd.choice(NOMI),
+            'cognome': rnd.choice(COGNOMI),
+            'email': f"dipendente{i}@example.com",
+            'data_assunzione': inizio_storico - timedelta(days=rnd.randint(0, 3650)),
+            'colore': rnd.choice(COLORI),
+            'tipo': tipo,
+            'rnd': random.Random(f"{args.seed}-{i}"),
+            'aperta': None,
+        })
+    return dipendenti
+
+
+def genera_timbrature(dipendenti, args):
+    """Timbrature (dipendente_id, inizio, fine) in ordine di giorno, come in produzione."""
+    adesso = datetime.now().replace(microsecond=0)
+    giorno = date.today() - timedelta(days=365 * args.anni)
+    while giorno <= date.today():
+        for d in dipendenti:
+            rnd = d['rnd']
+            # Giorni di ferie o malattia
+            if rnd.random() < args.assenze:
+                continue
+            for inizio, fine in turni_del_giorno(d['tipo'], giorno, rnd):
+                if inizio > adesso:
+                    continue
+                if d['aperta'] is not None:
+                    # Il tocco di oggi chiude il turno con l'uscita dimenticata
+                    yield d['id'], d['aperta'], inizio
+                    d['aperta'] = None
+                    continue
+                if fine > adesso or rnd.random() < args.aperte:
+                    # Turno in corso o uscita dimenticata
+                    d['aperta'] = inizio
+                    continue
+                yield d['id'], inizio, fine
+        giorno += timedelta(days=1)
+
+    for d in dipendenti:
+        if d['aperta'] is not None:
+            yield d['id'], d['aperta'], None
+
+
+def copia(cur, tabella, colonne, righe):
+    """Scrive le righe con COPY a blocchi; restituisce quante."""
+    totale = 0
+    inizio = time.perf_counter()
+    buffer = io.StringIO()
+    n = 0
+    for riga in righe:
+        buffer.write('\t'.join('\\N' if v is None else str(v) for v in riga) + '\n')
+        n += 1
+        if n == BLOCCO_COPY:
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {tabella} ({colonne}) FROM STDIN", buffer)
+            totale += n
+            print(f"  {tabella}: {totale} rows, {totale / (time.perf_counter() - inizio):.0f} rows/s")
+            buffer = io.StringIO()
+            n = 0
+    if n:
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {tabella} ({colonne}) FROM STDIN", buffer)
+        totale += n
+    return totale
+
 
-# Path al database
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'timbrature.db')
-
-# Funzione per ottenere una connessione al database
-def get_db():
-    db = sqlite3.connect(DB_PATH)
-    db.row_factory = sqlite3.Row
-    return db
-
-# Funzione per generare una data casuale tra inizio e fine
-def random_date(start_date, end_date):
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = random.randrange(days_between_dates)
-    return start_date + timedelta(days=random_number_of_days)
-
-# Crea dipendenti di test
-def create_test_employees():
-    print("Creazione dipendenti di test...")
-    
-    dipendenti = [
-        ("Mario", "Rossi", "mario.rossi@example.com", "2023-01-15"),
-        ("Giulia", "Bianchi", "giulia.bianchi@example.com", "2023-02-01"),
-        ("Paolo", "Verdi", "paolo.verdi@example.com", "2023-03-10"),
-        ("Francesca", "Ferrari", "francesca.ferrari@example.com", "2023-04-05"),
-        ("Alessandro", "Ricci", "alessandro.ricci@example.com", "2022-11-20"),
-        ("Laura", "Marini", "laura.marini@example.com", "2022-10-15")
-    ]
-    
-    db = get_db()
-    
-    # Pulisci le tabelle esistenti
-    print("Pulizia delle tabelle esistenti...")
-    db.execute("DELETE FROM timbrature")
-    db.execute("DELETE FROM dipendenti")
-    db.commit()
-    
-    # Inserisci i dipendenti
-    for dipendente in dipendenti:
-        try:
-            db.execute(
-                "INSERT INTO dipendenti (nome, cognome, email, data_assunzione) VALUES (?, ?, ?, ?)",
-                dipendente
-            )
-        except sqlite3.IntegrityError:
-            print(f"Errore: email {dipendente[2]} già in uso.")
-    
-    db.commit()
-    print(f"Creati {len(dipendenti)} dipendenti.")
-    
-    return [row['id'] for row in db.execute("SELECT id FROM dipendenti").fetchall()]
-
-# Genera timbrature casuali per i dipendenti
-def create_random_timbrature(dipendente_ids):
-    print("Generazione timbrature casuali...")
-    db = get_db()
-    
-    # Data di inizio e fine (ultimo anno)
-    end_date = datetime.now()
-    start_date = datetime(end_date.year -2, end_date.month, end_date.day)
-    
-    # Numero medio di giorni lavorati al mese per dipendente
-    work_days_per_month = 20
-    
-    total_entries = 0
-    
-    for dipendente_id in dipendente_ids:
-        # Genera date casuali per l'anno
-        current_date = start_date
-        
-        while current_date < end_date:
-            # Per ogni mese, genera circa 20 giorni lavorativi
-            month_start = current_date.replace(day=1)
-            month_end = (month_start.replace(month=month_start.month+1) if month_start.month < 12 
-                        else month_start.replace(year=month_start.year+1, month=1))
-            month_end = min(month_end, end_date)
-            
-            # Giorni in cui il dipendente ha lavorato questo mese
-            work_days = min(work_days_per_month, (month_end - month_start).days)
-            
-            # Genera le date di lavoro per questo mese
-            work_dates = sorted(random.sample(range(1, (month_end - month_start).days + 1), work_days))
-            
-            for day in work_dates:
-                work_date = month_start + timedelta(days=day-1)
-                
-                # Ora di inizio (tra le 8:00 e le 10:00)
-                start_hour = random.randint(8, 10)
-                start_minute = random.randint(0, 59)
-                inizio = datetime(work_date.year, work_date.month, work_date.day, 
-                                 start_hour, start_minute, 0)
-                
-                # Ore lavorate (tra 3 e 12 ore)
-                ore_lavorate = random.uniform(3.0, 12.0)
-                
-                # Ora di fine
-                fine = inizio + timedelta(hours=ore_lavorate)
-                
-                # Inserisci la timbratura
-                db.execute(
-                    "INSERT INTO timbrature (dipendente_id, inizio, fine) VALUES (?, ?, ?)",
-                    (dipendente_id, inizio.strftime('%Y-%m-%d %H:%M:%S'), fine.strftime('%Y-%m-%d %H:%M:%S'))
-                )
-                total_entries += 1
-            
-            # Passa al mese successivo
-            current_date = month_end
-    
-    db.commit()
-    print(f"Create {total_entries} timbrature casuali.")
-
-# Funzione principale
 def main():
-    print(f"Popolo il database {DB_PATH} con dati di test...")
-    
-    # Verifica che il database esista
-    if not os.path.exists(DB_PATH):
-        print(f"ERRORE: Il database {DB_PATH} non esiste.")
-        print("Esegui prima l'app Python per creare il database.")
+    parser = argparse.ArgumentParser(description='Generate synthetic test data in Postgres')
+    parser.add_argument('--dipendenti', type=int, default=50, help='number of employees')
+    parser.add_argument('--anni', type=int, default=2, help='years of history')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--notturni', type=float, default=0.1, help='fraction of night-shift employees')
+    parser.add_argument('--spezzati', type=float, default=0.3, help='fraction of split-shift employees')
+    parser.add_argument('--part-time', type=float, default=0.1, help='fraction of part-time employees')
+    parser.add_argument('--assenze', type=float, default=0.04, help='fraction of days off')
+    parser.add_argument('--aperte', type=float, default=0.005, help='fraction of forgotten clock-outs')
+    parser.add_argument('--svuota', action='store_true', help='clear employees and punches first')
+    args = parser.parse_args()
+
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        print("DATABASE_URL not found")
         return
-    
-    # Crea i dipendenti e ottieni i loro ID
-    dipendente_ids = create_test_employees()
-    
-    # Genera timbrature casuali
-    create_random_timbrature(dipendente_ids)
-    
-    print("Popolazione completata con successo!")
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+
+    try:
+        if args.svuota:
+            print("Clearing employees and punches...")
+            cur.execute("TRUNCATE TABLE timbrature, dipendenti, timbrature_client, mesi_chiusi RESTART IDENTITY CASCADE")
+        else:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM dipendenti)")
+            if cur.fetchone()[0]:
+                print("The database already contains employees: use --svuota to clear it.")
+                return
+
+        inizio = time.perf_counter()
+        dipendenti = genera_dipendenti(args)
+        copia(cur, 'dipendenti', 'id, nome, cognome, email, data_assunzione, colore', (
+            (d['id'], d['nome'], d['cognome'], d['email'], d['data_assunzione'], d['colore'])
+            for d in dipendenti
+        ))
+        cur.execute("SELECT setval('dipendenti_id_seq', %s)", (max(args.dipendenti, 1),))
+
+        # Partizioni per tutto il periodo, poi la copia senza trigger per riga:
+        # le tabelle derivate vengono ricostruite una volta sola alla fine
+        cur.execute("SELECT crea_partizioni_timbrature(%s, current_date)",
+                    (date.today() - timedelta(days=365 * args.anni),))
+        cur.execute("ALTER TABLE timbrature DISABLE TRIGGER USER")
+        print("Generating punches...")
+        righe = copia(cur, 'timbrature', 'dipendente_id, inizio, fine', genera_timbrature(dipendenti, args))
+        cur.execute("ALTER TABLE timbrature ENABLE TRIGGER USER")
+
+        print("Rebuilding derived tables...")
+        ricostruisci_ore_giornaliere(cur)
+        presenti = ricostruisci_presenze_correnti(cur)
+        cur.execute("UPDATE versione_dati SET versione = versione + 1 WHERE tabella = 'timbrature'")
+        cur.execute("ANALYZE timbrature")
+        cur.execute("ANALYZE ore_giornaliere")
+
+        conn.commit()
+        durata = time.perf_counter() - inizio
+        print(f"Created {len(dipendenti)} employees and {righe} punches ({presenti} currently open) "
+              f"in {durata:.1f} s ({righe / durata:.0f} rows/s).")
+        invalida_cache_locale()
+
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,89 @@
+import queue
+import select
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+
+CHANNEL = 'stato_dipendenti'
+
+
+class StatoListener:
+    """Un solo LISTEN per worker, smistato a tutti i client SSE collegati.
+
+    Il thread in background resta in ascolto sul canale `stato_dipendenti`
+    (alimentato dai trigger su timbrature e dipendenti) e inoltra ogni
+    notifica alle code dei subscriber. Si avvia al primo subscriber e si
+    riconnette da solo se la connessione cade.
+    """
+
+    def __init__(self, dsn, queue_size=100):
+        self.dsn = dsn
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, limite=None):
+        # Restituisce None se ci sono già `limite` subscriber collegati
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            if limite is not None and len(self._subscribers) >= limite:
+                return None
+            self._subscribers.add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stato-listener', daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _broadcast(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                # Client troppo lento: gli chiediamo di ricaricare tutto
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+    def _run(self):
+        backoff = 1
+        riconnessione = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {CHANNEL}')
+                backoff = 1
+                # Dopo una riconnessione potremmo aver perso notifiche
+                if riconnessione:
+                    self._broadcast(None)
+                riconnessione = True
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        conn.cursor().execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._broadcast(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Stato listener error: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
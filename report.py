@@ -0,0 +1,648 @@
+import base64
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+# Calcolo dei report di sola lettura, condiviso dalle rotte Flask (app.py, con
+# psycopg2) e dal server asincrono (asgi.py, con psycopg 3). Ogni report è un
+# generatore che non fa I/O: produce
+#   Query(sql, params)   e riceve le righe (lista di dict),
+#   Periodo(...)         per la cache dei report (riceve None; se il report è
+#                        in cache il chiamante chiude il generatore),
+# e restituisce il risultato da serializzare in JSON.
+
+Query = namedtuple('Query', 'sql params')
+Periodo = namedtuple('Periodo', 'data_inizio data_fine dipendente_id')
+
+# Timbrature per pagina del dettaglio di un dipendente (parametro limit)
+PAGINA_TIMBRATURE = 200
+PAGINA_TIMBRATURE_MAX = 1000
+
+
+class ParametroNonValido(ValueError):
+    """Parametro della richiesta non valido: le rotte rispondono 400."""
+
+
+def colonne(righe, campi):
+    """Formato colonnare (formato=colonne): un array per campo invece di un oggetto per riga."""
+    return {campo: [riga[campo] for riga in righe] for campo in campi}
+
+# I periodi dei report sono date comprese [data_inizio, data_fine]; nelle query
+# diventano l'intervallo semiaperto [data_inizio, data_fine + 1 giorno), con la
+# colonna senza funzioni o cast, così il filtro usa gli indici (e il pruning
+# delle partizioni) anche su timbrature.inizio che è un timestamp.
+
+
+def to_datetime(val, format='%Y-%m-%d %H:%M:%S'):
+    if val is None:
+        return None
+    if isinstance(val, str):
+        return datetime.strptime(val, format)
+    return val
+
+
+def fine_mese(y, m):
+    """Ultimo giorno del mese m dell'anno y."""
+    return date(y + m // 12, m % 12 + 1, 1) - timedelta(days=1)
+
+
+def ore_periodo(data_inizio, data_fine, mensile=False):
+    """Tabella del FROM (alias o: dipendente_id, giorno, ore, n_chiuse) e parametri delle ore dei giorni compresi."""
+    # I mesi chiusi (prima di fine_chiusura()) arrivano dagli snapshot della
+    # chiusura mensile, gli altri da ore_giornaliere. Con mensile=True e un periodo
+    # di mesi interi i mesi chiusi sono una riga per dipendente e mese (giorno =
+    # primo del mese): va bene per i totali del periodo o per mese, non per giorno.
+    fine = data_fine + timedelta(days=1)
+    if mensile and data_inizio.day == 1 and fine.day == 1:
+        chiusi = ('SELECT c.dipendente_id, c.mese AS giorno, c.ore, c.n_chiuse FROM ore_mensili_chiuse c '
+                  'WHERE c.mese >= %s AND c.mese < LEAST(%s, fine_chiusura())')
+    else:
+        chiusi = ('SELECT c.dipendente_id, c.giorno, c.ore, c.n_chiuse FROM ore_giornaliere_chiuse c '
+                  'WHERE c.giorno >= %s AND c.giorno < LEAST(%s, fine_chiusura())')
+    sql = f'''(
+            {chiusi}
+            UNION ALL
+            SELECT g.dipendente_id, g.giorno, g.ore, g.n_chiuse FROM ore_giornaliere g
+            WHERE g.giorno >= GREATEST(%s, fine_chiusura()) AND g.giorno < %s
+        ) o'''
+    return sql, [data_inizio, fine, data_inizio, fine]
+
+
+def totale(args):
+    periodo = args.get('periodo', 'mese')
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    oggi = date.today()
+    data_fine = oggi
+    if periodo == 'settimana':
+        data_inizio = oggi - timedelta(days=7)
+    elif periodo == 'mese':
+        data_inizio = oggi - timedelta(days=30)
+    elif periodo == 'mese_specifico':
+        # Calcola inizio e fine del mese specifico
+        try:
+            m = int(selected_month)
+            y = int(selected_year)
+            data_inizio = date(y, m, 1)
+            data_fine = fine_mese(y, m)
+        except:
+            # Fallback al mese corrente
+            data_inizio = oggi.replace(day=1)
+    else:  # anno
+        data_inizio = oggi - timedelta(days=365)
+
+    yield Periodo(data_inizio, data_fine, None)
+
+    # Legge gli aggregati (giornalieri o dei mesi chiusi) invece delle singole timbrature
+    ore, params = ore_periodo(data_inizio, data_fine, mensile=True)
+    report = yield Query(f'''
+        SELECT
+            d.id, d.nome, d.cognome,
+            SUM(o.ore) as ore_totali
+        FROM dipendenti d
+        JOIN {ore} ON d.id = o.dipendente_id
+        GROUP BY d.id
+        ORDER BY ore_totali DESC
+    ''', params)
+
+    result = []
+    for row in report:
+        result.append({
+            'id': row['id'],
+            'nome': row['nome'],
+            'cognome': row['cognome'],
+            'ore_totali': round(row['ore_totali'], 2)
+        })
+
+    return result
+
+
+def intervallo_dettaglio(periodo, selected_year, selected_month):
+    """Giorni di inizio e fine (compresi) del dettaglio timbrature per periodo e anno selezionati."""
+    oggi = date.today()
+
+    if periodo == 'mese_specifico':
+        try:
+            m = int(selected_month)
+            y = int(selected_year)
+            data_inizio = date(y, m, 1)
+            data_fine = fine_mese(y, m)
+        except:
+             data_inizio = date(int(selected_year), 1, 1)
+             data_fine = date(int(selected_year), 12, 31)
+    elif int(selected_year) == oggi.year:
+        # Logica per l'anno corrente
+        data_fine = oggi
+        if periodo == 'settimana':
+            data_inizio = oggi - timedelta(days=7)
+        elif periodo == 'mese':
+            data_inizio = oggi - timedelta(days=30)
+        else:  # anno
+            data_inizio = date(oggi.year, 1, 1)
+    else:
+        # Logica per anni passati
+        y = int(selected_year)
+        data_fine = date(y, 12, 31)
+        if periodo == 'settimana':
+            # Ultima settimana dell'anno
+            data_inizio = date(y, 12, 24)
+        elif periodo == 'mese':
+            # Ultimo mese dell'anno
+            data_inizio = date(y, 12, 1)
+        else:  # anno
+            data_inizio = date(y, 1, 1)
+
+    return data_inizio, data_fine
+
+
+CAMPI_TIMBRATURA = ('id', 'data', 'inizio', 'fine', 'ore')
+
+
+def formatta_timbratura(t):
+    inizio = to_datetime(t['inizio'])
+    fine = to_datetime(t['fine'])
+
+    return {
+        'id': t['id'],  # Aggiunto ID per la modifica
+        'data': inizio.strftime('%d/%m/%Y'),
+        'inizio': inizio.strftime('%H:%M:%S'),
+        'fine': fine.strftime('%H:%M:%S') if fine else None,
+        'ore': round(t['ore'], 2) if t['ore'] is not None else None
+    }
+
+
+def scrivi_cursore(t):
+    """Token opaco per la pagina che segue la timbratura t (keyset su inizio, id)."""
+    testo = f"{to_datetime(t['inizio']).isoformat()}|{t['id']}"
+    return base64.urlsafe_b64encode(testo.encode()).decode().rstrip('=')
+
+
+def leggi_cursore(token):
+    """Inizio e id dell'ultima timbratura della pagina precedente."""
+    try:
+        inizio, ultimo = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode().split('|')
+        return datetime.fromisoformat(inizio), int(ultimo)
+    except ValueError:
+        raise ParametroNonValido('cursore non valido')
+
+
+def dipendente(args, id):
+    periodo = args.get('periodo', 'mese')
+
+    # Ottieni l'anno selezionato (default: anno corrente)
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    # Paginazione keyset: limit timbrature dopo il cursore (dalla più recente)
+    try:
+        limit = int(args.get('limit', PAGINA_TIMBRATURE))
+    except ValueError:
+        raise ParametroNonValido('limit non valido')
+    if not 1 <= limit <= PAGINA_TIMBRATURE_MAX:
+        raise ParametroNonValido(f'limit deve essere compreso tra 1 e {PAGINA_TIMBRATURE_MAX}')
+    cursore = leggi_cursore(args['cursore']) if args.get('cursore') else None
+
+    # Determina le date di inizio/fine in base al periodo e all'anno
+    data_inizio, data_fine = intervallo_dettaglio(periodo, selected_year, selected_month)
+
+    yield Periodo(data_inizio, data_fine, id)
+
+    # Una riga in più per sapere se c'è un'altra pagina
+    params = [id, data_inizio, data_fine + timedelta(days=1)]
+    dopo = ''
+    if cursore:
+        dopo = 'AND (t.inizio, t.id) < (%s, %s)'
+        params += cursore
+    timbrature = yield Query(f'''
+        SELECT
+            t.id,
+            t.inizio,
+            t.fine,
+            CASE WHEN t.fine IS NOT NULL
+                THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600
+                ELSE NULL END as ore
+        FROM timbrature t
+        WHERE t.dipendente_id = %s AND t.inizio >= %s AND t.inizio < %s {dopo}
+        ORDER BY t.inizio DESC, t.id DESC
+        LIMIT %s
+    ''', params + [limit + 1])
+
+    dipendente = (yield Query('SELECT nome, cognome FROM dipendenti WHERE id = %s', (id,)))[0]
+
+    righe = [formatta_timbratura(t) for t in timbrature[:limit]]
+    result = {
+        'nome': dipendente['nome'],
+        'cognome': dipendente['cognome'],
+        'timbrature': colonne(righe, CAMPI_TIMBRATURA) if args.get('formato') == 'colonne' else righe,
+        'anno': selected_year,
+        'next': scrivi_cursore(timbrature[limit - 1]) if len(timbrature) > limit else None
+    }
+
+    if cursore is None:
+        # Totali del periodo (per mese) con la prima pagina, dagli aggregati
+        ore, params = ore_periodo(data_inizio, data_fine)
+        mesi = yield Query(f'''
+            SELECT
+                date_trunc('month', o.giorno)::date as mese,
+                SUM(o.ore) as ore_totali,
+                COUNT(*) as giorni
+            FROM {ore}
+            WHERE o.dipendente_id = %s
+            GROUP BY mese
+            ORDER BY mese DESC
+        ''', params + [id])
+        result['totali'] = {
+            'ore': round(sum(m['ore_totali'] for m in mesi), 2),
+            'giorni': sum(m['giorni'] for m in mesi),
+            'mesi': [{'mese': m['mese'].strftime('%Y-%m'), 'ore': round(m['ore_totali'], 2)} for m in mesi]
+        }
+
+    return result
+
+
+def timbrature(args):
+    # Dettaglio timbrature di tutti i dipendenti in un'unica query,
+    # già ordinato e con nome/cognome (sostituisce una richiesta per dipendente)
+    periodo = args.get('periodo', 'mese')
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    data_inizio, data_fine = intervallo_dettaglio(periodo, selected_year, selected_month)
+
+    timbrature = yield Query('''
+        SELECT
+            t.id,
+            t.dipendente_id,
+            d.nome,
+            d.cognome,
+            t.inizio,
+            t.fine,
+            CASE WHEN t.fine IS NOT NULL
+                THEN EXTRACT(EPOCH FROM (t.fine - t.inizio)) / 3600
+                ELSE NULL END as ore
+        FROM timbrature t
+        JOIN dipendenti d ON d.id = t.dipendente_id
+        WHERE t.inizio >= %s AND t.inizio < %s
+        ORDER BY t.inizio DESC, t.id DESC
+    ''', (data_inizio, data_fine + timedelta(days=1)))
+
+    result = {
+        'timbrature': [],
+        'anno': selected_year
+    }
+
+    for t in timbrature:
+        riga = formatta_timbratura(t)
+        riga['dipendente_id'] = t['dipendente_id']
+        riga['nome'] = t['nome']
+        riga['cognome'] = t['cognome']
+        result['timbrature'].append(riga)
+
+    return result
+
+
+def mensile(args):
+    dipendente_id = args.get('dipendente', 'tutti')
+    periodo = args.get('periodo', 'anno')
+
+    # Ottieni l'anno selezionato (default: anno corrente)
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    # Default: Anno (Mensile)
+    if periodo == 'anno':
+        start_date = date(int(selected_year), 1, 1)
+        end_date = date(int(selected_year), 12, 31)
+
+        # Query per raggruppamento mensile
+        group_by = "date_trunc('month', o.giorno)::date"
+        labels = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+                  "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+        yield Periodo(start_date, end_date, None if dipendente_id == 'tutti' else dipendente_id)
+
+        # Esegui query (i mesi chiusi sono già una riga per dipendente e mese)
+        ore, params = ore_periodo(start_date, end_date, mensile=True)
+        if dipendente_id != 'tutti':
+            report = yield Query(f'''
+                SELECT
+                    {group_by} as label_key,
+                    SUM(o.ore) as ore_totali
+                FROM {ore}
+                WHERE o.dipendente_id = %s
+                GROUP BY label_key
+                ORDER BY label_key
+            ''', params + [dipendente_id])
+        else:
+            report = yield Query(f'''
+                SELECT
+                    {group_by} as label_key,
+                    SUM(o.ore) as ore_totali
+                FROM {ore}
+                GROUP BY label_key
+                ORDER BY label_key
+            ''', params)
+
+        # Formatta dati
+        data = [0] * 12
+        for row in report:
+            idx = row['label_key'].month - 1
+            if 0 <= idx < 12:
+                data[idx] = round(row['ore_totali'], 2)
+
+        return {
+            'labels': labels,
+            'data': data,
+            'anno': selected_year
+        }
+
+    else:
+        # Periodo: Mese, Mese Specifico, Settimana (Giornaliero)
+        if periodo == 'settimana':
+            start_date = date.today() - timedelta(days=6) # Last 7 days including today
+            end_date = date.today()
+        elif periodo == 'mese':
+            start_date = date.today() - timedelta(days=29) # Last 30 days
+            end_date = date.today()
+        elif periodo == 'mese_specifico':
+            try:
+                m = int(selected_month)
+                y = int(selected_year)
+                start_date = date(y, m, 1)
+                end_date = fine_mese(y, m)
+            except:
+                start_date = date(int(selected_year), 1, 1)
+                end_date = date(int(selected_year), 12, 31)
+
+        yield Periodo(start_date, end_date, None if dipendente_id == 'tutti' else dipendente_id)
+
+        # Query per raggruppamento giornaliero
+        # Usa la data completa come chiave per ordinamento e visualizzazione
+        group_by = "o.giorno"
+
+        ore, params = ore_periodo(start_date, end_date)
+        query_base = f'''
+            SELECT
+                {group_by} as data_giorno,
+                SUM(o.ore) as ore_totali
+            FROM {ore}
+        '''
+
+        if dipendente_id != 'tutti':
+            query_base += " WHERE o.dipendente_id = %s"
+            params.append(dipendente_id)
+
+        query_base += f" GROUP BY data_giorno ORDER BY data_giorno"
+
+        report = yield Query(query_base, params)
+
+        # Genera labels e data
+        # Per semplicità, restituiamo solo i giorni che hanno dati o tutti i giorni nel range%s
+        # Meglio tutti i giorni nel range per continuità
+
+        labels = []
+        data = []
+
+        # Mappa dei risultati
+        results_map = {row['data_giorno']: row['ore_totali'] for row in report}
+
+        current = start_date
+
+        while current <= end_date:
+            # Format label: dd/mm
+            label = current.strftime('%d/%m')
+            labels.append(label)
+
+            val = results_map.get(current, 0)
+            data.append(round(val, 2))
+
+            current += timedelta(days=1)
+
+        return {
+            'labels': labels,
+            'data': data,
+            'anno': selected_year
+        }
+
+
+def distribuzione(args):
+    periodo = args.get('periodo', 'mese')
+    dipendente_id = args.get('dipendente', 'tutti')
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    # Determina la data di inizio e fine
+    oggi = date.today()
+    data_fine = oggi
+
+    if periodo == 'settimana':
+        data_inizio = oggi - timedelta(days=7)
+    elif periodo == 'mese':
+        data_inizio = oggi - timedelta(days=30)
+    elif periodo == 'mese_specifico':
+        try:
+            m = int(selected_month)
+            y = int(selected_year)
+            data_inizio = date(y, m, 1)
+            data_fine = fine_mese(y, m)
+        except:
+             data_inizio = oggi - timedelta(days=30)
+    else:  # anno
+        data_inizio = oggi - timedelta(days=365)
+
+    yield Periodo(data_inizio, data_fine, None if dipendente_id == 'tutti' else dipendente_id)
+
+    # Costruisci la query SQL (serve il giorno della settimana: sempre per giorno)
+    ore, params = ore_periodo(data_inizio, data_fine)
+    if dipendente_id != 'tutti':
+        where_clause = "WHERE o.dipendente_id = %s AND o.n_chiuse > 0"
+        params.append(dipendente_id)
+    else:
+        where_clause = "WHERE o.n_chiuse > 0"
+
+    # Query per ottenere la distribuzione oraria per giorno della settimana
+    # (media per timbratura chiusa = ore totali / timbrature chiuse)
+    report = yield Query(f'''
+        SELECT
+            EXTRACT(DOW FROM o.giorno) as giorno_settimana,
+            SUM(o.ore) / SUM(o.n_chiuse) as ore_medie
+        FROM {ore}
+        {where_clause}
+        GROUP BY giorno_settimana
+        ORDER BY giorno_settimana
+    ''', params)
+
+    # Prepara i dati per tutti i giorni della settimana (0=domenica, 1=lunedì, ...)
+    giorni = ["Domenica", "Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato"]
+    ore_per_giorno = [0] * 7  # Inizializza con 0 ore per ogni giorno
+
+    # Popola i dati dai risultati della query
+    for row in report:
+        idx = int(row['giorno_settimana'])  # Converte da 0-6 a indice
+        if 0 <= idx < 7:  # Controllo di sicurezza
+            ore_per_giorno[idx] = round(row['ore_medie'], 2)
+
+    return {
+        'labels': giorni,
+        'data': ore_per_giorno
+    }
+
+
+def confronto(args):
+    periodo = args.get('periodo', 'mese')
+
+    # Ottieni l'anno selezionato (default: anno corrente)
+    selected_year = args.get('anno', str(datetime.now().year))
+    selected_month = args.get('mese', str(datetime.now().month))
+
+    # Determina la data di inizio in base al periodo
+    if periodo == 'mese':
+        # Ultimo mese: prendere da 30 giorni fa fino ad oggi se anno corrente,
+        # altrimenti prendere l'ultimo mese dell'anno selezionato
+        oggi = date.today()
+        if int(selected_year) == oggi.year:
+            data_inizio = oggi - timedelta(days=30)
+            data_fine = oggi
+        else:
+            data_inizio = date(int(selected_year), 12, 1)
+            data_fine = date(int(selected_year), 12, 31)
+    elif periodo == 'mese_specifico':
+        try:
+            m = int(selected_month)
+            y = int(selected_year)
+            data_inizio = date(y, m, 1)
+            data_fine = fine_mese(y, m)
+        except:
+             data_inizio = date(int(selected_year), 1, 1)
+             data_fine = date(int(selected_year), 12, 31)
+    else:  # anno
+        data_inizio = date(int(selected_year), 1, 1)
+        data_fine = date(int(selected_year), 12, 31)
+
+    yield Periodo(data_inizio, data_fine, None)
+
+    # Un'unica query per tutti i dipendenti, raggruppata per dipendente e mese
+    # (per i periodi mensili basta il totale del dipendente)
+    group_by = "date_trunc('month', o.giorno)::date" if periodo not in ('mese', 'mese_specifico') else "NULL::date"
+    ore, params = ore_periodo(data_inizio, data_fine, mensile=True)
+    report = yield Query(f'''
+        SELECT
+            d.id, d.nome, d.cognome,
+            {group_by} as mese,
+            SUM(o.ore) as ore_totali
+        FROM dipendenti d
+        LEFT JOIN {ore} ON o.dipendente_id = d.id
+        GROUP BY d.id, mese
+        ORDER BY d.cognome, d.nome, d.id, mese
+    ''', params)
+
+    # Pivot: una riga per dipendente (nell'ordine cognome, nome) con le ore per mese
+    dipendenti = {}
+    for row in report:
+        dip = dipendenti.setdefault(row['id'], {
+            'nome': row['nome'],
+            'cognome': row['cognome'],
+            'ore_totali': 0,
+            'ore_mensili': [0] * 12
+        })
+        if row['ore_totali'] is None:
+            continue
+        if row['mese'] is None:
+            dip['ore_totali'] = row['ore_totali']
+        else:
+            mese_idx = row['mese'].month - 1  # Converte da 1-12 a 0-11 per l'indice
+            if 0 <= mese_idx < 12:  # Controllo di sicurezza
+                dip['ore_mensili'][mese_idx] = round(row['ore_totali'], 2)
+
+    result = {
+        'labels': [],
+        'datasets': [],
+        'anno': selected_year
+    }
+
+    if periodo == 'mese' or periodo == 'mese_specifico':
+        # Ore per dipendente nel periodo selezionato (una singola barra per dipendente)
+        result['labels'] = ["Ore Lavorate"]
+
+        # Definiamo alcuni colori per i diversi dipendenti
+        colori = [
+            'rgba(54, 162, 235, 0.7)', 'rgba(255, 99, 132, 0.7)', 'rgba(75, 192, 192, 0.7)',
+            'rgba(255, 206, 86, 0.7)', 'rgba(153, 102, 255, 0.7)', 'rgba(255, 159, 64, 0.7)',
+            'rgba(199, 199, 199, 0.7)', 'rgba(83, 102, 255, 0.7)', 'rgba(40, 167, 69, 0.7)'
+        ]
+
+        for idx, dip in enumerate(dipendenti.values()):
+            color_idx = idx % len(colori)
+
+            result['datasets'].append({
+                'label': f"{dip['cognome']} {dip['nome']}",
+                'data': [round(dip['ore_totali'], 2)],
+                'backgroundColor': colori[color_idx],
+                'borderColor': colori[color_idx].replace('0.7)', '1)'),
+                'borderWidth': 1
+            })
+    else:  # anno - mostra l'andamento mensile per ciascun dipendente
+        # Prepara le etichette dei mesi
+        mesi = ["Gen", "Feb", "Mar", "Apr", "Mag", "Giu", "Lug", "Ago", "Set", "Ott", "Nov", "Dic"]
+        result['labels'] = mesi
+
+        # Definiamo alcuni colori per i diversi dipendenti
+        colori = [
+            'rgba(54, 162, 235, 1)', 'rgba(255, 99, 132, 1)', 'rgba(75, 192, 192, 1)',
+            'rgba(255, 206, 86, 1)', 'rgba(153, 102, 255, 1)', 'rgba(255, 159, 64, 1)',
+            'rgba(199, 199, 199, 1)', 'rgba(83, 102, 255, 1)', 'rgba(40, 167, 69, 1)'
+        ]
+
+        for idx, dip in enumerate(dipendenti.values()):
+            color_idx = idx % len(colori)
+
+            # Aggiungi il dataset per questo dipendente
+            result['datasets'].append({
+                'label': f"{dip['cognome']} {dip['nome']}",
+                'data': dip['ore_mensili'],
+                'borderColor': colori[color_idx],
+                'backgroundColor': colori[color_idx].replace('1)', '0.1)'),
+                'fill': False,
+                'tension': 0.1
+            })
+
+    return result
+
+
+def stato_dipendenti(args=None):
+    # Legge solo presenze_correnti (un turno aperto per dipendente):
+    # il costo dipende dal numero di dipendenti, non dallo storico
+    dipendenti = yield Query('''
+        SELECT
+            d.id, d.nome, d.cognome,
+            p.inizio,
+            p.timbratura_id
+        FROM dipendenti d
+        LEFT JOIN presenze_correnti p ON d.id = p.dipendente_id
+        ORDER BY d.cognome, d.nome
+    ''', ())
+
+    result = []
+    for d in dipendenti:
+        stato = {
+            'id': d['id'],
+            'nome': d['nome'],
+            'cognome': d['cognome'],
+            'presente': d['inizio'] is not None,
+            'inizio': None
+        }
+
+        if d['inizio']:
+            inizio = to_datetime(d['inizio'])
+            stato['inizio'] = inizio.strftime('%d/%m/%Y %H:%M:%S')
+
+        result.append(stato)
+
+    if args and args.get('formato') == 'colonne':
+        return colonne(result, ('id', 'nome', 'cognome', 'presente', 'inizio'))
+    return result
+
+
+# Query della versione dei dati, per gli ETag delle API di sola lettura: somma dei
+# contatori di ogni tabella, che cresce a ogni scrittura
+VERSIONE_DATI = 'SELECT SUM(versione)::bigint AS versione FROM versione_dati'
@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from metrics import CACHE_REPORT
+
+# File della cache se REPORT_CACHE_PATH non è impostata
+PERCORSO_PREDEFINITO = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                    'timbraceck-report-cache.sqlite3')
+
+
+class ReportCache:
+    """Cache dei report condivisa da tutti i worker gunicorn della macchina.
+
+    Le voci stanno in un file SQLite (in /dev/shm quando disponibile, quindi
+    in memoria condivisa) e sono etichettate con il dipendente e l'intervallo
+    di date che coprono, così una timbratura invalida solo i report che la
+    includono: i periodi passati e chiusi restano in cache indefinitamente.
+    Oltre `max_bytes` vengono eliminate le voci usate meno di recente.
+    Ogni errore SQLite viene trattato come un miss: la cache non deve mai
+    far fallire una richiesta.
+
+    Se un'invalidazione fallisce (per esempio "database is locked" con molti
+    worker che scrivono insieme) viene cambiata l'epoca, un valore casuale in
+    un file accanto al database: ogni voce ricorda l'epoca in cui il report è
+    stato calcolato e quelle di un'epoca precedente non vengono più servite.
+
+    Un hit è solo una lettura: l'ultimo accesso della voce, usato per
+    l'eliminazione, viene aggiornato al massimo una volta ogni
+    `intervallo_accesso` secondi, perché ogni UPDATE prende il lock di
+    scrittura del file condiviso da tutti i worker.
+    """
+
+    def __init__(self, path, max_bytes, intervallo_accesso=60):
+        self.path = path
+        self.path_epoca = path + '.epoca'
+        self.max_bytes = max_bytes
+        self.intervallo_accesso = intervallo_accesso
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            # File creato da una versione senza la colonna epoca: si riparte vuoti
+            colonne = [c[1] for c in conn.execute('PRAGMA table_info(voci)')]
+            if colonne and 'epoca' not in colonne:
+                conn.execute('DROP TABLE voci')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS voci (
+                    chiave TEXT PRIMARY KEY,
+                    dipendente_id INTEGER,
+                    data_inizio TEXT NOT NULL,
+                    data_fine TEXT NOT NULL,
+                    valore TEXT NOT NULL,
+                    epoca TEXT NOT NULL,
+                    dimensione INTEGER NOT NULL,
+                    ultimo_accesso REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_voci_accesso ON voci(ultimo_accesso);
+                CREATE TABLE IF NOT EXISTS generazione (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    valore INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO generazione (id, valore) VALUES (1, 0);
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, attr):
+        with self._stats_lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+        CACHE_REPORT.labels(attr[1:]).inc()
+
+    def _epoca(self):
+        try:
+            with open(self.path_epoca) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def _nuova_epoca(self):
+        # Valore sempre diverso (non un contatore): due worker che la cambiano
+        # insieme non possono scrivere lo stesso valore
+        tmp = f"{self.path_epoca}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, 'w') as f:
+            f.write(os.urandom(8).hex())
+        os.replace(tmp, self.path_epoca)
+
+    def generazione(self):
+        """Contatore delle invalidazioni ed epoca, da leggere prima di calcolare un report."""
+        try:
+            epoca = self._epoca()
+            return self._conn().execute('SELECT valore FROM generazione WHERE id = 1').fetchone()[0], epoca
+        except (sqlite3.Error, OSError):
+            self._count('_errors')
+            return None
+
+    def get(self, chiave):
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                'SELECT valore, ultimo_accesso FROM voci WHERE chiave = ? AND epoca = ?', (chiave, self._epoca())
+            ).fetchone()
+            if row is None:
+                self._count('_misses')
+                return None
+            adesso = time.time()
+            if adesso - row[1] >= self.intervallo_accesso:
+                # Solo per l'ordine di eliminazione: se il file è bloccato da
+                # un altro worker il valore viene servito lo stesso
+                try:
+                    conn.execute('UPDATE voci SET ultimo_accesso = ? WHERE chiave = ?', (adesso, chiave))
+                except sqlite3.OperationalError:
+                    pass
+            self._count('_hits')
+            return row[0]
+        except (sqlite3.Error, OSError):
+            self._count('_errors')
+            return None
+
+    def put(self, chiave, valore, dipendente_id, data_inizio, data_fine, generazione):
+        """Memorizza un report calcolato.
+
+        Se nel frattempo c'è stata un'invalidazione (generazione o epoca
+        cambiata) il valore potrebbe essere già vecchio e non viene salvato.
+        """
+        if generazione is None:
+            return
+        generazione, epoca = generazione
+        dimensione = len(valore)
+        if dimensione > self.max_bytes:
+            return
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                attuale = conn.execute('SELECT valore FROM generazione WHERE id = 1').fetchone()[0]
+                if attuale != generazione or self._epoca() != epoca:
+                    conn.execute('ROLLBACK')
+                    return
+                conn.execute(
+                    'INSERT OR REPLACE INTO voci (chiave, dipendente_id, data_inizio, data_fine, valore, epoca, dimensione, ultimo_accesso) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (chiave, dipendente_id, data_inizio, data_fine, valore, epoca, dimensione, time.time())
+                )
+                # Rispetta il budget eliminando le voci meno usate di recente
+                totale = conn.execute('SELECT COALESCE(SUM(dimensione), 0) FROM voci').fetchone()[0]
+                while totale > self.max_bytes:
+                    vecchie = conn.execute(
+                        'SELECT chiave, dimensione FROM voci ORDER BY ultimo_accesso LIMIT 20'
+                    ).fetchall()
+                    if not vecchie:
+                        break
+                    conn.executemany('DELETE FROM voci WHERE chiave = ?', [(v[0],) for v in vecchie])
+                    totale -= sum(v[1] for v in vecchie)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except (sqlite3.Error, OSError):
+            self._count('_errors')
+
+    def invalida(self, dipendente_id=None, giorno=None):
+        """Elimina i report che includono il giorno indicato per quel dipendente.
+
+        I report su tutti i dipendenti (dipendente_id NULL) vengono sempre
+        considerati. Senza argomenti svuota l'intera cache. Se il database non
+        è scrivibile cambia l'epoca, che invalida tutte le voci esistenti.
+        """
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'DELETE FROM voci WHERE (? IS NULL OR dipendente_id IS NULL OR dipendente_id = ?) '
+                    'AND (? IS NULL OR (data_inizio <= ? AND data_fine >= ?))',
+                    (dipendente_id, dipendente_id, giorno, giorno, giorno)
+                )
+                conn.execute('UPDATE generazione SET valore = valore + 1 WHERE id = 1')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            self._count('_errors')
+            try:
+                self._nuova_epoca()
+            except OSError as e:
+                print(f"Report cache: invalidation failed: {e}")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {'hits': self._hits, 'misses': self._misses, 'errors': self._errors}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else None
+        try:
+            voci, byte = self._conn().execute(
+                'SELECT COUNT(*), COALESCE(SUM(dimensione), 0) FROM voci'
+            ).fetchone()
+            stats.update({'entries': voci, 'bytes': byte, 'max_bytes': self.max_bytes})
+        except sqlite3.Error:
+            pass
+        return stats
+
+
+def invalida_cache_locale():
+    """Cambia l'epoca della cache dei report di questa macchina, se esiste.
+
+    Da chiamare dopo il commit negli script che scrivono sul database fuori
+    dall'applicazione (import, migrazione, ricostruzione di ore_giornaliere):
+    i worker smettono di servire i report calcolati prima.
+    """
+    path = os.environ.get('REPORT_CACHE_PATH') or PERCORSO_PREDEFINITO
+    if os.path.exists(path):
+        ReportCache(path, 0)._nuova_epoca()
+        print(f"Report cache invalidated: {path}")
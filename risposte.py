@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+from datetime import date
+
+import orjson
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import parse_etags
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Serializzazione JSON, ETag e compressione delle risposte, condivise dall'app
+# Flask (app.py) e dal server asincrono (asgi.py).
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider di Flask basato su orjson.
+
+    Stesso risultato del provider predefinito (chiavi ordinate, Decimal come
+    stringa, date nel formato HTTP), salvo i caratteri non ASCII, scritti in
+    UTF-8 invece che come sequenze \\u.
+    """
+
+    OPZIONI = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps_bytes(self, obj):
+        opzioni = self.OPZIONI
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            opzioni |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=opzioni)
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
+
+
+# Risposte testuali da comprimere; le altre (immagini, xlsx) sono già compresse
+TIPI_COMPRIMIBILI = {
+    'application/json', 'application/javascript', 'text/javascript',
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'image/svg+xml',
+}
+
+
+def comprimibile(mimetype, dimensione, soglia):
+    """True se la risposta va compressa (soglia 0 = compressione disattivata)."""
+    return bool(soglia) and dimensione is not None and dimensione >= soglia and mimetype in TIPI_COMPRIMIBILI
+
+
+def negozia(accept_encodings):
+    """Codifica preferita dal client tra brotli (se installato) e gzip, o None."""
+    return accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+
+# Estensioni dei file precompressi da build_static.py
+ESTENSIONI = {'br': '.br', 'gzip': '.gz'}
+
+
+def comprimi(dati, codifica, livello_gzip=6, qualita_brotli=4):
+    if codifica == 'br':
+        return brotli.compress(dati, quality=qualita_brotli)
+    # mtime fisso: stesso contenuto, stessi byte
+    return gzip.compress(dati, compresslevel=livello_gzip, mtime=0)
+
+
+def comprimi_risposta(dati, mimetype, accept_encodings, config):
+    """Comprime il corpo di una risposta secondo Accept-Encoding e la configurazione dell'app.
+
+    Restituisce (dati, codifica, vary): codifica è None se il corpo resta non
+    compresso; vary è True se la risposta dipende da Accept-Encoding (tipo
+    comprimibile e sopra COMPRESSION_MIN_BYTES), anche quando il client non
+    accetta nessuna codifica.
+    """
+    if not comprimibile(mimetype, len(dati), config['COMPRESSION_MIN_BYTES']):
+        return dati, None, False
+    codifica = negozia(accept_encodings)
+    if codifica is None:
+        return dati, None, True
+    dati = comprimi(dati, codifica, config['COMPRESSION_GZIP_LEVEL'], config['COMPRESSION_BROTLI_QUALITY'])
+    return dati, codifica, True
+
+
+# Le API di sola lettura vengono sempre riconvalidate, e mai salvate da cache condivise
+CACHE_CONTROL_DATI = 'private, no-cache'
+
+
+def etag_dati(full_path, versione):
+    """ETag forte di una risposta legata alla versione dei dati.
+
+    Include la data odierna: i periodi relativi ("ultima settimana") cambiano
+    ogni giorno anche senza scritture.
+    """
+    return hashlib.sha1(f"{full_path}|{versione}|{date.today()}".encode()).hexdigest()
+
+
+def non_modificata(if_none_match, etag):
+    """True se l'header If-None-Match contiene l'ETag (confronto debole: le
+    risposte compresse hanno l'ETag debole)."""
+    return parse_etags(if_none_match).contains_weak(etag)
@@ -1,4 +1,5 @@
 #!/bin/bash
 # Script di avvio per la produzione
 # Avvia l'applicazione usando Gunicorn su porta 5003 con 4 worker
-gunicorn -w 4 -b 0.0.0.0:5003 "app:create_app()"
+# (i thread servono anche a tenere aperti i flussi SSE dei chioschi)
+gunicorn -w 4 --threads 16 -b 0.0.0.0:5003 "app:create_app()"
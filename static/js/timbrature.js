@@ -9,23 +9,62 @@ document.addEventListener('DOMContentLoaded', function () {
 
     // Variabili globali
     let dipendenteSelezionato = null;
+    let statoDipendenti = new Map();
+    let streamAttivo = false;
+    let invioInCorso = false;
 
-    // Carica i dipendenti all'avvio
-    caricaDipendenti();
+    // Coda offline (IndexedDB): le timbrature non inviate restano qui con
+    // l'orario originale e vengono spedite tutte insieme al ritorno della rete
+    const codaDB = apriCoda();
+    codaDB.catch(error => console.warn('Coda offline non disponibile:', error));
+
+    // Usa lo stato incluso nella pagina (altrimenti lo carica) e resta in ascolto delle variazioni
+    const statoIniziale = document.getElementById('stato-dipendenti');
+    if (statoIniziale) {
+        aggiornaDipendenti(JSON.parse(statoIniziale.textContent));
+    } else {
+        caricaDipendenti();
+    }
+    avviaStream();
+
+    // Invia la coda rimasta da una sessione precedente, al ritorno della rete e periodicamente
+    inviaCoda();
+    window.addEventListener('online', inviaCoda);
+    setInterval(inviaCoda, 30000);
 
     // Event listener per il pulsante di conferma timbratura
     confermaTimbraturaBtn.addEventListener('click', function () {
         if (!dipendenteSelezionato) return;
 
-        // Richiesta AJAX per registrare la timbratura
+        const evento = {
+            id: nuovoIdTimbratura(),
+            dipendente_id: Number(dipendenteSelezionato),
+            timestamp: timestampLocale(new Date())
+        };
+
+        // Se ci sono timbrature in coda la nuova va in fondo, per mantenere l'ordine
+        leggiCoda()
+            .then(coda => coda.length > 0 || !navigator.onLine)
+            .catch(() => false)
+            .then(usaCoda => usaCoda ? accodaTimbratura(evento) : registraTimbratura(evento));
+    });
+
+    // Richiesta AJAX per registrare la timbratura
+    function registraTimbratura(evento) {
         const formData = new FormData();
-        formData.append('dipendente_id', dipendenteSelezionato);
+        formData.append('dipendente_id', evento.dipendente_id);
+        // Stesso id della coda: se la risposta va persa e la timbratura viene
+        // rinviata dalla coda, il server la riconosce come già registrata
+        formData.append('client_id', evento.id);
 
         fetch('/timbratura', {
             method: 'POST',
             body: formData
         })
-            .then(response => response.json())
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                return response.json();
+            })
             .then(data => {
                 if (data.success) {
                     // Chiudi il modal
@@ -35,25 +74,114 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (toastMessage) toastMessage.textContent = data.message;
                     timbraToast.show();
 
-                    // Ricarica i dipendenti per aggiornare lo stato
-                    setTimeout(caricaDipendenti, 500);
+                    // Con lo stream attivo l'aggiornamento arriva dal server,
+                    // altrimenti ricarica i dipendenti per aggiornare lo stato
+                    if (!streamAttivo) setTimeout(caricaDipendenti, 500);
                 } else {
                     alert('Si è verificato un errore durante la registrazione della timbratura');
                 }
             })
+            .catch(error => {
+                // Rete o server non raggiungibili: la timbratura non va persa
+                console.error('Errore:', error);
+                accodaTimbratura(evento);
+            });
+    }
+
+    function accodaTimbratura(evento) {
+        operazioneCoda('readwrite', store => store.put(evento))
+            .then(() => {
+                timbraModal.hide();
+                aggiornaPresenzaLocale(evento);
+                if (toastMessage) toastMessage.textContent = 'Timbratura salvata: verrà inviata appena torna la connessione';
+                timbraToast.show();
+                inviaCoda();
+            })
             .catch(error => {
                 console.error('Errore:', error);
                 alert('Si è verificato un errore durante la registrazione della timbratura');
             });
-    });
+    }
+
+    // Invia l'intera coda in una sola richiesta; il server ignora gli id già ricevuti
+    function inviaCoda() {
+        if (invioInCorso || !navigator.onLine) return;
+        invioInCorso = true;
+
+        leggiCoda()
+            .then(coda => {
+                if (coda.length === 0) return;
+                return fetch('/api/timbrature/batch', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ timbrature: coda })
+                })
+                    .then(response => {
+                        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                        return response.json();
+                    })
+                    .then(data => operazioneCoda('readwrite', store => {
+                        data.risultati.forEach(r => store.delete(r.id));
+                    }))
+                    .then(caricaDipendenti);
+            })
+            .catch(error => console.warn('Coda timbrature non inviata:', error))
+            .finally(() => { invioInCorso = false; });
+    }
+
+    // Finché la timbratura è in coda mostra comunque il cambio di stato
+    function aggiornaPresenzaLocale(evento) {
+        const dip = statoDipendenti.get(evento.dipendente_id);
+        if (!dip) return;
+        const [data, ora] = evento.timestamp.split('T');
+        dip.presente = !dip.presente;
+        dip.inizio = dip.presente ? `${data.split('-').reverse().join('/')} ${ora}` : null;
+        renderizzaDipendenti(Array.from(statoDipendenti.values()));
+    }
+
+    function apriCoda() {
+        return new Promise((resolve, reject) => {
+            if (!window.indexedDB) {
+                reject(new Error('IndexedDB non disponibile'));
+                return;
+            }
+            const richiesta = indexedDB.open('timbraceck', 1);
+            richiesta.onupgradeneeded = () => richiesta.result.createObjectStore('coda', { keyPath: 'id' });
+            richiesta.onsuccess = () => resolve(richiesta.result);
+            richiesta.onerror = () => reject(richiesta.error);
+        });
+    }
+
+    function operazioneCoda(modo, operazione) {
+        return codaDB.then(db => new Promise((resolve, reject) => {
+            const tx = db.transaction('coda', modo);
+            const richiesta = operazione(tx.objectStore('coda'));
+            tx.oncomplete = () => resolve(richiesta ? richiesta.result : undefined);
+            tx.onerror = () => reject(tx.error);
+        }));
+    }
+
+    function leggiCoda() {
+        return operazioneCoda('readonly', store => store.getAll());
+    }
+
+    function nuovoIdTimbratura() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+
+    // Orario locale del chiosco (stesso fuso del server), senza conversione in UTC
+    function timestampLocale(d) {
+        const p = n => String(n).padStart(2, '0');
+        return `${d.getFullYear()}-${p(d.getMonth() + 1)}-${p(d.getDate())}T` +
+            `${p(d.getHours())}:${p(d.getMinutes())}:${p(d.getSeconds())}`;
+    }
 
     // Funzione per caricare i dipendenti
     function caricaDipendenti() {
         fetch('/api/stato-dipendenti')
             .then(response => response.json())
-            .then(data => {
-                renderizzaDipendenti(data);
-            })
+            .then(aggiornaDipendenti)
             .catch(error => {
                 console.error('Errore:', error);
                 dipendenteContainer.innerHTML = `
@@ -67,6 +195,51 @@ document.addEventListener('DOMContentLoaded', function () {
             });
     }
 
+    function aggiornaDipendenti(data) {
+        statoDipendenti = new Map(data.map(dip => [dip.id, dip]));
+        renderizzaDipendenti(Array.from(statoDipendenti.values()));
+    }
+
+    // Aggiornamenti push (Server-Sent Events): il server invia solo
+    // lo stato del dipendente che è cambiato
+    function avviaStream() {
+        if (!window.EventSource) return;
+
+        const source = new EventSource('/api/stato-dipendenti/stream');
+        let connessioni = 0;
+
+        source.addEventListener('open', function () {
+            // Alla riconnessione potremmo aver perso delle variazioni
+            if (connessioni++ > 0) caricaDipendenti();
+            streamAttivo = true;
+        });
+
+        source.addEventListener('stato', function (event) {
+            const dip = JSON.parse(event.data);
+            if (dip.eliminato) {
+                statoDipendenti.delete(dip.id);
+            } else {
+                statoDipendenti.set(dip.id, dip);
+            }
+            renderizzaDipendenti(Array.from(statoDipendenti.values()));
+        });
+
+        source.addEventListener('reload', caricaDipendenti);
+
+        source.addEventListener('error', function () {
+            // Il browser riprova da solo; nel frattempo si torna al ricaricamento completo
+            streamAttivo = false;
+            if (source.readyState === EventSource.CLOSED) {
+                // Risposta diversa da 200 (es. 503, troppi schermi collegati):
+                // il browser non riprova, quindi si aggiorna l'elenco e si riprova più tardi
+                setTimeout(function () {
+                    caricaDipendenti();
+                    avviaStream();
+                }, 60000);
+            }
+        });
+    }
+
     // Funzione per renderizzare i dipendenti
     function renderizzaDipendenti(dipendenti) {
         // Ordina i dipendenti per cognome, nome
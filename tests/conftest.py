@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+
+# I moduli dell'applicazione sono nella radice del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class CursoreFinto:
+    def __init__(self, connessione):
+        self.connessione = connessione
+        self.righe = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.connessione.query.append((sql, params))
+        self.righe = self.connessione.risposta(sql, params)
+        self.rowcount = len(self.righe)
+
+    def fetchone(self):
+        return self.righe[0] if self.righe else None
+
+    def fetchall(self):
+        return self.righe
+
+    def close(self):
+        pass
+
+
+class DatabaseFinto:
+    """Connessione psycopg2 finta: registra le query (e i commit) e restituisce le righe di risposta(sql, params)."""
+
+    def __init__(self):
+        self.query = []
+        self.risposta = lambda sql, params: [{'versione': 1}] if 'versione_dati' in sql else []
+
+    def cursor(self, cursor_factory=None):
+        return CursoreFinto(self)
+
+    def commit(self):
+        self.query.append(('COMMIT', None))
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db_finto(monkeypatch):
+    # La connessione della richiesta (g.db) diventa un DatabaseFinto; niente cache dei report
+    import app as app_module
+    from db_wrapper import NeonDB
+
+    connessione = DatabaseFinto()
+
+    def get_db():
+        if 'db' not in app_module.g:
+            app_module.g.db = NeonDB(connessione)
+        return app_module.g.db
+
+    monkeypatch.setattr(app_module, 'get_db', get_db)
+    monkeypatch.setattr(app_module, 'get_report_cache', lambda: None)
+    return connessione
+
+
+@pytest.fixture
+def client_admin():
+    import app as app_module
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+        s['role'] = 'admin'
+    return client
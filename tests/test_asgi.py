@@ -0,0 +1,126 @@
+import asyncio
+import os
+import subprocess
+import sys
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('starlette')
+pytest.importorskip('a2wsgi')
+
+import app as app_module
+import asgi
+
+# Modalità asincrona (asgi.py) senza database: le query del pool asincrono sono
+# sostituite da righe fisse, le stesse della connessione finta delle rotte Flask.
+
+RIGHE_TOTALE = [{'id': i, 'nome': f'Nome{i}', 'cognome': f'Cognome{i}', 'ore_totali': Decimal('12.345') * i}
+                for i in range(1, 4)]
+
+
+def righe(sql, params):
+    return [{'versione': 7}] if 'versione_dati' in sql else RIGHE_TOTALE
+
+
+def chiama(path, query='', headers=None):
+    # Una richiesta GET all'app ASGI: (status, header, corpo)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    messaggi = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(messaggio):
+        messaggi.append(messaggio)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    inizio = next(m for m in messaggi if m['type'] == 'http.response.start')
+    corpo = b''.join(m.get('body', b'') for m in messaggi if m['type'] == 'http.response.body')
+    return inizio['status'], {k.decode().lower(): v.decode() for k, v in inizio['headers']}, corpo
+
+
+def cookie_sessione(**sessione):
+    nome = app_module.app.config['SESSION_COOKIE_NAME']
+    return {'Cookie': f'{nome}={asgi.sessioni.dumps(sessione)}'}
+
+
+@pytest.fixture
+def query_async(monkeypatch):
+    eseguite = []
+
+    async def fetch(endpoint, stats, sql, params):
+        eseguite.append(sql)
+        return righe(sql, params)
+
+    monkeypatch.setattr(asgi, 'fetch', fetch)
+    monkeypatch.setattr(asgi, 'get_report_cache', lambda: None)
+    return eseguite
+
+
+def test_senza_sessione_risponde_flask(query_async):
+    status, headers, _ = chiama('/api/report/totale', 'periodo=mese')
+    assert status == 302 and '/login' in headers['location']
+    assert query_async == []
+
+
+def test_stesso_report_di_flask(query_async, db_finto, client_admin):
+    db_finto.risposta = righe
+    flask = client_admin.get('/api/report/totale?periodo=mese')
+
+    status, headers, corpo = chiama('/api/report/totale', 'periodo=mese',
+                                    cookie_sessione(user_id=1, role='admin'))
+    assert status == 200
+    assert corpo == flask.data
+    assert headers['etag'] == flask.headers['ETag']
+    assert len(query_async) == 2
+
+    # Stessa versione dei dati: 304 senza eseguire il report
+    status, _, corpo = chiama('/api/report/totale', 'periodo=mese',
+                              dict(cookie_sessione(user_id=1, role='admin'), **{'If-None-Match': headers['etag']}))
+    assert (status, corpo) == (304, b'')
+    assert len(query_async) == 3
+
+
+def test_parametro_non_valido(query_async):
+    status, headers, corpo = chiama('/api/report/dipendente/1', 'limit=abc',
+                                    cookie_sessione(user_id=1, role='admin'))
+    assert status == 400 and 'etag' not in headers
+    assert b'limit non valido' in corpo
+
+
+def test_import_senza_connessioni():
+    # Né asgi.py né app.py aprono il pool psycopg2 o creano partizioni all'import
+    radice = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, DATABASE_URL='postgresql://127.0.0.1:1/assente')
+    risultato = subprocess.run(
+        [sys.executable, '-c', 'import psycopg2; psycopg2.connect = None; import asgi, app; print(app.db_pool)'],
+        cwd=radice, env=env, check=True, capture_output=True, text=True)
+    assert risultato.stdout.strip() == 'None'
+    assert 'Error' not in risultato.stdout + risultato.stderr
+
+
+def test_lifespan_avvia_il_worker(monkeypatch):
+    eventi = []
+
+    async def apri():
+        eventi.append('pool asincrono')
+
+    async def chiudi():
+        eventi.append('chiuso')
+
+    monkeypatch.setattr(asgi, 'avvia', lambda: eventi.append('avvia'))
+    monkeypatch.setattr(asgi.pool, 'open', apri)
+    monkeypatch.setattr(asgi.pool, 'close', chiudi)
+
+    async def ciclo():
+        async with asgi.lifespan(asgi.app):
+            eventi.append('richieste')
+
+    asyncio.run(ciclo())
+    assert eventi == ['avvia', 'pool asincrono', 'richieste', 'chiuso']
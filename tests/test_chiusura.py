@@ -0,0 +1,132 @@
+import os
+from datetime import date
+
+import psycopg2
+import pytest
+
+import app as app_module
+from db_wrapper import NeonDB
+
+# Chiusura mensile. Il ciclo di app.chiudi_mesi è provato con la connessione
+# finta; la funzione chiudi_mesi() e il blocco delle scritture sui mesi chiusi
+# con DATABASE_URL, chiudendo gennaio 2000 in una transazione annullata alla fine.
+
+richiede_db = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL not set')
+
+MESE_PROVA = date(2000, 1, 1)
+
+
+def test_un_mese_per_transazione(db_finto):
+    def risposta(sql, params):
+        if 'FROM mesi_chiusi' in sql:
+            return [{'fine': None}]
+        if 'MIN(inizio)' in sql:
+            return [{'primo': date(2025, 11, 1)}]
+        return [{'chiusi': 1}]
+    db_finto.risposta = risposta
+
+    chiusi = []
+    app_module.chiudi_mesi(NeonDB(db_finto), date(2026, 1, 1), 'admin', chiusi)
+
+    assert chiusi == [date(2025, 11, 1), date(2025, 12, 1), date(2026, 1, 1)]
+    chiusure = [params for sql, params in db_finto.query if 'chiudi_mesi' in sql]
+    assert chiusure == [(m, 'admin') for m in chiusi]
+    # Un commit dopo ogni mese
+    assert [sql for sql, _ in db_finto.query][-6:] == ['SELECT chiudi_mesi(%s, %s) AS chiusi', 'COMMIT'] * 3
+
+
+@pytest.fixture
+def conn():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    yield conn
+    conn.rollback()
+    conn.close()
+
+
+@pytest.fixture
+def dipendente(conn):
+    # Dipendente di prova con un turno di 8 ore nel mese da chiudere (non salvati)
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM mesi_chiusi)")
+        if cur.fetchone()[0]:
+            pytest.skip('months are already closed in this database')
+        cur.execute('''
+            INSERT INTO dipendenti (nome, cognome, email, data_assunzione)
+            VALUES ('Test', 'Chiusura', 'test-chiusura@example.com', '2000-01-01') RETURNING id
+        ''')
+        dipendente_id = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO timbrature (dipendente_id, inizio, fine)
+            VALUES (%s, '2000-01-10 08:00', '2000-01-10 16:00') RETURNING id
+        ''', (dipendente_id,))
+        return dipendente_id, cur.fetchone()[0]
+
+
+@richiede_db
+@pytest.mark.parametrize('mese', [date.today().replace(day=1), date(date.today().year + 1, 1, 1)])
+def test_solo_mesi_passati(conn, mese):
+    with conn.cursor() as cur, pytest.raises(psycopg2.errors.ObjectNotInPrerequisiteState):
+        cur.execute('SELECT chiudi_mesi(%s, %s)', (mese, 'test'))
+
+
+@richiede_db
+def test_turni_aperti(conn, dipendente):
+    dipendente_id, _ = dipendente
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO timbrature (dipendente_id, inizio) VALUES (%s, '2000-01-11 08:00')",
+                    (dipendente_id,))
+        with pytest.raises(psycopg2.errors.ObjectNotInPrerequisiteState, match='Turni ancora aperti'):
+            cur.execute('SELECT chiudi_mesi(%s, %s)', (MESE_PROVA, 'test'))
+
+
+@pytest.fixture
+def mese_chiuso(conn, dipendente, monkeypatch):
+    dipendente_id, timbratura_id = dipendente
+    with conn.cursor() as cur:
+        cur.execute('SELECT chiudi_mesi(%s, %s)', (MESE_PROVA, 'test'))
+        assert cur.fetchone()[0] == 1
+        cur.execute("INSERT INTO timbrature (dipendente_id, inizio, fine) VALUES (%s, now(), now()) RETURNING id",
+                    (dipendente_id,))
+        aperta_id = cur.fetchone()[0]
+    # Le rotte usano la transazione del test, che contiene la chiusura (in caso
+    # di errore NeonDB la annulla, quindi una sola scrittura per test)
+    db = NeonDB(conn)
+    # Nessun commit, anche se una scrittura dovesse riuscire
+    db.commit = lambda: None
+    monkeypatch.setattr(app_module, 'get_db', lambda: db)
+    monkeypatch.setattr(app_module, 'invalida_report', lambda *args: None)
+    return dipendente_id, timbratura_id, aperta_id
+
+
+@richiede_db
+def test_snapshot(conn, mese_chiuso):
+    with conn.cursor() as cur:
+        cur.execute('SELECT ore, n_chiuse FROM ore_giornaliere_chiuse WHERE dipendente_id = %s', (mese_chiuso[0],))
+        assert cur.fetchall() == [(8, 1)]
+        cur.execute('SELECT ore FROM ore_mensili_chiuse WHERE dipendente_id = %s AND mese = %s',
+                    (mese_chiuso[0], MESE_PROVA))
+        assert cur.fetchall() == [(8,)]
+
+
+@richiede_db
+@pytest.mark.parametrize('scrittura', ['modifica', 'sposta', 'elimina'])
+def test_scritture_su_mese_chiuso(mese_chiuso, client_admin, scrittura):
+    _, timbratura_id, aperta_id = mese_chiuso
+    if scrittura == 'modifica':
+        risposta = client_admin.put(f'/api/timbratura/{timbratura_id}',
+                                    json={'data': '2000-01-10', 'inizio': '09:00', 'fine': '16:00'})
+    elif scrittura == 'sposta':
+        # Da un mese aperto dentro il mese chiuso
+        risposta = client_admin.put(f'/api/timbratura/{aperta_id}',
+                                    json={'data': '2000-01-12', 'inizio': '08:00', 'fine': '16:00'})
+    else:
+        risposta = client_admin.delete(f'/api/timbratura/{timbratura_id}')
+    assert risposta.status_code == 409
+    assert risposta.get_json()['mese_chiuso'] is True
+    assert '01/2000 è chiuso' in risposta.get_json()['error']
+
+
+@richiede_db
+def test_dipendente_con_mesi_chiusi(mese_chiuso, client_admin):
+    risposta = client_admin.delete(f'/admin/dipendente/{mese_chiuso[0]}')
+    assert risposta.status_code == 409
@@ -0,0 +1,85 @@
+import gzip
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import parse_accept_header
+
+import app as app_module
+import risposte
+
+# Serializzazione JSON e compressione delle risposte: negoziazione di
+# Accept-Encoding, ETag debole e Vary sulle risposte compresse, 304.
+
+URL = '/api/report/totale?periodo=mese'
+
+
+def accept(valore):
+    return parse_accept_header(valore)
+
+
+def test_negozia():
+    assert risposte.negozia(accept('gzip, deflate, br')) == ('br' if risposte.brotli else 'gzip')
+    assert risposte.negozia(accept('gzip')) == 'gzip'
+    assert risposte.negozia(accept('br;q=0, gzip;q=0.5')) == 'gzip'
+    assert risposte.negozia(accept('identity')) is None
+    assert risposte.negozia(accept('')) is None
+
+
+def test_json_come_il_provider_predefinito():
+    dati = {'ore': Decimal('12.50'), 'giorno': date(2026, 3, 1), 'b': [1, None, True], 'a': 1.5}
+    assert app_module.app.json.loads(app_module.app.json.dumps(dati)) == \
+        DefaultJSONProvider(app_module.app).loads(DefaultJSONProvider(app_module.app).dumps(dati))
+    assert app_module.app.json.dumps({'ore': Decimal('12.50')}) == '{"ore":"12.50"}'
+
+
+@pytest.fixture
+def report_grande(db_finto):
+    # Abbastanza righe da superare COMPRESSION_MIN_BYTES
+    righe = [{'id': i, 'nome': f'Nome{i}', 'cognome': f'Cognome{i}', 'ore_totali': Decimal('160.25')}
+             for i in range(100)]
+    db_finto.risposta = lambda sql, params: [{'versione': 1}] if 'versione_dati' in sql else righe
+    return db_finto
+
+
+@pytest.mark.parametrize('codifica', ['br', 'gzip'])
+def test_risposta_compressa(report_grande, client_admin, codifica):
+    if codifica == 'br' and risposte.brotli is None:
+        pytest.skip('brotli not installed')
+    originale = client_admin.get(URL, headers={'Accept-Encoding': 'identity'})
+    compressa = client_admin.get(URL, headers={'Accept-Encoding': codifica})
+
+    assert compressa.headers['Content-Encoding'] == codifica
+    assert 'Accept-Encoding' in compressa.headers['Vary']
+    decompressa = risposte.brotli.decompress(compressa.data) if codifica == 'br' else gzip.decompress(compressa.data)
+    assert decompressa == originale.data
+    # Stessa versione dei dati: ETag debole uguale a quello forte della risposta non compressa
+    assert compressa.headers['ETag'] == 'W/' + originale.headers['ETag']
+
+
+def test_risposta_non_compressa(report_grande, client_admin):
+    risposta = client_admin.get(URL, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in risposta.headers
+    assert 'Accept-Encoding' in risposta.headers['Vary']
+    assert not risposta.headers['ETag'].startswith('W/')
+
+
+def test_sotto_soglia_o_disattivata(report_grande, client_admin, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'COMPRESSION_MIN_BYTES', 0)
+    risposta = client_admin.get(URL, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in risposta.headers
+    assert 'Accept-Encoding' not in risposta.headers.get('Vary', '')
+
+    monkeypatch.setitem(app_module.app.config, 'COMPRESSION_MIN_BYTES', 10 ** 6)
+    assert 'Content-Encoding' not in client_admin.get(URL, headers={'Accept-Encoding': 'gzip'}).headers
+
+
+@pytest.mark.parametrize('codifica', ['gzip', 'identity'])
+def test_304(report_grande, client_admin, codifica):
+    etag = client_admin.get(URL, headers={'Accept-Encoding': codifica}).headers['ETag']
+    query = len(report_grande.query)
+    risposta = client_admin.get(URL, headers={'Accept-Encoding': codifica, 'If-None-Match': etag})
+    assert risposta.status_code == 304 and risposta.data == b''
+    # Solo la lettura della versione dei dati
+    assert len(report_grande.query) == query + 1
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+from prometheus_client import REGISTRY
+
+import app as app_module
+
+# /metrics: accesso con token, contatori delle richieste e somma dei valori
+# scritti dai worker in PROMETHEUS_MULTIPROC_DIR.
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_token(monkeypatch):
+    client = app_module.app.test_client()
+    monkeypatch.setitem(app_module.app.config, 'METRICS_TOKEN', '')
+    assert client.get('/metrics').status_code == 200
+
+    monkeypatch.setitem(app_module.app.config, 'METRICS_TOKEN', 'segreto')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer altro'}).status_code == 401
+    risposta = client.get('/metrics', headers={'Authorization': 'Bearer segreto'})
+    assert risposta.status_code == 200
+    assert b'timbraceck_http_requests_total' in risposta.data
+
+
+def test_contatore_richieste():
+    etichette = {'endpoint': 'login', 'method': 'GET', 'status': '200'}
+    prima = REGISTRY.get_sample_value('timbraceck_http_requests_total', etichette) or 0
+    assert app_module.app.test_client().get('/login').status_code == 200
+    assert REGISTRY.get_sample_value('timbraceck_http_requests_total', etichette) == prima + 1
+
+
+def test_somma_dei_worker(tmp_path):
+    # Due "worker" registrano una timbratura ciascuno; un terzo risponde a /metrics
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', "import metrics; metrics.TIMBRATURE.labels('ingresso', 'chiosco').inc()"],
+                       cwd=RADICE, env=env, check=True)
+    risultato = subprocess.run([sys.executable, '-c', 'import metrics; print(metrics.esporta()[0].decode())'],
+                               cwd=RADICE, env=env, check=True, capture_output=True, text=True)
+    assert 'timbraceck_punches_total{origine="chiosco",tipo="ingresso"} 2.0' in risultato.stdout
@@ -0,0 +1,64 @@
+import sys
+
+import pytest
+
+import migrate_to_neon
+from conftest import DatabaseFinto
+
+# migrate_to_neon.py con connessioni finte: i trigger di timbrature disattivati
+# per la copia vengono sempre riattivati, e le tabelle derivate ricostruite,
+# anche se la copia si interrompe.
+
+
+@pytest.fixture
+def migrazione(monkeypatch, tmp_path):
+    pg = DatabaseFinto()
+    monkeypatch.setattr(sys, 'argv', ['migrate_to_neon.py'])
+    monkeypatch.setattr(migrate_to_neon, 'POSTGRES_DB_URL', 'postgresql://finto')
+    (tmp_path / 'timbrature.db').touch()
+    monkeypatch.setattr(migrate_to_neon, 'SQLITE_DB_PATH', str(tmp_path / 'timbrature.db'))
+    monkeypatch.setattr(migrate_to_neon.psycopg2, 'connect', lambda url: pg)
+    monkeypatch.setattr(migrate_to_neon, 'invalida_cache_locale', lambda: None)
+
+    def prepara(pg_conn, sqlite_conn, ricomincia):
+        pg_conn.cursor().execute("ALTER TABLE timbrature DISABLE TRIGGER USER")
+        pg_conn.commit()
+
+    monkeypatch.setattr(migrate_to_neon, 'prepara', prepara)
+    return pg
+
+
+def eseguite(pg):
+    return [sql.strip() for sql, _ in pg.query]
+
+
+def test_trigger_riattivati_dopo_la_copia(migrazione, monkeypatch, capsys):
+    monkeypatch.setattr(migrate_to_neon, 'copia_tabelle', lambda chunk, processi: 10)
+    migrate_to_neon.migrate()
+
+    sql = eseguite(migrazione)
+    assert sql.index("ALTER TABLE timbrature ENABLE TRIGGER USER") > sql.index("ALTER TABLE timbrature DISABLE TRIGGER USER")
+    assert sql[-1] == 'COMMIT'
+    assert 'Migration completed successfully' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('errore', [RuntimeError('connessione persa'), KeyboardInterrupt()])
+def test_trigger_riattivati_se_la_copia_fallisce(migrazione, monkeypatch, errore):
+    def copia_tabelle(chunk, processi):
+        raise errore
+
+    monkeypatch.setattr(migrate_to_neon, 'copia_tabelle', copia_tabelle)
+    if isinstance(errore, KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            migrate_to_neon.migrate()
+    else:
+        migrate_to_neon.migrate()
+
+    sql = eseguite(migrazione)
+    riattivati = sql.index("ALTER TABLE timbrature ENABLE TRIGGER USER")
+    # Dopo la riattivazione: ricostruzione di ore_giornaliere e presenze_correnti nella stessa transazione
+    dopo = sql[riattivati:]
+    assert 'DELETE FROM ore_giornaliere' in dopo and 'DELETE FROM presenze_correnti' in dopo
+    assert dopo[-1] == 'COMMIT'
+    # Le sequenze non vengono toccate: la migrazione riprenderà dal checkpoint
+    assert not any('setval' in s for s in sql)
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+import report
+
+# Paginazione per cursore del dettaglio di un dipendente (/api/report/dipendente/<id>).
+
+INIZIO = datetime(2026, 3, 20, 8, 0)
+
+
+def timbrature(n):
+    # Dalla più recente, come la query del report
+    return [{'id': 100 - i, 'inizio': INIZIO - timedelta(days=i), 'fine': INIZIO - timedelta(days=i) + timedelta(hours=8),
+             'ore': Decimal('8')} for i in range(n)]
+
+
+def test_cursore_andata_e_ritorno():
+    t = {'id': 4242, 'inizio': datetime(2026, 3, 1, 7, 59, 30)}
+    assert report.leggi_cursore(report.scrivi_cursore(t)) == (t['inizio'], 4242)
+    # Senza padding e sicuro negli URL
+    assert set(report.scrivi_cursore(t)) <= set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_')
+
+
+@pytest.mark.parametrize('token', ['', 'x', '!!!!', 'bm9uLXZhbGlkbw', 'MjAyNi0wMy0wMXxhYmM', 'w6g'])
+def test_cursore_non_valido(token):
+    with pytest.raises(report.ParametroNonValido):
+        report.leggi_cursore(token)
+
+
+@pytest.fixture
+def dettaglio(db_finto):
+    def risposta(sql, params):
+        if 'versione_dati' in sql:
+            return [{'versione': 1}]
+        if 'FROM dipendenti' in sql:
+            return [{'nome': 'Mario', 'cognome': 'Rossi'}]
+        if 'FROM timbrature' in sql:
+            return timbrature(params[-1])
+        return []
+    db_finto.risposta = risposta
+    return db_finto
+
+
+def test_pagine(dettaglio, client_admin):
+    prima = client_admin.get('/api/report/dipendente/1?periodo=anno&limit=5').get_json()
+    assert [t['id'] for t in prima['timbrature']] == [100, 99, 98, 97, 96]
+    assert 'totali' in prima
+    # Una riga in più per sapere se c'è un'altra pagina
+    _, params = next(q for q in dettaglio.query if 'FROM timbrature' in q[0])
+    assert params[-1] == 6
+
+    dettaglio.query.clear()
+    seconda = client_admin.get(f"/api/report/dipendente/1?periodo=anno&limit=5&cursore={prima['next']}").get_json()
+    assert 'totali' not in seconda
+    sql, params = next(q for q in dettaglio.query if 'FROM timbrature' in q[0])
+    assert '(t.inizio, t.id) < (%s, %s)' in sql
+    assert params[-3:] == [INIZIO - timedelta(days=4), 96, 6]
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=1001', 'limit=-5', 'limit=abc', 'cursore=non-valido'])
+def test_parametri_non_validi(dettaglio, client_admin, query):
+    risposta = client_admin.get(f'/api/report/dipendente/1?{query}')
+    assert risposta.status_code == 400
+    assert 'error' in risposta.get_json()
+    assert not any('FROM timbrature' in sql for sql, _ in dettaglio.query)
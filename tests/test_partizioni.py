@@ -0,0 +1,70 @@
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import pytest
+
+import app as app_module
+
+# Partizioni mensili di timbrature: creazione giornaliera dai worker (senza
+# database) e funzione crea_partizioni_timbrature (con DATABASE_URL, tutto in
+# una transazione annullata alla fine).
+
+richiede_db = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL not set')
+
+
+def test_manutenzione_una_volta_al_giorno(monkeypatch):
+    chiamate = []
+    fatto = threading.Event()
+
+    def crea_partizioni():
+        chiamate.append(threading.current_thread().name)
+        fatto.set()
+
+    monkeypatch.setattr(app_module, 'crea_partizioni', crea_partizioni)
+    monkeypatch.setattr(app_module, 'ultima_manutenzione', date.today() - timedelta(days=1))
+
+    client = app_module.app.test_client()
+    client.get('/login')
+    assert fatto.wait(5)
+    client.get('/login')
+    client.get('/login')
+
+    assert chiamate == ['crea-partizioni']
+    assert app_module.ultima_manutenzione == date.today()
+
+
+@richiede_db
+def test_crea_partizioni_sposta_righe_dalla_default():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'timbrature'::regclass")
+        if cur.fetchone() is None:
+            pytest.skip('timbrature is not partitioned: run migra_partizioni.py first')
+
+        cur.execute('''
+            INSERT INTO dipendenti (nome, cognome, email, data_assunzione)
+            VALUES ('Test', 'Partizioni', 'test-partizioni@example.com', current_date) RETURNING id
+        ''')
+        dipendente_id = cur.fetchone()[0]
+        # Un mese senza partizione: la riga finisce in timbrature_default
+        cur.execute('INSERT INTO timbrature (dipendente_id, inizio, fine) VALUES (%s, %s, %s)',
+                    (dipendente_id, datetime(2099, 1, 15, 8), datetime(2099, 1, 15, 16)))
+        cur.execute("SELECT tableoid::regclass::text FROM timbrature WHERE dipendente_id = %s", (dipendente_id,))
+        assert cur.fetchone()[0] == 'timbrature_default'
+
+        cur.execute("SELECT crea_partizioni_timbrature('2099-01-01', '2099-02-01')")
+        assert cur.fetchone()[0] == 2
+        cur.execute("SELECT crea_partizioni_timbrature('2099-01-01', '2099-02-01')")
+        assert cur.fetchone()[0] == 0
+
+        cur.execute("SELECT tableoid::regclass::text FROM timbrature WHERE dipendente_id = %s", (dipendente_id,))
+        assert cur.fetchone()[0] == 'timbrature_2099_01'
+        # Lo spostamento passa dai trigger: le ore del giorno non sono contate due volte
+        cur.execute('SELECT ore, n_timbrature FROM ore_giornaliere WHERE dipendente_id = %s', (dipendente_id,))
+        assert cur.fetchall() == [(8, 1)]
+    finally:
+        conn.rollback()
+        conn.close()
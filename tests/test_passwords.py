@@ -0,0 +1,66 @@
+import passwords
+from passwords import PasswordHasher
+
+# Cache delle verifiche delle password: un accesso ripetuto entro cache_ttl
+# secondi non ricalcola PBKDF2. Con 0 processi l'hash è calcolato nel thread
+# del test.
+
+
+def hasher_contato(monkeypatch, cache_ttl=60):
+    calcoli = []
+    check = passwords.check_password_hash
+
+    def check_contato(hash_salvato, password):
+        calcoli.append(password)
+        return check(hash_salvato, password)
+
+    monkeypatch.setattr(passwords, 'check_password_hash', check_contato)
+    return PasswordHasher(1000, 0, cache_ttl, 'chiave'), calcoli
+
+
+def test_verifica_in_cache(monkeypatch):
+    hasher, calcoli = hasher_contato(monkeypatch)
+    hash_salvato = hasher.genera('kiosk')
+
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert calcoli == ['kiosk']
+    stats = hasher.stats()
+    assert (stats['cache_hits'], stats['cache_misses'], stats['cache_entries']) == (1, 1, 1)
+
+    # Le password errate non vanno in cache; un nuovo hash salvato (password
+    # cambiata) non usa la voce della vecchia
+    assert not hasher.verifica(hash_salvato, 'sbagliata')
+    assert not hasher.verifica(hash_salvato, 'sbagliata')
+    assert hasher.verifica(hasher.genera('kiosk'), 'kiosk')
+    assert calcoli == ['kiosk', 'sbagliata', 'sbagliata', 'kiosk']
+
+
+def test_scadenza_cache(monkeypatch):
+    hasher, calcoli = hasher_contato(monkeypatch, cache_ttl=60)
+    hash_salvato = hasher.genera('kiosk')
+    adesso = [1000.0]
+    monkeypatch.setattr(passwords.time, 'monotonic', lambda: adesso[0])
+
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    adesso[0] += 59
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert calcoli == ['kiosk']
+    adesso[0] += 2
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert calcoli == ['kiosk', 'kiosk']
+
+
+def test_cache_disattivata(monkeypatch):
+    hasher, calcoli = hasher_contato(monkeypatch, cache_ttl=0)
+    hash_salvato = hasher.genera('kiosk')
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert hasher.verifica(hash_salvato, 'kiosk')
+    assert calcoli == ['kiosk', 'kiosk']
+    assert hasher.stats()['cache_entries'] == 0
+
+
+def test_da_aggiornare():
+    hasher = PasswordHasher(1000, 0, 60, 'chiave')
+    assert not hasher.da_aggiornare(hasher.genera('kiosk'))
+    assert PasswordHasher(2000, 0, 60, 'chiave').da_aggiornare(hasher.genera('kiosk'))
@@ -0,0 +1,179 @@
+import os
+from datetime import date, datetime
+
+import psycopg2
+import pytest
+
+import app as app_module
+from db_wrapper import NeonDB
+
+# Verifica dei piani delle query di report: chiama gli endpoint con il client di
+# test di Flask, registra le query su timbrature, ore_giornaliere e gli snapshot
+# dei mesi chiusi e con EXPLAIN controlla che:
+#   - vengano lette solo le partizioni dei mesi compresi tra le date passate
+#     come parametri (partition pruning);
+#   - nessuna di queste tabelle venga letta con un seq scan. Il controllo è fatto
+#     con enable_seqscan = off: su un database piccolo il planner sceglie il seq
+#     scan anche quando l'indice è usabile, quindi resta un seq scan solo se il
+#     filtro non può usare nessun indice (funzioni o cast sulla colonna).
+# Richiedono un database (DATABASE_URL, anche da .env) e vengono saltati senza.
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL not set')
+
+TABELLE = ('timbrature', 'ore_giornaliere', 'ore_giornaliere_chiuse', 'ore_mensili_chiuse')
+
+
+def url_da_verificare():
+    anno = date.today().year
+    urls = []
+    for periodo in ('settimana', 'mese', 'mese_specifico', 'anno'):
+        for a in (anno, anno - 1):
+            filtro = f'periodo={periodo}&anno={a}&mese=3'
+            urls += [
+                f'/api/report/totale?{filtro}',
+                f'/api/report/mensile?{filtro}',
+                f'/api/report/mensile?{filtro}&dipendente=1',
+                f'/api/report/distribuzione?{filtro}',
+                f'/api/report/distribuzione?{filtro}&dipendente=1',
+                f'/api/report/confronto?{filtro}',
+                f'/api/report/dipendente/1?{filtro}',
+                f'/api/report/timbrature?{filtro}',
+                f'/api/export/timbrature?{filtro}&formato=csv',
+                f'/api/export/timbrature?{filtro}&formato=csv&dipendente=1',
+            ]
+    return urls
+
+
+def date_parametri(params):
+    valori = []
+    for p in params if isinstance(params, (list, tuple)) else ():
+        if isinstance(p, datetime):
+            valori.append(p.date())
+        elif isinstance(p, date):
+            valori.append(p)
+        elif isinstance(p, str):
+            try:
+                valori.append(datetime.fromisoformat(p).date())
+            except ValueError:
+                pass
+    return valori
+
+
+def mesi(da, a):
+    risultato = []
+    mese = da.replace(day=1)
+    while mese <= a:
+        risultato.append(f"timbrature_{mese:%Y_%m}")
+        mese = date(mese.year + mese.month // 12, mese.month % 12 + 1, 1)
+    return risultato
+
+
+def nodi(piano):
+    yield piano
+    for figlio in piano.get('Plans', []):
+        yield from nodi(figlio)
+
+
+def piano(cur, query, params):
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+    return cur.fetchone()[0][0]['Plan']
+
+
+def tabella(nome):
+    # Le partizioni contano come timbrature
+    return 'timbrature' if nome.startswith('timbrature_') else nome
+
+
+def partizioni_extra(cur, query, params, partizioni):
+    """Partizioni lette oltre a quelle dei mesi del periodo richiesto."""
+    date_query = date_parametri(params)
+    if not date_query:
+        return set()
+    attese = mesi(min(date_query), max(date_query))
+    lette = {n['Relation Name'] for n in nodi(piano(cur, query, params))
+             if n.get('Relation Name', '').startswith('timbrature_')}
+    # La partizione di default è ammessa solo per i mesi senza partizione propria
+    ammesse = set(attese)
+    if any(p not in partizioni for p in attese):
+        ammesse.add('timbrature_default')
+    return lette - ammesse
+
+
+def seq_scan(cur, query, params):
+    """Tabelle dei report lette per intero anche con enable_seqscan = off."""
+    cur.execute('SET LOCAL enable_seqscan = off')
+    return sorted({n['Relation Name'] for n in nodi(piano(cur, query, params))
+                   if tabella(n.get('Relation Name', '')) in TABELLE and n['Node Type'] == 'Seq Scan'})
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='module')
+def partizioni(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'timbrature'::regclass
+        """)
+        partizioni = {r[0] for r in cur.fetchall()}
+    conn.rollback()
+    if not partizioni:
+        pytest.skip('timbrature is not partitioned: run migra_partizioni.py first')
+    return partizioni
+
+
+@pytest.fixture
+def query_registrate(monkeypatch):
+    registrate = []
+    execute = NeonDB.execute
+    stream = NeonDB.stream
+
+    def execute_registrato(self, query, params=()):
+        registrate.append((query, params))
+        return execute(self, query, params)
+
+    def stream_registrato(self, query, params=(), chunk_size=2000):
+        registrate.append((query, params))
+        return stream(self, query, params, chunk_size)
+
+    monkeypatch.setattr(NeonDB, 'execute', execute_registrato)
+    monkeypatch.setattr(NeonDB, 'stream', stream_registrato)
+    # Le risposte devono arrivare dalle query, non dalla cache dei report
+    monkeypatch.setattr(app_module, 'get_report_cache', lambda: None)
+    return registrate
+
+
+@pytest.fixture
+def client():
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+        s['role'] = 'admin'
+    return client
+
+
+@pytest.mark.parametrize('url', url_da_verificare())
+def test_piani_report(url, client, query_registrate, conn, partizioni):
+    risposta = client.get(url)
+    risposta.get_data()
+    assert risposta.status_code == 200
+
+    errori = []
+    for query, params in query_registrate:
+        if not any(t in query for t in TABELLE) or 'versione_dati' in query:
+            continue
+        with conn.cursor() as cur:
+            if 'timbrature' in query:
+                extra = partizioni_extra(cur, query, params, partizioni)
+                if extra:
+                    errori.append(f"partizioni in più: {', '.join(sorted(extra))}")
+            seq = seq_scan(cur, query, params)
+            if seq:
+                errori.append(f"seq scan su {', '.join(seq)}")
+        conn.rollback()
+    assert not errori, '\n'.join(errori)
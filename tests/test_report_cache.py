@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+import report_cache
+from report_cache import ReportCache
+
+# Cache dei report su SQLite: i hit non scrivono sul file condiviso, l'epoca
+# cambiata dagli script invalida le voci esistenti.
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ReportCache(str(tmp_path / 'cache.sqlite3'), 1024 * 1024)
+    cache.put('chiave', '{"ore":"8.00"}', 1, '2026-03-01', '2026-03-31', cache.generazione())
+    return cache
+
+
+def ultimo_accesso(cache):
+    return cache._conn().execute("SELECT ultimo_accesso FROM voci WHERE chiave = 'chiave'").fetchone()[0]
+
+
+def test_hit_senza_scritture(cache):
+    conn = cache._conn()
+    scritture = conn.total_changes
+    for _ in range(10):
+        assert cache.get('chiave') == '{"ore":"8.00"}'
+    assert conn.total_changes == scritture
+    assert cache.stats()['hits'] == 10
+
+
+def test_ultimo_accesso_aggiornato_dopo_intervallo(cache, monkeypatch):
+    prima = ultimo_accesso(cache)
+    monkeypatch.setattr(report_cache.time, 'time', lambda: prima + cache.intervallo_accesso + 1)
+    assert cache.get('chiave') is not None
+    assert ultimo_accesso(cache) == prima + cache.intervallo_accesso + 1
+
+
+def test_hit_con_file_bloccato(cache, monkeypatch):
+    # Un altro worker tiene il lock di scrittura: il report viene servito lo stesso
+    altro = sqlite3.connect(cache.path, timeout=0, isolation_level=None)
+    altro.execute('BEGIN IMMEDIATE')
+    cache._conn().execute('PRAGMA busy_timeout = 0')
+    prima = ultimo_accesso(cache)
+    monkeypatch.setattr(report_cache.time, 'time', lambda: prima + cache.intervallo_accesso + 1)
+    try:
+        assert cache.get('chiave') == '{"ore":"8.00"}'
+    finally:
+        altro.execute('ROLLBACK')
+        altro.close()
+    assert cache.stats()['errors'] == 0
+
+
+def test_invalida_cache_locale(cache, monkeypatch):
+    monkeypatch.setenv('REPORT_CACHE_PATH', cache.path)
+    report_cache.invalida_cache_locale()
+    assert cache.get('chiave') is None
+
+
+def test_invalida_cache_locale_senza_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('REPORT_CACHE_PATH', str(tmp_path / 'assente.sqlite3'))
+    report_cache.invalida_cache_locale()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,68 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+import app as app_module
+from db_wrapper import NeonDB
+
+# Il numero di query dei report non deve crescere con il numero di dipendenti
+# (nessuna query per dipendente). Il database è sostituito da una connessione
+# finta, quindi i test non richiedono Postgres.
+
+
+class CursoreFinto:
+    def __init__(self, dipendenti):
+        self.dipendenti = dipendenti
+        self.righe = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        # Una riga per dipendente e mese, come la query raggruppata di confronto
+        self.righe = [
+            {'id': i, 'nome': f'Nome{i}', 'cognome': f'Cognome{i:04d}',
+             'mese': date(2025, mese, 1), 'ore_totali': Decimal('160.00')}
+            for i in range(1, self.dipendenti + 1) for mese in (1, 2)
+        ]
+        self.rowcount = len(self.righe)
+
+    def fetchall(self):
+        return self.righe
+
+
+class ConnessioneFinta:
+    def __init__(self, dipendenti):
+        self.dipendenti = dipendenti
+
+    def cursor(self, cursor_factory=None):
+        return CursoreFinto(self.dipendenti)
+
+    def rollback(self):
+        pass
+
+
+def query_confronto(monkeypatch, dipendenti, periodo):
+    chiamate = []
+    execute = NeonDB.execute
+
+    def execute_contato(self, query, params=()):
+        chiamate.append(query)
+        return execute(self, query, params)
+
+    db = NeonDB(ConnessioneFinta(dipendenti))
+    monkeypatch.setattr(NeonDB, 'execute', execute_contato)
+    monkeypatch.setattr(app_module, 'get_db', lambda: db)
+    monkeypatch.setattr(app_module, 'get_report_cache', lambda: None)
+
+    url = f'/api/report/confronto?periodo={periodo}&anno=2025&mese=1'
+    with app_module.app.test_request_context(url):
+        risposta = app_module.esegui_report(app_module.report.confronto(app_module.request.args))
+    assert len(risposta.get_json()['datasets']) == dipendenti
+    return len(chiamate)
+
+
+@pytest.mark.parametrize('periodo', ['anno', 'mese_specifico'])
+def test_confronto_query_costanti(monkeypatch, periodo):
+    pochi = query_confronto(monkeypatch, 10, periodo)
+    molti = query_confronto(monkeypatch, 300, periodo)
+    assert pochi == molti == 1
@@ -0,0 +1,93 @@
+import gzip
+import os
+import sys
+
+import pytest
+
+import app as app_module
+import build_static
+import risposte
+
+# Asset statici di build_static.py: nomi con hash nel manifest, versioni
+# precompresse scelte secondo Accept-Encoding, niente file fuori da static/dist.
+
+
+@pytest.fixture
+def dist(tmp_path, monkeypatch):
+    # Build in una cartella temporanea, servita al posto di static/dist
+    monkeypatch.setattr(build_static, 'DIST_DIR', str(tmp_path))
+    monkeypatch.setattr(sys, 'argv', ['build_static.py'])
+    build_static.main()
+    monkeypatch.setattr(app_module, 'ASSET_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'asset_manifest', app_module.carica_manifest())
+    return tmp_path
+
+
+def url_css():
+    with app_module.app.test_request_context():
+        return app_module.asset_url(filename='css/style.css')
+
+
+def test_asset_url_con_hash(dist):
+    nome = app_module.asset_manifest['css/style.css']
+    assert nome.startswith('css/style.') and nome.endswith('.css')
+    assert url_css() == f'/static/dist/{nome}'
+    with open(os.path.join(app_module.app.static_folder, 'css', 'style.css'), 'rb') as f:
+        assert (dist / nome).read_bytes() == f.read()
+    with app_module.app.test_request_context():
+        # Fuori dal manifest: il file di static/
+        assert app_module.asset_url(filename='non/esiste.js') == '/static/non/esiste.js'
+
+
+def test_asset_url_senza_build_o_in_debug(dist, monkeypatch):
+    monkeypatch.setattr(app_module.app, 'debug', True)
+    assert url_css() == '/static/css/style.css'
+    monkeypatch.setattr(app_module.app, 'debug', False)
+    monkeypatch.setattr(app_module, 'asset_manifest', {})
+    assert url_css() == '/static/css/style.css'
+
+
+@pytest.mark.parametrize('codifica', ['br', 'gzip', 'identity'])
+def test_versione_precompressa(dist, codifica):
+    if codifica == 'br' and risposte.brotli is None:
+        pytest.skip('brotli not installed')
+    client = app_module.app.test_client()
+    originale = client.get('/static/css/style.css').data
+    risposta = client.get(url_css(), headers={'Accept-Encoding': codifica})
+
+    assert risposta.status_code == 200
+    assert risposta.mimetype == 'text/css'
+    assert 'Accept-Encoding' in risposta.headers['Vary']
+    assert risposta.cache_control.immutable and risposta.cache_control.public
+    assert risposta.cache_control.max_age == app_module.ASSET_MAX_AGE
+    if codifica == 'identity':
+        assert 'Content-Encoding' not in risposta.headers
+        assert risposta.data == originale
+    else:
+        assert risposta.headers['Content-Encoding'] == codifica
+        decompressa = risposte.brotli.decompress(risposta.data) if codifica == 'br' else gzip.decompress(risposta.data)
+        assert decompressa == originale
+
+
+def test_senza_versione_precompressa(dist):
+    # Un asset senza .gz accanto: servito non compresso anche se il client accetta gzip
+    nome = app_module.asset_manifest['css/style.css']
+    (dist / (nome + '.gz')).unlink()
+    risposta = app_module.app.test_client().get(url_css(), headers={'Accept-Encoding': 'gzip'})
+    assert risposta.status_code == 200
+    assert 'Content-Encoding' not in risposta.headers
+
+
+@pytest.mark.parametrize('percorso', [
+    '/static/dist/../../app.py',
+    '/static/dist/%2e%2e/%2e%2e/app.py',
+    '/static/dist/..%2f..%2fapp.py',
+    '/static/dist//etc/passwd',
+    '/static/dist/manifest.json/../../../app.py',
+])
+def test_percorsi_fuori_da_dist(dist, percorso):
+    client = app_module.app.test_client()
+    for codifica in ('gzip', 'identity'):
+        risposta = client.get(percorso, headers={'Accept-Encoding': codifica})
+        assert risposta.status_code == 404
+        assert b'import' not in risposta.data and b'root:' not in risposta.data
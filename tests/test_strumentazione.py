@@ -0,0 +1,42 @@
+import logging
+import re
+
+import app as app_module
+from db_wrapper import NeonDB, normalize_sql
+
+# Strumentazione SQL per richiesta: testo delle query nei log, log delle query
+# lente senza parametri e header Server-Timing.
+
+
+def test_normalize_sql():
+    sql = "SELECT *  FROM t\n WHERE nome = 'Rossi' AND id = 42 AND inizio >= %s"
+    assert normalize_sql(sql) == 'SELECT * FROM t WHERE nome = ? AND id = ? AND inizio >= ?'
+    assert normalize_sql('SELECT ' + 'x, ' * 300, max_length=20) == 'SELECT x, x, x, x, x...'
+
+
+def test_query_lenta_senza_parametri(caplog):
+    from conftest import DatabaseFinto
+
+    db = NeonDB(DatabaseFinto(), slow_query_ms=1e-9, label='login')
+    with caplog.at_level(logging.WARNING, logger='timbraceck.sql'):
+        db.execute('SELECT id FROM admin WHERE username = %s AND password = %s', ('mario', 'segreto'))
+
+    assert len(caplog.records) == 1
+    messaggio = caplog.records[0].getMessage()
+    assert '2 params redacted [login]' in messaggio
+    assert 'WHERE username = ? AND password = ?' in messaggio
+    assert 'segreto' not in messaggio and 'mario' not in messaggio
+    assert db.stats.count == 1
+
+
+def test_server_timing(db_finto, client_admin, monkeypatch):
+    risposta = client_admin.get('/api/report/totale?periodo=mese')
+    assert risposta.status_code == 200
+    server_timing = risposta.headers['Server-Timing']
+    assert re.fullmatch(r'app;dur=[\d.]+, db;dur=[\d.]+;desc="(.*)", db-slowest;dur=[\d.]+', server_timing)
+    # Versione dei dati per l'ETag e query del report
+    assert 'desc="2 queries, 1 rows"' in server_timing
+    assert len(db_finto.query) == 2
+
+    monkeypatch.setitem(app_module.app.config, 'SERVER_TIMING', False)
+    assert 'Server-Timing' not in client_admin.get('/api/report/totale?periodo=mese').headers
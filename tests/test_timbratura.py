@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+import psycopg2
+import pytest
+
+import app as app_module
+from db_wrapper import NeonDB
+
+# Tocchi doppi sul chiosco contro un database reale: il secondo tocco non deve
+# aprire un nuovo turno. Saltati senza DATABASE_URL (anche da .env).
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL not set')
+
+
+def connetti():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def turni_aperti(conn, dipendente_id):
+    with conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM timbrature WHERE dipendente_id = %s AND fine IS NULL',
+                    (dipendente_id,))
+        aperti = cur.fetchone()[0]
+    conn.rollback()
+    return aperti
+
+
+@pytest.fixture
+def conn():
+    conn = connetti()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def dipendente(conn):
+    # Dipendente creato per il test ed eliminato alla fine con le sue timbrature
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO dipendenti (nome, cognome, email, data_assunzione)
+            VALUES ('Test', 'Tocco doppio', %s, %s) RETURNING id
+        ''', (f'test-{uuid.uuid4().hex}@example.com', date.today()))
+        dipendente_id = cur.fetchone()[0]
+    conn.commit()
+    yield dipendente_id
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM dipendenti WHERE id = %s', (dipendente_id,))
+    conn.commit()
+
+
+@pytest.fixture
+def db():
+    db = NeonDB(connetti())
+    yield db
+    db.conn.close()
+
+
+def test_uscita_concorrente(conn, dipendente, db):
+    assert app_module.registra_timbratura(db, dipendente, None, datetime.now())['tipo'] == 'ingresso'
+
+    # Primo tocco in uscita lasciato in sospeso: tiene il blocco sul turno aperto
+    primo = connetti()
+    with primo.cursor() as cur:
+        cur.execute('UPDATE timbrature SET fine = %s WHERE dipendente_id = %s AND fine IS NULL',
+                    (datetime.now(), dipendente))
+
+    esiti = []
+    secondo = threading.Thread(target=lambda: esiti.append(
+        app_module.registra_timbratura(db, dipendente, None, datetime.now())))
+    secondo.start()
+    try:
+        # Attende che il secondo tocco sia fermo sul blocco del primo
+        pid = db.conn.get_backend_pid()
+        for _ in range(100):
+            with conn.cursor() as cur:
+                cur.execute('SELECT wait_event_type FROM pg_stat_activity WHERE pid = %s', (pid,))
+                riga = cur.fetchone()
+            conn.rollback()
+            if riga and riga[0] == 'Lock':
+                break
+            time.sleep(0.05)
+        else:
+            pytest.fail('the second punch never waited for the first one')
+    finally:
+        primo.commit()
+        primo.close()
+        secondo.join(10)
+
+    assert esiti[0]['tipo'] == 'uscita_doppia'
+    assert turni_aperti(conn, dipendente) == 0
+
+
+def test_tocco_dopo_uscita(conn, dipendente, db, monkeypatch):
+    for tipo in ('ingresso', 'uscita', 'uscita_doppia'):
+        assert app_module.registra_timbratura(db, dipendente, None, datetime.now())['tipo'] == tipo
+    assert turni_aperti(conn, dipendente) == 0
+
+    # Fuori dalla finestra il tocco è un nuovo ingresso
+    monkeypatch.setitem(app_module.app.config, 'TIMBRATURA_DOPPIA_SECONDI', 0)
+    assert app_module.registra_timbratura(db, dipendente, None, datetime.now())['tipo'] == 'ingresso'
+    assert turni_aperti(conn, dipendente) == 1
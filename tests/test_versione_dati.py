@@ -0,0 +1,46 @@
+import os
+
+import psycopg2
+import pytest
+
+import report
+
+# Versione dei dati per gli ETag: un contatore per tabella. Con DATABASE_URL;
+# entrambe le transazioni vengono annullate alla fine.
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL not set')
+
+
+@pytest.fixture
+def connessioni():
+    connessioni = [psycopg2.connect(os.environ['DATABASE_URL']) for _ in range(2)]
+    yield connessioni
+    for conn in connessioni:
+        conn.rollback()
+        conn.close()
+
+
+def versione(cur):
+    cur.execute(report.VERSIONE_DATI)
+    return cur.fetchone()[0]
+
+
+def test_ogni_scrittura_cambia_la_versione(connessioni):
+    with connessioni[0].cursor() as cur:
+        prima = versione(cur)
+        cur.execute("UPDATE dipendenti SET colore = colore WHERE false")
+        assert versione(cur) == prima + 1
+        cur.execute("DELETE FROM timbrature WHERE false")
+        assert versione(cur) == prima + 2
+
+
+def test_dipendenti_non_attendono_le_timbrature(connessioni):
+    # Una transazione aperta che ha scritto su timbrature tiene il lock della
+    # sua riga di versione_dati, non di quella dei dipendenti
+    timbrature, dipendenti = (conn.cursor() for conn in connessioni)
+    timbrature.execute("DELETE FROM timbrature WHERE false")
+    dipendenti.execute("SET LOCAL lock_timeout = '200ms'")
+    dipendenti.execute("UPDATE dipendenti SET colore = colore WHERE false")
+    # Stessa tabella: attende la prima transazione
+    with pytest.raises(psycopg2.errors.LockNotAvailable):
+        dipendenti.execute("DELETE FROM timbrature WHERE false")